@@ -1,248 +1,3840 @@
+import time
+STARTUP_T0 = time.perf_counter()
+
 import os
 import discord
+import audioop   # el mismo que usa discord.py para el volumen (audioop-lts desde Python 3.13)
 from discord.ext import commands
 from discord import app_commands, ui
 from dotenv import load_dotenv
-import yt_dlp
-from collections import deque
+from collections import deque, OrderedDict
 import asyncio
+import bisect
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import re
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyClientCredentials
+import json
+import sqlite3
+import threading
+import sys
+import random
+from urllib.parse import quote, unquote, urlsplit
+from dataclasses import dataclass
+from abc import ABC, abstractmethod
+from functools import cache
+from itertools import islice
 import aiohttp
-import requests
-import imageio_ffmpeg as ffmpeg
+from aiohttp import web
+import hashlib
+import unicodedata
+from difflib import SequenceMatcher
+
+# Sólo el módulo: yt_dlp se importa dentro de los procesos del pool, no en el del bot
+import ytdl_worker
+
+from datetime import timedelta
+
+# =========================
+# CARGA DE CONFIGURACIÓN
+# =========================
+load_dotenv()
+TOKEN = os.getenv("DISCORD_TOKEN")
+SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
+SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+
+# Opcional para Last.fm (para /lastfm)
+LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")   # Recomendado
+LASTFM_USER = os.getenv("LASTFM_USER")         # Recomendado
+
+# Opcional para scrobblear a Last.fm lo que suena (cuenta de LASTFM_USER)
+LASTFM_API_SECRET = os.getenv("LASTFM_API_SECRET")
+LASTFM_SESSION_KEY = os.getenv("LASTFM_SESSION_KEY")
+SCROBBLE_FLUSH_INTERVAL = float(os.getenv("SCROBBLE_FLUSH_INTERVAL", 60))   # segundos entre envíos
+
+# Búsquedas simultáneas en YouTube al importar una playlist, álbum o artista de Spotify
+SPOTIFY_PLAYLIST_CONCURRENCY = int(os.getenv("SPOTIFY_PLAYLIST_CONCURRENCY", 8))
+SPOTIFY_MARKET = os.getenv("SPOTIFY_MARKET", "US")   # país para disponibilidad y top de artistas
+SPOTIFY_MATCH_CANDIDATES = int(os.getenv("SPOTIFY_MATCH_CANDIDATES", 6))   # resultados de YouTube a puntuar por pista
+
+# Máximo de vídeos que se importan de una playlist o mix de YouTube
+YOUTUBE_PLAYLIST_MAX_ENTRIES = int(os.getenv("YOUTUBE_PLAYLIST_MAX_ENTRIES", 1000))
+
+# Reintentos al recuperar un stream cortado antes de tiempo (URL caducada, etc.)
+STREAM_MAX_RECOVERIES = int(os.getenv("STREAM_MAX_RECOVERIES", 2))
+
+# Transiciones sin hueco: ffmpeg de la siguiente pista se lanza y se precarga poco antes del final
+PREROLL_SECONDS = float(os.getenv("PREROLL_SECONDS", 8))      # antelación; 0 lo desactiva
+PREROLL_FRAMES = int(os.getenv("PREROLL_FRAMES", 25))         # frames de 20 ms leídos por adelantado
+CROSSFADE_SECONDS = float(os.getenv("CROSSFADE_SECONDS", 0))  # fundido entre pistas (sólo modo "pcm")
+
+# Modo de reproducción: "pcm" (volumen en Python, codificación en discord.py) u "opus" (todo en ffmpeg)
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "pcm").lower()
+OPUS_BITRATE = int(os.getenv("OPUS_BITRATE", 128))   # kbps, sólo modo "opus"
+
+# Procesos dedicados a yt-dlp (fuera del GIL de los hilos de audio)
+YTDLP_WORKERS = int(os.getenv("YTDLP_WORKERS", 2))
+
+# Admisión de extracciones: a la vez en el pool (0: tantas como procesos) y por servidor (0: sin tope propio),
+# comandos /play por usuario (por minuto y ráfaga; 0: sin límite) y plazo para que un /play tenga su
+# canción antes de avisar de que el bot está saturado (0: sin plazo)
+EXTRACTION_MAX_ACTIVE = int(os.getenv("EXTRACTION_MAX_ACTIVE", 0)) or None
+EXTRACTION_GUILD_LIMIT = int(os.getenv("EXTRACTION_GUILD_LIMIT", 0)) or None
+EXTRACTION_USER_RATE = float(os.getenv("EXTRACTION_USER_RATE", 30))
+EXTRACTION_USER_BURST = int(os.getenv("EXTRACTION_USER_BURST", 8))
+EXTRACTION_INTERACTIVE_DEADLINE = float(os.getenv("EXTRACTION_INTERACTIVE_DEADLINE", 25))   # segundos
+
+# Carpeta para los datos persistentes del bot (cachés, etc.). No se crea al importar: cada
+# archivo crea su carpeta al escribirse por primera vez (ensure_parent_dir)
+DATA_DIR = os.getenv("BOT_DATA_DIR", "data")
+
+def ensure_parent_dir(path: str) -> str:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+# Caché persistente de resoluciones búsqueda/Spotify/URL → pista de YouTube
+RESOLUTION_CACHE_PATH = os.getenv("RESOLUTION_CACHE_PATH", os.path.join(DATA_DIR, "resolution_cache.sqlite3"))
+RESOLUTION_CACHE_TTL = int(os.getenv("RESOLUTION_CACHE_TTL", 30 * 24 * 3600))   # segundos
+RESOLUTION_CACHE_MAX_ENTRIES = int(os.getenv("RESOLUTION_CACHE_MAX_ENTRIES", 50000))
+
+# URLs directas de audio recordadas en memoria (las firmadas caducan en unas horas)
+STREAM_URL_CACHE_SIZE = int(os.getenv("STREAM_URL_CACHE_SIZE", 2048))
+
+# Historial de reproducción por servidor (repeticiones sin extraer y autoplay): pistas recordadas por
+# servidor y cuántas de las últimas que sonaron no repite el autoplay
+PLAY_HISTORY_PATH = os.getenv("PLAY_HISTORY_PATH", os.path.join(DATA_DIR, "play_history.sqlite3"))
+PLAY_HISTORY_MAX_TRACKS = int(os.getenv("PLAY_HISTORY_MAX_TRACKS", 2000))
+AUTOPLAY_RECENT = int(os.getenv("AUTOPLAY_RECENT", 20))
+
+# Caché de audio en disco para pistas repetidas, en bucle o con /seek (0 la desactiva)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(DATA_DIR, "audio"))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", 2048)) * 1024 * 1024
+AUDIO_CACHE_MAX_TRACK_SECONDS = int(os.getenv("AUDIO_CACHE_MAX_TRACK_SECONDS", 15 * 60))
+
+# Normalización de volumen (EBU R128): sonoridad objetivo y ganancia máxima aplicable en dB
+LOUDNESS_TARGET_LUFS = float(os.getenv("LOUDNESS_TARGET_LUFS", -14))
+LOUDNESS_MAX_GAIN_DB = float(os.getenv("LOUDNESS_MAX_GAIN_DB", 6))
+LOUDNESS_NORMALIZATION = os.getenv("LOUDNESS_NORMALIZATION", "1") == "1"
+
+# Persistencia de colas: diario de cambios + instantánea compactada (se restauran al reiniciar)
+QUEUE_JOURNAL_PATH = os.getenv("QUEUE_JOURNAL_PATH", os.path.join(DATA_DIR, "queues.journal"))
+QUEUE_SNAPSHOT_PATH = os.getenv("QUEUE_SNAPSHOT_PATH", os.path.join(DATA_DIR, "queues.snapshot.json"))
+QUEUE_FLUSH_INTERVAL = float(os.getenv("QUEUE_FLUSH_INTERVAL", 1.0))        # segundos entre escrituras del diario
+QUEUE_SNAPSHOT_INTERVAL = float(os.getenv("QUEUE_SNAPSHOT_INTERVAL", 60))   # segundos entre instantáneas
+QUEUE_POSITION_INTERVAL = float(os.getenv("QUEUE_POSITION_INTERVAL", 5))    # cada cuánto se guarda la posición
+
+# Dónde vive el estado de las colas: "file" (diario local), "memory" (se pierde al reiniciar) o "redis"
+# (compartido entre procesos: un servidor puede cambiar de proceso al repartir de nuevo los shards)
+STATE_STORE_BACKEND = os.getenv("STATE_STORE", "file").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+REDIS_STATE_KEY = os.getenv("REDIS_STATE_KEY", "musicbot:guilds")
+
+# Sharding (ver launcher.py): total de shards y los que atiende este proceso; sin definir, uno solo automático
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) or None
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()] or None
+# Sólo un proceso sincroniza los comandos con Discord
+COMMAND_SYNC = os.getenv("COMMAND_SYNC", "1") == "1"
+
+# Caché de letras (lyrics.ovh): entradas en memoria, vigencia de aciertos y de "no encontrada"
+LYRICS_CACHE_SIZE = int(os.getenv("LYRICS_CACHE_SIZE", 512))
+LYRICS_TTL = int(os.getenv("LYRICS_TTL", 24 * 3600))              # segundos
+LYRICS_NEGATIVE_TTL = int(os.getenv("LYRICS_NEGATIVE_TTL", 3600))  # segundos
+# Pedir la letra de cada pista al empezar a sonar, para que /letra responda al momento
+# (LYRICS_PREFETCH=0 lo apaga: una petición a lyrics.ovh por canción aunque nadie la pida)
+LYRICS_PREFETCH = os.getenv("LYRICS_PREFETCH", "1") == "1"
+
+# Mensajes salientes: separación mínima entre llamadas a Discord por canal y canciones por página de /queue
+OUTBOUND_MIN_INTERVAL = float(os.getenv("OUTBOUND_MIN_INTERVAL", 1.0))   # segundos
+QUEUE_PAGE_SIZE = int(os.getenv("QUEUE_PAGE_SIZE", 15))
+
+# Scrobbles pendientes de enviar (sobreviven a caídas de Last.fm y a reinicios)
+SCROBBLE_SPOOL_PATH = os.getenv("SCROBBLE_SPOOL_PATH", os.path.join(DATA_DIR, "scrobbles.spool.json"))
+
+# Registro del último /sync de comandos (hash del árbol); FORCE_COMMAND_SYNC=1 sincroniza siempre
+COMMAND_SYNC_STATE_PATH = os.path.join(DATA_DIR, "command_tree.sha256")
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+
+# =========================
+# CLIENTES EXTERNOS (se crean en el primer uso)
+# =========================
+@cache
+def get_ffmpeg_path() -> str:
+    """Ruta a FFmpeg: FFMPEG_PATH del entorno o el binario de imageio-ffmpeg."""
+    path = os.getenv("FFMPEG_PATH")
+    if not path:
+        import imageio_ffmpeg
+        path = imageio_ffmpeg.get_ffmpeg_exe()
+    # Aviso si la ruta no existe (no bloquea la ejecución)
+    if not os.path.isfile(path):
+        print(f"[AVISO] No se encontró FFmpeg en: {path}. Verifica la ruta o ponlo en el PATH.")
+    return path
+
+# =========================
+# ESTRUCTURAS DE ESTADO
+# =========================
+# Reproductor por servidor (ver GuildPlayer): cola (TrackQueue de Track), canción actual, loop y volumen
+PLAYERS: dict[str, "GuildPlayer"] = {}
+
+# Colas guardadas en disco pendientes de restaurar en on_ready (ver QueueJournal)
+SAVED_QUEUES: dict[str, dict] = {}
+
+# =========================
+# BOT
+# =========================
+intents = discord.Intents.default()
+intents.message_content = True
+
+class MusicBotClient(commands.AutoShardedBot):
+    async def setup_hook(self):
+        mark_startup("login")
+        await open_caches()
+        await start_queue_persistence()
+        if SCROBBLER is not None:
+            SCROBBLER.start()
+        await start_http_server()
+        run_in_background(monitor_loop_lag())
+        run_in_background(seed_suggestions())
+        STARTUP_TIMES["command_sync"] = COMMAND_SYNC_SKIPPED
+        if COMMAND_SYNC:
+            try:
+                STARTUP_TIMES["command_sync"] = COMMAND_SYNC_DONE if await sync_command_tree() else COMMAND_SYNC_SKIPPED
+            except Exception as e:
+                # Sin sync siguen valiendo los comandos ya registrados; el hash no se guardó y se reintenta al reiniciar
+                print(f"[arranque] No se pudieron sincronizar los comandos: {e}")
+                STARTUP_TIMES["command_sync"] = COMMAND_SYNC_FAILED
+        mark_startup("setup")
+
+    async def close(self):
+        # Guardar las colas antes de que la desconexión de voz dispare fines de pista
+        await stop_queue_persistence()
+        if SCROBBLER is not None:
+            SCROBBLER.close()
+        await super().close()
+        await stop_http_server()
+        await close_http_session()
+
+bot = MusicBotClient(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+def owns_guild(guild_id: str | int) -> bool:
+    """Si el servidor cae en uno de los shards de este proceso (fórmula de Discord)."""
+    if SHARD_COUNT is None or SHARD_IDS is None:
+        return True
+    return (int(guild_id) >> 22) % SHARD_COUNT in SHARD_IDS
+
+# =========================
+# MÉTRICAS
+# =========================
+class Histogram:
+    """Histograma acumulativo al estilo Prometheus (buckets "le"). Se puede observar desde cualquier hilo."""
+
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            self.last = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for le, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            label = "+Inf" if le == math.inf else repr(le)
+            lines.append(f'{self.name}_bucket{{le="{label}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+EXTRACTION_SECONDS = Histogram(
+    "musicbot_extraction_seconds", "Latencia de search_ytdlp_async (espera en el pool + extracción).",
+    (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30),
+)
+FFMPEG_FIRST_PACKET_SECONDS = Histogram(
+    "musicbot_ffmpeg_first_packet_seconds", "Desde lanzar ffmpeg hasta el primer paquete de audio.",
+    (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10),
+)
+TRANSITION_GAP_SECONDS = Histogram(
+    "musicbot_transition_gap_seconds", "Silencio entre el fin de una canción y el primer paquete de la siguiente.",
+    (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10),
+)
+SPOTIFY_MATCH_CONFIDENCE = Histogram(
+    "musicbot_spotify_match_confidence", "Puntuación del vídeo elegido para cada pista de Spotify (0-1).",
+    (0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1),
+)
+LOOP_LAG_SECONDS = Histogram(
+    "musicbot_event_loop_lag_seconds", "Retraso del event loop respecto a un temporizador de 0.5 s.",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+async def monitor_loop_lag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - interval))
+
+# =========================
+# UTILIDADES
+# =========================
+# Opciones de yt-dlp para resolver pistas y URLs de stream
+YDL_OPTIONS = {
+    "format": "bestaudio[abr<=96]/bestaudio",
+    "noplaylist": True,
+    "cookiefile": "cookies.txt",
+}
+# Búsquedas planas: sólo título, canal, duración e ID de cada resultado, sin resolver formatos
+YDL_FLAT_OPTIONS = {
+    "extract_flat": "in_playlist",
+    "skip_download": True,
+    "cookiefile": "cookies.txt",
+}
+
+class ExtractionEngine:
+    """
+    Ejecuta las extracciones de yt-dlp en un pool de procesos propio (ytdl_worker), donde cada
+    proceso reutiliza sus instancias de YoutubeDL por juego de opciones. Así el parseo pesado
+    no compite por el GIL con los hilos de audio. Guarda latencias y profundidad de cola.
+    """
+
+    def __init__(self, workers: int, history: int = 1000):
+        self.workers = max(1, workers)
+        self._pool: ProcessPoolExecutor | None = None
+        self.pending = 0          # llamadas enviadas al pool y aún sin terminar
+        self.calls = 0
+        self.errors = 0
+        self.latencies: deque[float] = deque(maxlen=history)   # espera en cola + trabajo
+        self.work_times: deque[float] = deque(maxlen=history)  # sólo trabajo dentro del proceso
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: no heredar hilos (voz, event loop) del proceso del bot
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def start(self):
+        """Arranca los procesos por adelantado para que la primera búsqueda no pague el arranque."""
+        pool = self._get_pool()
+        for _ in range(self.workers):
+            pool.submit(ytdl_worker.warmup)
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.pending - self.workers)
+
+    async def extract(self, query: str, ydl_opts: dict, overrides: dict | None = None):
+        opts_key = json.dumps(ydl_opts, sort_keys=True)
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        self.calls += 1
+        start = time.perf_counter()
+        try:
+            info, work = await loop.run_in_executor(self._get_pool(), ytdl_worker.extract, query, opts_key, overrides)
+        except BrokenProcessPool:
+            # Un proceso murió (OOM, señal...): descartar el pool; el siguiente uso crea otro
+            self.errors += 1
+            self._pool = None
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.latencies.append(time.perf_counter() - start)
+        self.work_times.append(work)
+        return info
+
+    def stats(self) -> dict:
+        def pct(values, q):
+            if not values:
+                return 0.0
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+        return {
+            "workers": self.workers,
+            "calls": self.calls,
+            "errors": self.errors,
+            "pending": self.pending,
+            "queue_depth": self.queue_depth,
+            "latency_p50": pct(self.latencies, 0.5),
+            "latency_p95": pct(self.latencies, 0.95),
+            "work_p50": pct(self.work_times, 0.5),
+            "work_p95": pct(self.work_times, 0.95),
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+EXTRACTOR = ExtractionEngine(YTDLP_WORKERS)
+
+# Prioridades de las extracciones: comandos que alguien espera, trabajo de fondo e importaciones
+PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, PRIORITY_BULK = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "background", "bulk")
+
+@dataclass(frozen=True)
+class ExtractionJob:
+    """Quién pide una extracción y con qué urgencia (ver ExtractionScheduler)."""
+    priority: int = PRIORITY_BACKGROUND
+    guild_id: str | None = None
+    user_id: int | None = None
+    deadline: float | None = None   # time.monotonic() límite para tener respuesta; None: sin límite
+
+BACKGROUND_JOB = ExtractionJob()
+
+def interactive_job(interaction: discord.Interaction) -> ExtractionJob:
+    deadline = time.monotonic() + EXTRACTION_INTERACTIVE_DEADLINE if EXTRACTION_INTERACTIVE_DEADLINE > 0 else None
+    return ExtractionJob(PRIORITY_INTERACTIVE, str(interaction.guild_id), interaction.user.id, deadline)
+
+class ExtractionRejected(Exception):
+    """Extracción no admitida: el usuario va demasiado rápido o no empezaría dentro de su plazo."""
+
+    def __init__(self, message: str, reason: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+@dataclass(eq=False)
+class _Waiter:
+    job: ExtractionJob
+    priority: int      # la del job, o la de alguien más urgente que se unió a la misma extracción
+    seq: int
+    future: asyncio.Future
+    enqueued: float
+
+class ExtractionScheduler:
+    """
+    Admisión y reparto del pool de yt-dlp entre servidores.
+
+    - Como mucho `max_active` extracciones en el pool (por defecto, una por proceso) y
+      `guild_limit` por servidor; el resto espera aquí y no en la cola FIFO del ProcessPoolExecutor.
+    - Al quedar un hueco entra la de mayor prioridad y, a igual prioridad, la del servidor con
+      menos extracciones en marcha: una playlist enorme no deja sin turno a los /play de otros.
+    - Cada comando de un usuario gasta una ficha de su cubo (user_rate por minuto, ráfaga user_burst).
+    - Un comando con plazo se rechaza en cuanto se ve que no tendrá respuesta a tiempo, con un
+      mensaje, en vez de dejar la interacción diferida esperando sin respuesta.
+
+    Fichas y plazos son de cada llamante (admit, within), nunca de la extracción compartida:
+    las que se agrupan en SingleFlight no fallan para todos porque uno vaya rápido o tenga prisa.
+    """
+
+    def __init__(self, max_active: int | None = None, guild_limit: int | None = None,
+                 user_rate: float = 30, user_burst: int = 8):
+        self.max_active = max_active
+        self.guild_limit = guild_limit
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.active = 0
+        self.active_by_guild: dict[str, int] = {}
+        self.admitted = [0] * len(PRIORITY_NAMES)
+        self.rejected = {"rate": 0, "deadline": 0}
+        self.waits = [deque(maxlen=500) for _ in PRIORITY_NAMES]   # segundos en espera hasta entrar
+        self._waiting: list[_Waiter] = []
+        self._queued: dict = {}      # clave de la extracción → su _Waiter mientras espera turno
+        self._seq = 0
+        self._buckets: dict[int, tuple[float, float]] = {}         # usuario → (fichas, última recarga)
+
+    @property
+    def limit(self) -> int:
+        return self.max_active or EXTRACTOR.workers
+
+    def waiting(self, priority: int) -> int:
+        return sum(1 for w in self._waiting if w.priority == priority)
+
+    def admit(self, job: ExtractionJob):
+        """
+        Admisión de un comando, una vez por comando y antes de unirse a ninguna extracción:
+        lo rechaza si la cola ya no le deja responder a tiempo y, si se acepta, gasta una ficha
+        del usuario (un rechazo no le cuesta nada).
+        """
+        if job.deadline is not None and time.monotonic() + self._estimated_wait(job.priority) > job.deadline:
+            self._reject("deadline")
+        if job.user_id is not None:
+            self._take_token(job.user_id)
+
+    async def within(self, job: ExtractionJob, awaitable):
+        """
+        Espera `awaitable` hasta el plazo de `job`. Al vencer sólo se rechaza a este llamante:
+        el trabajo sigue para quien lo comparta y su resultado queda en las cachés.
+        """
+        if job.deadline is None:
+            return await awaitable
+        # Si se abandona sigue en BACKGROUND_TASKS hasta acabar, y nadie lee su resultado o su error
+        task = run_in_background(awaitable)
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), max(0.0, job.deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self._reject("deadline")
+
+    def promote(self, key, job: ExtractionJob | None):
+        """Alguien con `job` se une a la extracción `key`: si aún espera turno, sube a su prioridad."""
+        waiter = self._queued.get(key)
+        if waiter is not None and job is not None and job.priority < waiter.priority:
+            waiter.priority = job.priority
+
+    async def run(self, job: ExtractionJob | None, factory, key=None):
+        """
+        Espera turno según `job` y devuelve el resultado de `factory()` (corrutina). Sin plazo ni
+        fichas: es el trabajo compartido. Con `key`, promote() puede subirle la prioridad mientras espera.
+        """
+        job = job or BACKGROUND_JOB
+        waiter = _Waiter(job, job.priority, self._seq, asyncio.get_running_loop().create_future(), time.monotonic())
+        self._seq += 1
+        self._waiting.append(waiter)
+        if key is not None:
+            self._queued[key] = waiter
+        try:
+            self._dispatch()
+            if not waiter.future.done():
+                try:
+                    await asyncio.shield(waiter.future)
+                except asyncio.CancelledError:
+                    if waiter.future.done():
+                        self._release(job)   # el turno llegó a la vez que la cancelación: devolverlo
+                    else:
+                        self._waiting.remove(waiter)
+                    raise
+        finally:
+            if key is not None and self._queued.get(key) is waiter:
+                del self._queued[key]
+        self.admitted[waiter.priority] += 1
+        self.waits[waiter.priority].append(time.monotonic() - waiter.enqueued)
+        try:
+            return await factory()
+        finally:
+            self._release(job)
+
+    def _dispatch(self):
+        while self._waiting and self.active < self.limit:
+            best, best_rank = None, None
+            for waiter in self._waiting:
+                running = self.active_by_guild.get(waiter.job.guild_id, 0)
+                if waiter.job.guild_id is not None and self.guild_limit and running >= self.guild_limit:
+                    continue
+                rank = (waiter.priority, running, waiter.seq)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = waiter, rank
+            if best is None:
+                return
+            self._waiting.remove(best)
+            self.active += 1
+            if best.job.guild_id is not None:
+                self.active_by_guild[best.job.guild_id] = self.active_by_guild.get(best.job.guild_id, 0) + 1
+            best.future.set_result(None)
+
+    def _release(self, job: ExtractionJob):
+        self.active -= 1
+        if job.guild_id is not None:
+            left = self.active_by_guild.get(job.guild_id, 1) - 1
+            if left:
+                self.active_by_guild[job.guild_id] = left
+            else:
+                self.active_by_guild.pop(job.guild_id, None)
+        self._dispatch()
+
+    def _estimated_wait(self, priority: int) -> float:
+        """Segundos hasta tener una extracción nueva de `priority`: lo que tiene delante más la suya."""
+        work = EXTRACTOR.work_times
+        if not work:
+            return 0.0   # sin medidas todavía: que decida el plazo
+        ahead = sum(1 for w in self._waiting if w.priority <= priority)
+        per_job = sum(work) / len(work)
+        return (ahead / self.limit + 1) * per_job
+
+    def _take_token(self, user_id: int):
+        if self.user_rate <= 0:
+            return
+        now = time.monotonic()
+        tokens, last = self._buckets.get(user_id, (float(self.user_burst), now))
+        tokens = min(float(self.user_burst), tokens + (now - last) * self.user_rate / 60)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            self._reject("rate", (1 - tokens) * 60 / self.user_rate)
+        self._buckets[user_id] = (tokens - 1, now)
+        if len(self._buckets) > 10000:
+            # Quien ya tendría el cubo lleno no necesita entrada
+            full = 60 * self.user_burst / self.user_rate
+            self._buckets = {u: b for u, b in self._buckets.items() if now - b[1] < full}
+
+    def _reject(self, reason: str, retry_after: float | None = None):
+        self.rejected[reason] += 1
+        if reason == "rate":
+            raise ExtractionRejected(f"Vas muy rápido: espera {math.ceil(retry_after)} s antes de pedir otra canción.",
+                                     reason, retry_after)
+        raise ExtractionRejected("El bot está saturado ahora mismo: prueba de nuevo en unos segundos.", reason)
+
+    def stats(self) -> dict:
+        def pct(values, q):
+            if not values:
+                return 0.0
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+        per_guild: dict[str, list[int]] = {g: [n, 0] for g, n in self.active_by_guild.items()}
+        for waiter in self._waiting:
+            if waiter.job.guild_id is not None:
+                per_guild.setdefault(waiter.job.guild_id, [0, 0])[1] += 1
+        busiest = sorted(per_guild.items(), key=lambda kv: -(kv[1][0] + kv[1][1]))[:5]
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "guild_limit": self.guild_limit,
+            "waiting": {name: self.waiting(p) for p, name in enumerate(PRIORITY_NAMES)},
+            "admitted": dict(zip(PRIORITY_NAMES, self.admitted)),
+            "rejected": dict(self.rejected),
+            "wait_p50": {name: pct(self.waits[p], 0.5) for p, name in enumerate(PRIORITY_NAMES)},
+            "wait_p95": {name: pct(self.waits[p], 0.95) for p, name in enumerate(PRIORITY_NAMES)},
+            "guilds": [(guild_id, active, waiting) for guild_id, (active, waiting) in busiest],
+        }
+
+class SingleFlight:
+    """
+    Agrupa las llamadas concurrentes con la misma clave en una única tarea compartida.
+    Un error llega a todos los que esperaban esa clave y no se recuerda (la siguiente llamada
+    reintenta); si uno de los que esperan se cancela, la tarea sigue para el resto.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0   # llamadas que se unieron a una tarea ya en vuelo
+        self._tasks: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def __contains__(self, key) -> bool:
+        return key in self._tasks
+
+    async def run(self, key, factory):
+        """Devuelve el resultado de `factory()` (corrutina sin argumentos) para `key`."""
+        self.calls += 1
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.create_task(factory())
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Si todos los que esperaban se cancelaron, nadie lee el error: marcarlo como visto
+        if not task.cancelled():
+            task.exception()
+
+# Extracciones idénticas (misma consulta y opciones) en vuelo, y búsquedas en Spotify por ID
+EXTRACTIONS = SingleFlight()
+SPOTIFY_LOOKUPS = SingleFlight()
+
+EXTRACTION_SCHEDULER = ExtractionScheduler(EXTRACTION_MAX_ACTIVE, EXTRACTION_GUILD_LIMIT,
+                                           EXTRACTION_USER_RATE, EXTRACTION_USER_BURST)
+
+async def search_ytdlp_async(query, ydl_opts, overrides: dict | None = None, job: ExtractionJob | None = None):
+    key = (query, json.dumps(ydl_opts, sort_keys=True), json.dumps(overrides, sort_keys=True))
+
+    async def extract():
+        start = time.perf_counter()
+        try:
+            return await EXTRACTION_SCHEDULER.run(job, lambda: EXTRACTOR.extract(query, ydl_opts, overrides), key)
+        finally:
+            EXTRACTION_SECONDS.observe(time.perf_counter() - start)
+
+    # Quien se une a una extracción en vuelo recibe el mismo dict: tratarlo como de sólo lectura.
+    # Si la lanzó una importación y se une un comando, pasa a esperar turno con la prioridad del comando
+    if key in EXTRACTIONS:
+        EXTRACTION_SCHEDULER.promote(key, job)
+    return await EXTRACTIONS.run(key, extract)
+
+# Tareas lanzadas sin esperarlas: el event loop sólo guarda una referencia débil a cada una, así
+# que se guardan aquí hasta que terminan para que el recolector no las elimine a medias
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# Sesión HTTP compartida por las APIs externas (conexiones keep-alive reutilizadas)
+HTTP_SESSION: aiohttp.ClientSession | None = None
+
+def http_session() -> aiohttp.ClientSession:
+    """Devuelve la sesión compartida, creándola en el primer uso (tiene que ser dentro del event loop)."""
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        HTTP_SESSION = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10),
+            connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+        )
+    return HTTP_SESSION
+
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is not None:
+        await HTTP_SESSION.close()
+        HTTP_SESSION = None
+
+def format_duration(seconds: int | float | None) -> str:
+    if seconds is None:
+        return "Desconocido"
+    try:
+        seconds = int(seconds)
+        return str(timedelta(seconds=seconds))
+    except Exception:
+        return "Desconocido"
+
+def make_queue_item(from_info: dict) -> "Track":
+    """
+    Convierte la info cruda de yt_dlp en un objeto estándar para la cola.
+    No guarda la URL directa del audio (caduca en unas horas): ver resolve_stream_url.
+    """
+    return Track(
+        id=from_info.get("id"),
+        title=from_info.get("title") or "Sin título",
+        webpage_url=from_info.get("webpage_url", from_info.get("original_url", from_info.get("url", ""))),
+        duration=from_info.get("duration"),
+        thumbnail=from_info.get("thumbnail") or "",
+        artist=from_info.get("uploader") or from_info.get("artist") or from_info.get("channel") or "Desconocido",
+    )
+
+def first_entry(results: dict | None) -> dict | None:
+    """Devuelve el primer resultado de una extracción (búsqueda o URL directa)."""
+    if not results:
+        return None
+    if 'entries' in results:
+        entries = [e for e in results['entries'] if e]
+        return entries[0] if entries else None
+    return results
+
+# =========================
+# SPOTIFY
+# =========================
+SPOTIFY_API = "https://api.spotify.com/v1"
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_URL_RE = re.compile(r"open\.spotify\.com/(?:intl-[a-z]+/)?(track|playlist|album|artist)/([A-Za-z0-9]+)")
+# Lo único que el bot usa de cada pista: búsqueda en YouTube (nombre + artista) y duración
+SPOTIFY_TRACK_FIELDS = "id,name,duration_ms,artists(name)"
+
+class SpotifyError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+class SpotifyClient:
+    """
+    Cliente asíncrono de la Web API de Spotify (client credentials) sobre la sesión HTTP compartida.
+    Cachea el token hasta poco antes de que caduque, agrupa las consultas de pistas sueltas en
+    llamadas a /tracks de hasta 50 IDs y, sabido el total de un listado, pide el resto de páginas a la vez.
+    """
+
+    BATCH = 50
+    BATCH_WINDOW = 0.02   # segundos que espera una consulta suelta a que se le unan otras
+
+    def __init__(self, client_id: str | None, client_secret: str | None, market: str, page_concurrency: int = 4):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.market = market
+        self.page_concurrency = page_concurrency
+        self.requests = 0
+        self._token: str | None = None
+        self._token_expires = 0.0
+        self._token_lock = asyncio.Lock()
+        self._batch: dict[str, list[asyncio.Future]] = {}
+        self._batch_timer: asyncio.TimerHandle | None = None
+        self._batch_tasks: set[asyncio.Task] = set()
+
+    async def _access_token(self) -> str:
+        if self._token and time.time() < self._token_expires - 60:
+            return self._token
+        async with self._token_lock:
+            if self._token and time.time() < self._token_expires - 60:
+                return self._token
+            if not self.client_id or not self.client_secret:
+                raise SpotifyError("Faltan SPOTIPY_CLIENT_ID / SPOTIPY_CLIENT_SECRET")
+            auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+            async with http_session().post(SPOTIFY_TOKEN_URL, data={"grant_type": "client_credentials"}, auth=auth) as resp:
+                data = await resp.json(content_type=None)
+                if resp.status != 200:
+                    raise SpotifyError(f"Autenticación rechazada: {data.get('error_description') or resp.status}", resp.status)
+            self._token = data["access_token"]
+            self._token_expires = time.time() + data.get("expires_in", 3600)
+            return self._token
+
+    async def get(self, path: str, params: dict | None = None) -> dict:
+        """GET autenticado a la Web API. Reintenta los 429 (respetando Retry-After), los 5xx y un token caducado."""
+        error = None
+        refreshed = False
+        for attempt in range(4):
+            token = await self._access_token()
+            self.requests += 1
+            headers = {"Authorization": f"Bearer {token}"}
+            async with http_session().get(f"{SPOTIFY_API}/{path}", params=params, headers=headers) as resp:
+                if resp.status == 401 and not refreshed:
+                    # Token revocado o caducado antes de tiempo: pedir otro una vez
+                    self._token, refreshed = None, True
+                    continue
+                if resp.status == 429 or resp.status >= 500:
+                    error = SpotifyError(f"Spotify respondió HTTP {resp.status}", resp.status)
+                    delay = float(resp.headers.get("Retry-After", 2 ** attempt))
+                else:
+                    data = await resp.json(content_type=None)
+                    if resp.status != 200:
+                        message = (data.get("error") or {}).get("message") if isinstance(data, dict) else None
+                        raise SpotifyError(message or f"Spotify respondió HTTP {resp.status}", resp.status)
+                    return data
+            await asyncio.sleep(min(delay, 30))
+        raise error
+
+    async def tracks(self, track_ids: list[str]) -> list[dict | None]:
+        """Pistas por ID, en el mismo orden (None si no existe), en llamadas de BATCH IDs en paralelo."""
+        chunks = [track_ids[i:i + self.BATCH] for i in range(0, len(track_ids), self.BATCH)]
+        pages = await asyncio.gather(*(
+            self.get("tracks", {"ids": ",".join(chunk), "market": self.market}) for chunk in chunks
+        ))
+        return [track for page in pages for track in page["tracks"]]
+
+    async def track(self, track_id: str) -> dict:
+        """Una pista; las consultas sueltas que coinciden en el tiempo van juntas en una sola llamada."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.setdefault(track_id, []).append(future)
+        if len(self._batch) >= self.BATCH:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = loop.call_later(self.BATCH_WINDOW, self._flush_batch)
+        return await future
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch = self._batch, {}
+        if batch:
+            task = asyncio.create_task(self._deliver(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _deliver(self, batch: dict[str, list[asyncio.Future]]):
+        try:
+            found = await self.tracks(list(batch))
+        except Exception as e:
+            found, error = [None] * len(batch), e
+        else:
+            error = SpotifyError("Canción no encontrada en Spotify", 404)
+        for track, futures in zip(found, batch.values()):
+            for future in futures:
+                if future.done():
+                    continue  # quien esperaba se canceló
+                if track is None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(track)
+
+    async def _paged(self, path: str, params: dict, limit: int) -> list[dict]:
+        """Todos los items de un listado paginado: la primera página da el total y el resto se pide a la vez."""
+        first = await self.get(path, {**params, "limit": limit, "offset": 0})
+        semaphore = asyncio.Semaphore(self.page_concurrency)
+
+        async def page(offset: int) -> list[dict]:
+            async with semaphore:
+                return (await self.get(path, {**params, "limit": limit, "offset": offset}))["items"]
+
+        rest = await asyncio.gather(*(page(offset) for offset in range(limit, first.get("total") or 0, limit)))
+        return [item for items in (first["items"], *rest) for item in items]
+
+    async def playlist_tracks(self, playlist_id: str) -> list[dict]:
+        items = await self._paged(
+            f"playlists/{playlist_id}/tracks",
+            {"fields": f"total,items(track({SPOTIFY_TRACK_FIELDS}))", "additional_types": "track", "market": self.market},
+            100,
+        )
+        return [item.get("track") for item in items]
+
+    async def album_tracks(self, album_id: str) -> list[dict]:
+        return await self._paged(f"albums/{album_id}/tracks", {"market": self.market}, 50)
+
+    async def artist_top_tracks(self, artist_id: str) -> list[dict]:
+        return (await self.get(f"artists/{artist_id}/top-tracks", {"market": self.market}))["tracks"]
+
+SPOTIFY = SpotifyClient(
+    os.getenv("SPOTIPY_CLIENT_ID") or SPOTIFY_CLIENT_ID,
+    os.getenv("SPOTIPY_CLIENT_SECRET") or SPOTIFY_CLIENT_SECRET,
+    SPOTIFY_MARKET,
+)
+
+# =========================
+# PISTAS Y COLA
+# =========================
+@dataclass(frozen=True, slots=True)
+class Track:
+    """Pista de la cola: inmutable y con __slots__; el artista se interna porque se repite mucho."""
+    id: str | None
+    title: str
+    webpage_url: str
+    duration: int | None
+    thumbnail: str
+    artist: str
+
+    def __post_init__(self):
+        object.__setattr__(self, "artist", sys.intern(self.artist))
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "title": self.title,
+            "webpage_url": self.webpage_url,
+            "duration": self.duration,
+            "thumbnail": self.thumbnail,
+            "artist": self.artist,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Track":
+        return cls(
+            id=data.get("id"),
+            title=data.get("title") or "Sin título",
+            webpage_url=data.get("webpage_url") or "",
+            duration=data.get("duration"),
+            thumbnail=data.get("thumbnail") or "",
+            artist=data.get("artist") or "Desconocido",
+        )
+
+class TrackQueue:
+    """
+    Cola de pistas con manejadores estables (int) por entrada.
+
+    - Quitar por manejador es O(1): se borra del dict y su hueco en el orden queda como lápida,
+      que se compacta de forma perezosa (amortizado) cuando las lápidas son la mitad del orden.
+      Las consultas por posición saltan lápidas en vez de compactar.
+    - popleft / rotate son O(1) amortizado avanzando un índice de cabeza.
+    - Insertar o mover en una posición es un memmove de la lista de manejadores (sin tocar pistas).
+    - Barajar se hace en sitio sobre la lista de manejadores, sin copiar la cola.
+    """
+
+    __slots__ = ("_order", "_tracks", "_head", "_dead", "_next_handle")
+
+    def __init__(self, tracks=()):
+        self._order: list[int] = []           # manejadores en orden (puede haber lápidas)
+        self._tracks: dict[int, Track] = {}   # manejador → pista (sólo las vivas)
+        self._head = 0                        # primer índice de _order aún en la cola
+        self._dead = 0                        # lápidas en _order[_head:]
+        self._next_handle = 0
+        for track in tracks:
+            self.append(track)
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    def __bool__(self) -> bool:
+        return bool(self._tracks)
+
+    def __iter__(self):
+        tracks = self._tracks
+        for handle in islice(self._order, self._head, None):
+            track = tracks.get(handle)
+            if track is not None:
+                yield track
+
+    def __getitem__(self, index: int) -> Track:
+        return self._tracks[self.handle_at(index)]
+
+    def handles(self):
+        return (h for h in islice(self._order, self._head, None) if h in self._tracks)
+
+    def get(self, handle: int) -> Track | None:
+        return self._tracks.get(handle)
+
+    def _new_handle(self, track: Track) -> int:
+        handle = self._next_handle
+        self._next_handle += 1
+        self._tracks[handle] = track
+        return handle
+
+    def _compact(self):
+        """Elimina lápidas y el prefijo ya consumido; O(n), sólo cuando hace falta."""
+        if self._dead:
+            tracks = self._tracks
+            self._order = [h for h in islice(self._order, self._head, None) if h in tracks]
+        elif self._head:
+            del self._order[:self._head]
+        self._head = 0
+        self._dead = 0
+
+    def _skip_dead_head(self):
+        order, tracks = self._order, self._tracks
+        while self._head < len(order) and order[self._head] not in tracks:
+            self._head += 1
+            self._dead -= 1
+        # Evitar que el prefijo consumido crezca sin límite
+        if self._head > 64 and self._head * 2 > len(order):
+            self._compact()
+
+    def append(self, track: Track) -> int:
+        handle = self._new_handle(track)
+        self._order.append(handle)
+        return handle
+
+    def _physical(self, index: int) -> int:
+        """Índice en _order de la entrada viva número `index` (el final si no hay tantas), saltando lápidas."""
+        order = self._order
+        if not self._dead:
+            return min(self._head + index, len(order))
+        tracks = self._tracks
+        i = self._head
+        while i < len(order):
+            if order[i] in tracks:
+                if index == 0:
+                    return i
+                index -= 1
+            i += 1
+        return i
+
+    def insert(self, position: int, track: Track) -> int:
+        """Inserta en la posición (0 = cabeza) y devuelve el manejador."""
+        at = self._physical(max(0, position))
+        handle = self._new_handle(track)
+        self._order.insert(at, handle)
+        return handle
+
+    def head_handle(self) -> int | None:
+        self._skip_dead_head()
+        return self._order[self._head] if self._head < len(self._order) else None
+
+    def handle_at(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("posición fuera de la cola")
+        # La cabeza y la siguiente (lo que piden el reproductor y la precarga) salen sin recorrer nada
+        self._skip_dead_head()
+        return self._order[self._physical(index)]
+
+    def index_of(self, handle: int) -> int:
+        order, tracks = self._order, self._tracks
+        if handle in tracks:
+            if not self._dead:
+                return order.index(handle, self._head) - self._head
+            live = 0
+            for h in islice(order, self._head, None):
+                if h == handle:
+                    return live
+                if h in tracks:
+                    live += 1
+        raise ValueError(f"manejador {handle} fuera de la cola")
+
+    def popleft(self) -> Track:
+        handle = self.head_handle()
+        if handle is None:
+            raise IndexError("popleft de una cola vacía")
+        self._head += 1
+        return self._tracks.pop(handle)
+
+    def remove(self, handle: int) -> Track | None:
+        """Quita la entrada del manejador en O(1). Devuelve la pista o None si ya no estaba."""
+        track = self._tracks.pop(handle, None)
+        if track is not None:
+            self._dead += 1
+            if self._dead > 64 and self._dead * 2 > len(self._order) - self._head:
+                self._compact()
+        return track
+
+    def move(self, handle: int, position: int):
+        """Mueve la entrada a la posición indicada (0 = cabeza)."""
+        # Desde la cabeza: rotate deja copias del manejador en el prefijo ya consumido
+        del self._order[self._order.index(handle, self._head)]
+        self._order.insert(self._physical(max(0, position)), handle)
+
+    def rotate(self):
+        """Manda la cabeza al final (loop all)."""
+        handle = self.head_handle()
+        if handle is not None:
+            self._head += 1
+            self._order.append(handle)
+
+    def shuffle(self, keep_head: bool = False, rng: random.Random | None = None):
+        """Baraja en sitio (Fisher-Yates sobre los manejadores). keep_head deja la cabeza donde está."""
+        self._compact()
+        order = self._order
+        rand = (rng or random).random
+        start = 1 if keep_head else 0
+        for i in range(len(order) - 1, start, -1):
+            j = start + int(rand() * (i - start + 1))
+            order[i], order[j] = order[j], order[i]
+
+    def clear(self):
+        self._order.clear()
+        self._tracks.clear()
+        self._head = 0
+        self._dead = 0
+
+# =========================
+# CACHÉ DE RESOLUCIÓN
+# =========================
+YOUTUBE_ID_RE = re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})")
+STREAM_EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+def query_cache_key(query: str) -> str:
+    """Clave de caché para lo que escribe el usuario: ID de vídeo si es un enlace de YouTube, si no el texto normalizado."""
+    match = YOUTUBE_ID_RE.search(query)
+    if match:
+        return f"yt:{match.group(1)}"
+    if query.startswith("http"):
+        return f"url:{query.strip()}"
+    return f"q:{normalize_query(query)}"
+
+class ResolutionCache:
+    """
+    Caché SQLite clave → pista ya resuelta (ID de vídeo + metadata de make_queue_item).
+    Las claves son búsquedas normalizadas (q:), IDs de Spotify (sp:) e IDs de YouTube (yt:).
+    Las entradas caducan a los `ttl` segundos y, al pasar de `max_entries`, se expulsan
+    las menos usadas recientemente. Las pistas de Spotify guardan la confianza del emparejado.
+    Aparte, la tabla `loudness` guarda la sonoridad medida de cada pista (por webpage_url).
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._db: sqlite3.Connection | None = None
+        self._count = 0
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # La base se abre al primer uso: los procesos de extracción importan el módulo y no la tocan
+        with self._lock:
+            if self._db is None:
+                self._db = self._open()
+            return self._db
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(ensure_parent_dir(self.path), check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS resolutions ("
+            " key TEXT PRIMARY KEY, video_id TEXT, data TEXT NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS resolutions_last_used ON resolutions(last_used)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS loudness (url TEXT PRIMARY KEY, lufs REAL NOT NULL, analyzed REAL NOT NULL)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(resolutions)")}
+        if "confidence" not in columns:
+            # Cachés creadas antes de puntuar los emparejados Spotify → YouTube
+            conn.execute("ALTER TABLE resolutions ADD COLUMN confidence REAL")
+        self._count = conn.execute("SELECT COUNT(*) FROM resolutions").fetchone()[0]
+        return conn
+
+    def get(self, *keys: str) -> "Track | None":
+        """Busca la primera clave presente y vigente. Cuenta un acierto o un fallo por llamada."""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute("SELECT data, created FROM resolutions WHERE key = ?", (key,)).fetchone()
+                if not row:
+                    continue
+                data, created = row
+                if now - created > self.ttl:
+                    self._conn.execute("DELETE FROM resolutions WHERE key = ?", (key,))
+                    self._count -= 1
+                    continue
+                self._conn.execute("UPDATE resolutions SET last_used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return Track.from_dict(json.loads(data))
+            self.misses += 1
+            return None
+
+    def put(self, keys, item: "Track", confidence: float | None = None):
+        now = time.time()
+        data = json.dumps(item.to_dict(), ensure_ascii=False)
+        with self._lock:
+            for key in keys:
+                cur = self._conn.execute(
+                    "INSERT OR REPLACE INTO resolutions (key, video_id, data, created, last_used, confidence)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, item.id, data, now, now, confidence),
+                )
+                # INSERT OR REPLACE no distingue altas de reemplazos; _evict recalcula la cuenta real
+                self._count += cur.rowcount
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Limpiar lo caducado y, si aún sobra, expulsar hasta el 90% del límite empezando por lo menos usado
+        self._conn.execute("DELETE FROM resolutions WHERE created < ?", (time.time() - self.ttl,))
+        self._count = self._conn.execute("SELECT COUNT(*) FROM resolutions").fetchone()[0]
+        if self._count <= self.max_entries:
+            return
+        excess = self._count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM resolutions WHERE key IN (SELECT key FROM resolutions ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._count -= excess
+
+    def recent_tracks(self, limit: int) -> list["Track"]:
+        """Pistas distintas usadas más recientemente (para sembrar las sugerencias de /play)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM resolutions WHERE created >= ?"
+                " GROUP BY COALESCE(video_id, key) ORDER BY MAX(last_used) DESC LIMIT ?",
+                (time.time() - self.ttl, limit),
+            ).fetchall()
+        return [Track.from_dict(json.loads(data)) for (data,) in rows]
+
+    def loudness(self, url: str) -> float | None:
+        """Sonoridad integrada (LUFS) medida para la pista de `url`, si ya se analizó."""
+        with self._lock:
+            row = self._conn.execute("SELECT lufs FROM loudness WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def put_loudness(self, url: str, lufs: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO loudness (url, lufs, analyzed) VALUES (?, ?, ?)", (url, lufs, time.time())
+            )
+
+    def confidence(self, key: str) -> float | None:
+        """Confianza guardada para `key` (None si no existe o no es un emparejado puntuado)."""
+        with self._lock:
+            row = self._conn.execute("SELECT confidence FROM resolutions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def open(self):
+        """Abre la base si aún no se abrió; al arrancar se llama en un hilo (open_caches)."""
+        self._conn
+
+    def stats(self) -> dict:
+        # Sólo contadores en memoria (entries es 0 hasta abrir): /metrics no toca la base
+        total = self.hits + self.misses
+        return {
+            "entries": self._count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+RESOLUTION_CACHE = ResolutionCache(RESOLUTION_CACHE_PATH, RESOLUTION_CACHE_TTL, RESOLUTION_CACHE_MAX_ENTRIES)
+RESOLUTIONS = SingleFlight()
+
+async def resolve_item(keys: list[str], ydl_opts: dict, search_q, job: ExtractionJob | None = None) -> Track | None:
+    """
+    Resuelve una pista a un item de cola pasando por RESOLUTION_CACHE.
+    `search_q` es la búsqueda/URL para yt-dlp, o una corrutina sin argumentos que la calcula
+    (así una consulta a Spotify sólo se hace si hay fallo de caché); la corrutina puede
+    devolver (URL, confianza) si eligió el vídeo puntuando candidatos (match_spotify_track).
+    Los items no llevan URL de stream: se resuelve justo antes de reproducir (resolve_stream_url).
+    """
+    cached = RESOLUTION_CACHE.get(*keys)
+    if cached:
+        SUGGESTIONS.add_track(cached)
+        return cached
+
+    async def resolve():
+        target = search_q if isinstance(search_q, str) else await search_q()
+        confidence = None
+        if isinstance(target, tuple):
+            target, confidence = target
+        if not target:
+            return None
+        info = first_entry(await search_ytdlp_async(target, ydl_opts, job=job))
+        if not info:
+            return None
+        item = make_queue_item(info)
+        # La extracción ya trae una URL de stream válida: aprovecharla para la primera reproducción
+        remember_stream_url(item, info)
+        all_keys = list(keys)
+        if item.id and info.get("extractor_key", "Youtube") == "Youtube":
+            all_keys.append(f"yt:{item.id}")
+        RESOLUTION_CACHE.put(all_keys, item, confidence)
+        SUGGESTIONS.add_track(item)
+        return item
+
+    # La misma pista pedida a la vez desde varios servidores se resuelve una sola vez
+    # (incluida la consulta a Spotify de `search_q`)
+    return await RESOLUTIONS.run(tuple(keys), resolve)
+
+def spotify_query(track: dict) -> str:
+    return f"{track['name']} {track['artists'][0]['name']}"
+
+# =========================
+# HISTORIAL DE REPRODUCCIÓN
+# =========================
+HISTORY_WORD_RE = re.compile(r"\w+")
+
+def history_words(text: str) -> list[str]:
+    return HISTORY_WORD_RE.findall(text.lower())
+
+class PlayHistory:
+    """
+    Historial SQLite de lo que ha sonado en cada servidor.
+
+    - `tracks`: veces que sonó cada pista (por webpage_url) y cuándo por última vez.
+    - `words`: cada palabra de título y artista; buscar por prefijo es un rango del índice
+      (word >= 'pre' AND word < 'pre\uffff') en vez de recorrer el historial.
+    - `next_plays`: cuántas veces sonó una pista justo después de otra. Los vecinos para el
+      autoplay se leen de la clave primaria (servidor, anterior, siguiente) ya contados.
+    - `queries`: la búsqueda de /play (normalizada) que llevó a cada pista. Sólo repetir esa
+      misma búsqueda se resuelve desde el historial; una parecida se busca de nuevo.
+
+    Al pasar de `max_tracks` pistas en un servidor se olvidan las que llevan más tiempo sin sonar.
+    """
+
+    def __init__(self, path: str, max_tracks: int):
+        self.path = path
+        self.max_tracks = max_tracks
+        self.recorded = 0
+        self.replays = 0       # /play resueltos desde el historial, sin extracción
+        self.picks = 0         # pistas elegidas por el autoplay
+        self._sizes: dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._db: sqlite3.Connection | None = None
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        # Como en ResolutionCache: se abre al primer uso, nunca al importar el módulo
+        with self._lock:
+            if self._db is None:
+                self._db = self._open()
+            return self._db
+
+    def open(self):
+        self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(ensure_parent_dir(self.path), check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            " guild TEXT NOT NULL, url TEXT NOT NULL, data TEXT NOT NULL, plays INTEGER NOT NULL,"
+            " last_played REAL NOT NULL, PRIMARY KEY (guild, url)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS tracks_last_played ON tracks(guild, last_played)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS words ("
+            " guild TEXT NOT NULL, word TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (guild, word, url)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS next_plays ("
+            " guild TEXT NOT NULL, prev TEXT NOT NULL, next TEXT NOT NULL, count INTEGER NOT NULL,"
+            " last REAL NOT NULL, PRIMARY KEY (guild, prev, next)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS queries ("
+            " guild TEXT NOT NULL, query TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (guild, query)) WITHOUT ROWID"
+        )
+        return conn
+
+    def _size(self, guild_id: str) -> int:
+        size = self._sizes.get(guild_id)
+        if size is None:
+            size = self._sizes[guild_id] = self._conn.execute(
+                "SELECT COUNT(*) FROM tracks WHERE guild = ?", (guild_id,)).fetchone()[0]
+        return size
+
+    def record(self, guild_id: str, item: "Track", previous: "Track | None" = None):
+        """Anota que `item` empezó a sonar en el servidor, justo después de `previous`."""
+        if not item.webpage_url:
+            return
+        now = time.time()
+        data = json.dumps(item.to_dict(), ensure_ascii=False)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # Contada antes de insertar: tras un reinicio el servidor ya tiene pistas en la base
+                size = self._size(guild_id)
+                cur = self._conn.execute(
+                    "UPDATE tracks SET plays = plays + 1, last_played = ?, data = ? WHERE guild = ? AND url = ?",
+                    (now, data, guild_id, item.webpage_url),
+                )
+                if not cur.rowcount:
+                    self._conn.execute("INSERT INTO tracks VALUES (?, ?, ?, 1, ?)", (guild_id, item.webpage_url, data, now))
+                    words = set(history_words(f"{item.title} {item.artist}"))
+                    self._conn.executemany("INSERT OR IGNORE INTO words VALUES (?, ?, ?)",
+                                           [(guild_id, word, item.webpage_url) for word in words])
+                    size = self._sizes[guild_id] = size + 1
+                if previous is not None and previous.webpage_url and previous.webpage_url != item.webpage_url:
+                    self._conn.execute(
+                        "INSERT INTO next_plays VALUES (?, ?, ?, 1, ?) ON CONFLICT (guild, prev, next)"
+                        " DO UPDATE SET count = count + 1, last = excluded.last",
+                        (guild_id, previous.webpage_url, item.webpage_url, now),
+                    )
+                if size > self.max_tracks:
+                    self._evict(guild_id)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.recorded += 1
+
+    def _evict(self, guild_id: str):
+        # Quedarse con el 90% del límite, las que sonaron más recientemente
+        self._conn.execute(
+            "DELETE FROM tracks WHERE guild = ? AND url IN (SELECT url FROM tracks WHERE guild = ?"
+            " ORDER BY last_played DESC LIMIT -1 OFFSET ?)",
+            (guild_id, guild_id, int(self.max_tracks * 0.9)),
+        )
+        self._conn.execute("DELETE FROM words WHERE guild = ? AND url NOT IN (SELECT url FROM tracks WHERE guild = ?)",
+                           (guild_id, guild_id))
+        self._conn.execute(
+            "DELETE FROM next_plays WHERE guild = ? AND (prev NOT IN (SELECT url FROM tracks WHERE guild = ?)"
+            " OR next NOT IN (SELECT url FROM tracks WHERE guild = ?))",
+            (guild_id, guild_id, guild_id),
+        )
+        self._conn.execute("DELETE FROM queries WHERE guild = ? AND url NOT IN (SELECT url FROM tracks WHERE guild = ?)",
+                           (guild_id, guild_id))
+        self._sizes.pop(guild_id, None)
+
+    def search(self, guild_id: str, query: str, limit: int = 25) -> list["Track"]:
+        """
+        Pistas del servidor en cuyo título o artista empieza alguna palabra por cada una de
+        `query` (para el autocompletado); primero las que más han sonado.
+        """
+        words = history_words(query)
+        if not words:
+            return []
+        # El rango del índice se recorre con la palabra más larga, la más selectiva
+        key = max(words, key=len)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT t.data, t.plays, t.last_played FROM words w"
+                " JOIN tracks t ON t.guild = w.guild AND t.url = w.url"
+                " WHERE w.guild = ? AND w.word >= ? AND w.word < ? LIMIT 500",
+                (guild_id, key, key + "\uffff"),
+            ).fetchall()
+        matches = []
+        for data, plays, last_played in rows:
+            item = Track.from_dict(json.loads(data))
+            entry_words = history_words(f"{item.title} {item.artist}")
+            if all(any(w.startswith(word) for w in entry_words) for word in words):
+                matches.append((-plays, -last_played, item))
+        matches.sort(key=lambda m: m[:2])
+        return [item for _, _, item in matches[:limit]]
+
+    def remember_query(self, guild_id: str, query: str, item: "Track"):
+        """Anota que la búsqueda `query` de /play se resolvió a `item` en el servidor."""
+        if query.startswith("http") or not item.webpage_url:
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)",
+                               (guild_id, normalize_query(query), item.webpage_url))
+
+    def find(self, guild_id: str, query: str) -> "Track | None":
+        """
+        La pista ya sonada en el servidor a la que lleva `query`: la misma búsqueda de /play
+        (normalizada) o la URL exacta de la pista, como la que pone el autocompletado.
+        """
+        if query.startswith("http"):
+            sql, key = "SELECT data FROM tracks WHERE guild = ? AND url = ?", query.strip()
+        else:
+            sql = ("SELECT t.data FROM queries q JOIN tracks t ON t.guild = q.guild AND t.url = q.url"
+                   " WHERE q.guild = ? AND q.query = ?")
+            key = normalize_query(query)
+        with self._lock:
+            row = self._conn.execute(sql, (guild_id, key)).fetchone()
+        if row is None:
+            return None
+        self.replays += 1
+        return Track.from_dict(json.loads(row[0]))
+
+    def next_track(self, guild_id: str, after: "Track", exclude=()) -> "Track | None":
+        """
+        Para el autoplay: la que más veces ha sonado justo después de `after` en el servidor o,
+        si no hay ninguna, la más escuchada; nunca una de `exclude` (URLs recientes).
+        """
+        queries = (
+            ("SELECT t.data FROM next_plays n JOIN tracks t ON t.guild = n.guild AND t.url = n.next"
+             " WHERE n.guild = ? AND n.prev = ? ORDER BY n.count DESC, n.last DESC LIMIT ?",
+             (guild_id, after.webpage_url, len(exclude) + 1)),
+            ("SELECT data FROM tracks WHERE guild = ? ORDER BY plays DESC, last_played DESC LIMIT ?",
+             (guild_id, len(exclude) + 1)),
+        )
+        with self._lock:
+            for sql, params in queries:
+                for (data,) in self._conn.execute(sql, params):
+                    item = Track.from_dict(json.loads(data))
+                    if item.webpage_url not in exclude and item.webpage_url != after.webpage_url:
+                        self.picks += 1
+                        return item
+        return None
+
+HISTORY = PlayHistory(PLAY_HISTORY_PATH, PLAY_HISTORY_MAX_TRACKS)
+
+# =========================
+# EMPAREJADO SPOTIFY → YOUTUBE
+# =========================
+# Versiones que casi nunca son la que se busca, salvo que el propio nombre en Spotify las mencione
+MATCH_VARIANT_WORDS = (
+    "live", "en vivo", "directo", "cover", "karaoke", "instrumental", "remix", "sped up", "slowed",
+    "nightcore", "8d", "reaction", "bass boosted", "acoustic", "acustico", "hour", "hours", "hora", "loop",
+)
+# Parte del nombre en Spotify que no suele aparecer en YouTube: "Canción - Remastered 2011", "(feat. X)"
+MATCH_NAME_SUFFIX_RE = re.compile(r"\s+-\s+.*$|\s*[(\[].*?[)\]]")
+
+def match_words(text: str) -> str:
+    """Texto en minúsculas, sin acentos y con sólo letras, números y espacios simples."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c if c.isalnum() else " " for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+def score_candidate(track: dict, entry: dict) -> float:
+    """
+    Parecido (0-1) entre una pista de Spotify y un resultado plano de YouTube: duración,
+    título, artista y tipo de canal, menos una penalización por versiones no pedidas.
+    """
+    name = match_words(track.get("name") or "")
+    base_name = match_words(MATCH_NAME_SUFFIX_RE.sub("", track.get("name") or "")) or name
+    artist = match_words(track["artists"][0]["name"]) if track.get("artists") else ""
+    title = match_words(entry.get("title") or "")
+    channel_raw = entry.get("channel") or entry.get("uploader") or ""
+    channel = match_words(channel_raw)
+    title_words = set(title.split())
+
+    # Duración: igual (±2 s) vale 1 y cae a 0 con 22 s de diferencia
+    spotify_seconds = (track.get("duration_ms") or 0) / 1000
+    if spotify_seconds and entry.get("duration"):
+        duration = max(0.0, 1 - max(0.0, abs(entry["duration"] - spotify_seconds) - 2) / 20)
+    else:
+        duration = 0.5
+
+    # Título: palabras del nombre presentes y parecido del resto quitando el artista
+    name_words = base_name.split()
+    coverage = sum(w in title_words for w in name_words) / len(name_words) if name_words else 0.0
+    stripped = " ".join(w for w in title.split() if w not in artist.split())
+    title_score = 0.7 * coverage + 0.3 * SequenceMatcher(None, base_name, stripped).ratio()
+
+    # Artista: en el título o en el nombre del canal
+    artist_words = artist.split()
+    seen = title_words | set(channel.split())
+    artist_score = sum(w in seen for w in artist_words) / len(artist_words) if artist_words else 0.5
+
+    # Canal: "Artista - Topic" (audio oficial generado por YouTube) > VEVO / canal del artista > resto
+    if channel_raw.endswith(" - Topic"):
+        channel_score = 1.0
+    elif channel.replace(" ", "").endswith("vevo") or (artist and channel.replace(" ", "") == artist.replace(" ", "")):
+        channel_score = 0.8
+    else:
+        channel_score = 0.0
+
+    score = 0.35 * duration + 0.25 * title_score + 0.2 * artist_score + 0.2 * channel_score
+    padded_title, padded_name = f" {title} ", f" {name} "
+    for word in MATCH_VARIANT_WORDS:
+        if f" {word} " in padded_title and f" {word} " not in padded_name:
+            score -= 0.25
+    return max(0.0, min(1.0, score))
+
+async def match_spotify_track(track: dict, job: ExtractionJob | None = None) -> tuple[str, float | None]:
+    """
+    Elige el vídeo de YouTube para una pista de Spotify puntuando varios resultados de una
+    sola búsqueda plana; sólo el ganador se extrae entero después (resolve_item).
+    Devuelve (URL o búsqueda para yt-dlp, confianza).
+    """
+    query = spotify_query(track)
+    results = await search_ytdlp_async(f"ytsearch{SPOTIFY_MATCH_CANDIDATES}:{query}", YDL_FLAT_OPTIONS, job=job)
+    candidates = [e for e in (results or {}).get("entries") or [] if e and e.get("id")]
+    if not candidates:
+        return f"ytsearch1:{query}", None
+    confidence, best = max(((score_candidate(track, e), e) for e in candidates), key=lambda pair: pair[0])
+    SPOTIFY_MATCH_CONFIDENCE.observe(confidence)
+    if confidence < 0.5:
+        print(f"[spotify] Emparejado dudoso ({confidence:.2f}) para '{query}': {best.get('title')}")
+    return f"https://www.youtube.com/watch?v={best['id']}", confidence
+
+# =========================
+# URLS DE STREAM (resolución perezosa)
+# =========================
+# URL directa de audio por pista (webpage_url → (url, caducidad epoch, códec de audio)), en orden LRU
+STREAM_URLS: OrderedDict[str, tuple[str, float, str | None]] = OrderedDict()
+
+# Resoluciones en curso, para que la precarga y la reproducción compartan la misma extracción
+STREAM_RESOLVING = SingleFlight()
+
+def stream_url_expiry(url: str | None) -> float:
+    """Momento (epoch) en que caduca la URL firmada de googlevideo; 1 h si no lo indica."""
+    match = STREAM_EXPIRE_RE.search(url or "")
+    return float(match.group(1)) if match else time.time() + 3600
+
+def remember_stream_url(item: Track, info: dict):
+    url = info.get("url")
+    if not url or not item.webpage_url:
+        return
+    # Las caducadas ya no sirven a nadie; si aun así no hay sitio, fuera las menos usadas
+    now = time.time()
+    for key in [k for k, known in STREAM_URLS.items() if known[1] <= now]:
+        del STREAM_URLS[key]
+    STREAM_URLS[item.webpage_url] = (url, stream_url_expiry(url), info.get("acodec"))
+    STREAM_URLS.move_to_end(item.webpage_url)
+    while len(STREAM_URLS) > STREAM_URL_CACHE_SIZE:
+        STREAM_URLS.popitem(last=False)
+
+def invalidate_stream_url(item: Track):
+    STREAM_URLS.pop(item.webpage_url, None)
+
+async def resolve_stream_url(item: Track, min_valid: float = 60, job: ExtractionJob | None = None) -> tuple[str, str | None]:
+    """
+    Devuelve (URL reproducible, códec de audio) de la pista, extrayéndola sólo si no hay una
+    en memoria que siga siendo válida durante al menos `min_valid` segundos.
+    """
+    key = item.webpage_url
+    known = STREAM_URLS.get(key)
+    if known and known[1] - time.time() > min_valid:
+        STREAM_URLS.move_to_end(key)
+        return known[0], known[2]
+
+    async def extract():
+        info = first_entry(await search_ytdlp_async(key, YDL_OPTIONS, job=job))
+        if not info or not info.get("url"):
+            raise RuntimeError(f"No se pudo obtener el audio de {key}")
+        remember_stream_url(item, info)
+        return info["url"], info.get("acodec")
+
+    return await STREAM_RESOLVING.run(key, extract)
+
+# =========================
+# CACHÉ DE AUDIO
+# =========================
+class AudioCacheError(Exception):
+    pass
+
+class AudioCache:
+    """
+    Audio de pistas de YouTube guardado en disco tal cual lo sirve googlevideo (normalmente
+    Opus en WebM), para que las repeticiones y los /seek no vuelvan a descargar nada. Sólo
+    se guardan pistas que suenan por segunda vez, están en bucle o se buscan con /seek.
+    Expulsa por LRU cuando el total pasa de `max_bytes`; el orden sobrevive a reinicios (mtime).
+    """
+
+    CHUNK = 10 * 1024 * 1024   # descarga por rangos: googlevideo limita las peticiones sin Range
+
+    def __init__(self, directory: str, max_bytes: int, max_track_seconds: int, downloads: int = 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_track_seconds = max_track_seconds
+        self.hits = 0
+        self._bytes = 0
+        self.downloaded_bytes = 0
+        self._files: OrderedDict[str, tuple[str, int]] | None = None   # ID de vídeo → (ruta, bytes)
+        self._plays: OrderedDict[str, int] = OrderedDict()              # reproducciones recientes por ID
+        self._downloads = SingleFlight()
+        self._semaphore = asyncio.Semaphore(downloads)
+
+    @property
+    def _entries(self) -> OrderedDict[str, tuple[str, int]]:
+        # La carpeta se lee al primer uso y no al importar: los procesos de extracción importan
+        # el módulo y borrarían los .part que el bot está descargando
+        if self._files is None:
+            self._files = self._scan() if self.max_bytes > 0 else OrderedDict()
+            self._evict()
+        return self._files
+
+    def load(self):
+        """Lee la carpeta si aún no se leyó; al arrancar se llama en un hilo (open_caches)."""
+        self._entries
+
+    @property
+    def bytes(self) -> int:
+        # Para /metrics: sólo lo que hay en memoria, sin leer la carpeta desde el event loop
+        return self._bytes
+
+    def _scan(self) -> OrderedDict[str, tuple[str, int]]:
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                os.remove(entry.path)   # descarga interrumpida por un reinicio
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name.partition(".")[0], entry.path, stat.st_size))
+        entries = OrderedDict((video_id, (path, size)) for _, video_id, path, size in sorted(files))
+        self._bytes = sum(size for _, size in entries.values())
+        return entries
+
+    def __len__(self) -> int:
+        # Como bytes: sin leer la carpeta (0 hasta load())
+        return len(self._files or ())
+
+    def __contains__(self, item: Track) -> bool:
+        return self._video_id(item) in self._entries
+
+    @staticmethod
+    def _video_id(item: Track) -> str | None:
+        match = YOUTUBE_ID_RE.search(item.webpage_url)
+        return match.group(1) if match else None
+
+    def path(self, item: Track) -> str | None:
+        """Ruta local de la pista si está en disco (sin contarlo como uso)."""
+        entry = self._entries.get(self._video_id(item))
+        return entry[0] if entry and os.path.exists(entry[0]) else None
+
+    def lookup(self, item: Track) -> tuple[str, str | None] | None:
+        """(ruta local, códec) si la pista está en disco."""
+        video_id = self._video_id(item)
+        entry = self._entries.get(video_id) if video_id else None
+        if entry is None:
+            return None
+        if not os.path.exists(entry[0]):
+            self._forget(video_id)
+            return None
+        self._entries.move_to_end(video_id)
+        try:
+            os.utime(entry[0])
+        except OSError:
+            pass
+        self.hits += 1
+        return entry[0], "opus" if entry[0].endswith(".webm") else None
+
+    def note_play(self, item: Track, looping: bool):
+        """Cuenta una reproducción; a la segunda (o si está en bucle) la pista se descarga."""
+        video_id = self._video_id(item)
+        if not video_id:
+            return
+        plays = self._plays.pop(video_id, 0) + 1
+        self._plays[video_id] = plays
+        if len(self._plays) > 10000:
+            self._plays.popitem(last=False)
+        if plays > 1 or looping:
+            self.want(item)
+
+    def want(self, item: Track):
+        """Descarga la pista en segundo plano si merece la pena y aún no está."""
+        video_id = self._video_id(item)
+        if (self.max_bytes <= 0 or not video_id or video_id in self._entries
+                or not item.duration or item.duration > self.max_track_seconds):
+            return
+
+        async def run():
+            try:
+                await self._downloads.run(video_id, lambda: self._download(item, video_id))
+            except Exception as e:
+                print(f"[audio] No se pudo guardar {item.title}: {e}")
+
+        run_in_background(run())
+
+    async def _download(self, item: Track, video_id: str):
+        async with self._semaphore:
+            if video_id in self._entries:
+                return
+            url, acodec = await resolve_stream_url(item, min_valid=600)
+            path = os.path.join(self.directory, f"{video_id}.{'webm' if acodec == 'opus' else 'audio'}")
+            partial = path + ".part"
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+            # Límite de tamaño holgado: ~320 kbps durante la duración máxima
+            limit = self.max_track_seconds * 40_000
+            offset, total = 0, None
+            try:
+                with open(partial, "wb") as f:
+                    while total is None or offset < total:
+                        headers = {"Range": f"bytes={offset}-{offset + self.CHUNK - 1}"}
+                        async with http_session().get(url, headers=headers, timeout=timeout) as resp:
+                            if resp.status not in (200, 206):
+                                raise AudioCacheError(f"HTTP {resp.status}")
+                            async for block in resp.content.iter_chunked(1 << 16):
+                                f.write(block)
+                                offset += len(block)
+                                if offset > limit:
+                                    raise AudioCacheError("archivo demasiado grande")
+                            content_range = resp.headers.get("Content-Range", "")
+                            if resp.status == 200 or "/" not in content_range or content_range.endswith("/*"):
+                                break   # el servidor mandó el archivo entero
+                            total = int(content_range.rpartition("/")[2])
+                os.replace(partial, path)
+            except BaseException:
+                try:
+                    os.remove(partial)
+                except OSError:
+                    pass
+                raise
+            self._entries[video_id] = (path, offset)
+            self._bytes += offset
+            self.downloaded_bytes += offset
+            self._evict()
+
+    def _forget(self, video_id: str):
+        path, size = self._entries.pop(video_id)
+        self._bytes -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass   # en Linux, si ffmpeg lo tiene abierto sigue leyendo hasta cerrarlo
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._forget(next(iter(self._entries)))
+
+AUDIO_CACHE = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MAX_TRACK_SECONDS)
+
+async def open_caches():
+    """
+    Abre las bases SQLite y lee la carpeta de audio en hilos al arrancar, antes de atender
+    comandos: ni la reproducción ni /metrics pagan ese disco en el event loop.
+    """
+    await asyncio.gather(
+        asyncio.to_thread(RESOLUTION_CACHE.open),
+        asyncio.to_thread(HISTORY.open),
+        asyncio.to_thread(AUDIO_CACHE.load),
+    )
+
+# =========================
+# NORMALIZACIÓN DE VOLUMEN
+# =========================
+EBUR128_INTEGRATED_RE = re.compile(r"I:\s+(-?\d+(?:\.\d+)?) LUFS")
+
+class LoudnessAnalyzer:
+    """
+    Mide en segundo plano la sonoridad integrada (EBU R128, filtro ebur128 de ffmpeg) de la
+    pista que va a sonar y la guarda en RESOLUTION_CACHE, así que cada pista se analiza una
+    sola vez. La reproducción aplica la ganancia como filtro de ffmpeg (ver build_audio_source).
+    """
+
+    def __init__(self, target_lufs: float, max_gain_db: float, enabled: bool = True, max_seconds: int = 1800):
+        self.target_lufs = target_lufs
+        self.max_gain_db = max_gain_db
+        self.enabled = enabled
+        self.max_seconds = max_seconds   # directos y mezclas de horas no se analizan
+        self.analyses = 0
+        self.failures = 0
+        self._known: dict[str, float] = {}
+        self._flights = SingleFlight()
+        self._semaphore = asyncio.Semaphore(1)   # el análisis es CPU: no competir con los ffmpeg de reproducción
+
+    def lufs(self, item: Track) -> float | None:
+        lufs = self._known.get(item.webpage_url)
+        if lufs is None:
+            lufs = RESOLUTION_CACHE.loudness(item.webpage_url)
+            if lufs is not None:
+                self._known[item.webpage_url] = lufs
+        return lufs
+
+    def gain_db(self, item: Track) -> float:
+        """Ganancia para llevar la pista a la sonoridad objetivo (0 si aún no se ha medido)."""
+        lufs = self.lufs(item) if self.enabled else None
+        if lufs is None:
+            return 0.0
+        return max(-20.0, min(self.max_gain_db, self.target_lufs - lufs))
+
+    def schedule(self, item: Track):
+        """Analiza la pista en segundo plano si aún no tiene medida."""
+        if (not self.enabled or not item.webpage_url or not item.duration or item.duration > self.max_seconds
+                or self.lufs(item) is not None):
+            return
+
+        async def run():
+            try:
+                await self._flights.run(item.webpage_url, lambda: self._analyze(item))
+            except Exception as e:
+                self.failures += 1
+                print(f"[loudness] No se pudo analizar {item.title}: {e}")
+
+        run_in_background(run())
+
+    async def settle(self, item: Track, timeout: float):
+        """Espera, como mucho `timeout` segundos, a que termine un análisis de la pista ya en marcha."""
+        if not self.enabled or self.lufs(item) is not None or item.webpage_url not in self._flights:
+            return
+        try:
+            await asyncio.wait_for(self._flights.run(item.webpage_url, lambda: self._analyze(item)), timeout)
+        except Exception:
+            pass   # schedule() ya cuenta e informa de los fallos
+
+    async def _analyze(self, item: Track):
+        async with self._semaphore:
+            if self.lufs(item) is not None:
+                return
+            source = AUDIO_CACHE.path(item)
+            args = [get_ffmpeg_path(), "-nostats", "-hide_banner", "-threads", "1"]
+            if source is None:
+                source, _ = await resolve_stream_url(item, min_valid=600)
+                args += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+            args += ["-i", source, "-vn", "-af", "ebur128=framelog=quiet", "-f", "null", "-"]
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            if hasattr(os, "setpriority"):
+                # Prioridad baja, que no quite CPU a la reproducción. Se baja desde aquí y no con
+                # preexec_fn, que no es seguro en un proceso con hilos
+                try:
+                    os.setpriority(os.PRIO_PROCESS, process.pid, os.getpriority(os.PRIO_PROCESS, 0) + 10)
+                except OSError:
+                    pass   # ya terminó
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+            found = EBUR128_INTEGRATED_RE.findall(stderr.decode(errors="replace"))
+            if process.returncode != 0 or not found:
+                raise RuntimeError(f"ffmpeg terminó con código {process.returncode}")
+            # El último valor es el del resumen final
+            lufs = float(found[-1])
+            self.analyses += 1
+            self._known[item.webpage_url] = lufs
+            await asyncio.to_thread(RESOLUTION_CACHE.put_loudness, item.webpage_url, lufs)
+
+LOUDNESS = LoudnessAnalyzer(LOUDNESS_TARGET_LUFS, LOUDNESS_MAX_GAIN_DB, LOUDNESS_NORMALIZATION)
+
+# =========================
+# LETRAS
+# =========================
+LYRICS_PAGE_CHARS = 1800
+LYRICS_NOISE_RE = re.compile(
+    r"\s*[\(\[][^\)\]]*(official|video|audio|lyric|letra|visuali[sz]er|remaster|hd|4k|mv|feat|ft\b)[^\)\]]*[\)\]]",
+    re.IGNORECASE,
+)
+LYRICS_FEAT_RE = re.compile(r"\s+(feat\.?|ft\.?|featuring)\s.*$", re.IGNORECASE)
+
+class LyricsError(Exception):
+    """Fallo de red o de la API de letras (no se cachea, a diferencia de "no encontrada")."""
+
+def split_lyrics(text: str, max_len: int = LYRICS_PAGE_CHARS) -> tuple[str, ...]:
+    """Parte la letra en páginas de hasta `max_len` caracteres, cortando en saltos de línea."""
+    pages = []
+    while len(text) > max_len:
+        cut_index = text.rfind("\n", 0, max_len)
+        if cut_index == -1:
+            cut_index = max_len
+        pages.append(text[:cut_index])
+        text = text[cut_index:]
+    pages.append(text)
+    return tuple(pages)
+
+def guess_artist_title(item: Track) -> tuple[str, str]:
+    """(artista, canción) a partir de una pista de YouTube: "Artista - Canción (Official Video)" o el canal."""
+    title = LYRICS_NOISE_RE.sub("", item.title).strip()
+    if " - " in title:
+        artist, song = (part.strip() for part in title.split(" - ", 1))
+    else:
+        artist = re.sub(r"(\s*-\s*Topic|VEVO|Official)$", "", item.artist, flags=re.IGNORECASE).strip()
+        song = title
+    return LYRICS_FEAT_RE.sub("", artist), LYRICS_FEAT_RE.sub("", song)
+
+class LyricsService:
+    """
+    Letras de lyrics.ovh con caché LRU en memoria: cada entrada guarda las páginas ya partidas
+    y caduca a los `ttl` segundos ("no encontrada" también se cachea, `negative_ttl` segundos).
+    Las peticiones iguales en curso se comparten y prefetch() las pide en segundo plano.
+    """
+
+    def __init__(self, max_entries: int, ttl: int, negative_ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # clave → (páginas o None si no existe, caducidad epoch)
+        self._cache: OrderedDict[str, tuple[tuple[str, ...] | None, float]] = OrderedDict()
+        self._inflight = SingleFlight()
+
+    @staticmethod
+    def _key(artist: str, title: str) -> str:
+        return f"{normalize_query(artist)}\x00{normalize_query(title)}"
+
+    def cached(self, artist: str, title: str):
+        """(True, páginas o None) si hay entrada vigente; (False, None) si hay que pedirla."""
+        key = self._key(artist, title)
+        entry = self._cache.get(key)
+        if entry is None:
+            return False, None
+        if entry[1] < time.time():
+            del self._cache[key]
+            return False, None
+        self._cache.move_to_end(key)
+        return True, entry[0]
+
+    def _store(self, key: str, pages: tuple[str, ...] | None):
+        ttl = self.ttl if pages else self.negative_ttl
+        self._cache[key] = (pages, time.time() + ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, artist: str, title: str) -> tuple[str, ...] | None:
+        url = f"https://api.lyrics.ovh/v1/{quote(artist, safe='')}/{quote(title, safe='')}"
+        try:
+            async with http_session().get(url) as resp:
+                if resp.status == 404:
+                    return None
+                if resp.status != 200:
+                    raise LyricsError(f"HTTP {resp.status}")
+                data = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise LyricsError(str(e) or type(e).__name__) from e
+        lyrics = (data.get("lyrics") or "").strip()
+        return split_lyrics(lyrics) if lyrics else None
+
+    async def get(self, artist: str, title: str) -> tuple[str, ...] | None:
+        """Páginas de la letra, o None si no existe. Lanza LyricsError si la API falla."""
+        found, pages = self.cached(artist, title)
+        if found:
+            return pages
+
+        key = self._key(artist, title)
+
+        async def fetch():
+            result = await self._fetch(artist, title)
+            self._store(key, result)
+            return result
+
+        return await self._inflight.run(key, fetch)
+
+    def prefetch(self, item: Track):
+        """Pide en segundo plano la letra de la pista que empieza a sonar."""
+        artist, title = guess_artist_title(item)
+        if not artist or not title or self.cached(artist, title)[0]:
+            return
+
+        async def run():
+            try:
+                await self.get(artist, title)
+            except LyricsError as e:
+                print(f"[letras] No se pudo precargar {artist} - {title}: {e}")
+
+        run_in_background(run())
+
+LYRICS = LyricsService(LYRICS_CACHE_SIZE, LYRICS_TTL, LYRICS_NEGATIVE_TTL)
+
+# =========================
+# LAST.FM
+# =========================
+class LastFmError(Exception):
+    def __init__(self, message: str, code: int | None = None, retryable: bool = False):
+        super().__init__(message)
+        self.code = code
+        self.retryable = retryable
+
+class LastFmClient:
+    """
+    Cliente asíncrono de la API de Last.fm sobre la sesión HTTP compartida.
+    Las lecturas se cachean `cache_ttl` segundos; las llamadas firmadas (scrobbles) no.
+    """
+
+    API_URL = "https://ws.audioscrobbler.com/2.0/"
+    # Servicio caído, no disponible temporalmente, límite de peticiones
+    RETRYABLE_CODES = {11, 16, 29}
+
+    def __init__(self, api_key: str | None, api_secret: str | None = None, session_key: str | None = None,
+                 cache_ttl: float = 30, cache_size: int = 256):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.session_key = session_key
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+
+    @property
+    def can_scrobble(self) -> bool:
+        return bool(self.api_key and self.api_secret and self.session_key)
+
+    def _sign(self, params: dict) -> str:
+        payload = "".join(f"{k}{params[k]}" for k in sorted(params) if k not in ("format", "callback"))
+        return hashlib.md5((payload + self.api_secret).encode("utf-8")).hexdigest()
+
+    async def call(self, method: str, params: dict | None = None, signed: bool = False) -> dict:
+        params = {"method": method, "api_key": self.api_key, **(params or {})}
+        if signed:
+            params["sk"] = self.session_key
+            params["api_sig"] = self._sign(params)
+        params["format"] = "json"
+
+        cache_key = None if signed else json.dumps(params, sort_keys=True)
+        if cache_key:
+            cached = self._cache.get(cache_key)
+            if cached and cached[1] > time.time():
+                self._cache.move_to_end(cache_key)
+                return cached[0]
+
+        try:
+            request = http_session().post(self.API_URL, data=params) if signed else http_session().get(self.API_URL, params=params)
+            async with request as resp:
+                data = await resp.json(content_type=None)
+                status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise LastFmError(str(e) or type(e).__name__, retryable=True) from e
+        if isinstance(data, dict) and "error" in data:
+            code = data.get("error")
+            raise LastFmError(data.get("message", "error"), code, code in self.RETRYABLE_CODES)
+        if status >= 400:
+            raise LastFmError(f"HTTP {status}", retryable=status >= 500)
+
+        if cache_key:
+            self._cache[cache_key] = (data, time.time() + self.cache_ttl)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data
+
+    async def recent_tracks(self, user: str, limit: int = 1) -> list[dict]:
+        data = await self.call("user.getrecenttracks", {"user": user, "limit": limit})
+        tracks = data.get("recenttracks", {}).get("track", [])
+        return tracks if isinstance(tracks, list) else [tracks]
+
+    async def scrobble(self, batch: list[dict]):
+        """Envía hasta 50 scrobbles en una sola llamada (artist[i], track[i], timestamp[i]...)."""
+        params = {}
+        for i, entry in enumerate(batch):
+            for key, value in entry.items():
+                if value is not None:
+                    params[f"{key}[{i}]"] = value
+        await self.call("track.scrobble", params, signed=True)
+
+class Scrobbler:
+    """
+    Acumula las pistas escuchadas y las envía a Last.fm en lotes de hasta 50, cada
+    SCROBBLE_FLUSH_INTERVAL segundos o en cuanto se llena un lote. Si Last.fm falla, reintenta
+    con espera exponencial y guarda lo pendiente en un archivo (spool) que se recarga al arrancar.
+    """
+
+    BATCH = 50
+    MAX_AGE = 14 * 24 * 3600      # Last.fm rechaza scrobbles de hace más de 14 días
+    MAX_BACKOFF = 1800
+
+    def __init__(self, client: LastFmClient, spool_path: str, interval: float):
+        self.client = client
+        self.spool_path = spool_path
+        self.interval = interval
+        self.pending: list[dict] = []
+        self.sent = 0
+        self._spooled = False
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def track_finished(self, item: Track, started_at: float, position: float):
+        """Regla de Last.fm: pista de más de 30 s escuchada la mitad o 4 minutos."""
+        duration = item.duration or 0
+        if duration <= 30 or position < min(duration / 2, 240):
+            return
+        artist, title = guess_artist_title(item)
+        if not artist or not title:
+            return
+        self.pending.append({"artist": artist, "track": title, "timestamp": int(started_at), "duration": int(duration)})
+        if len(self.pending) >= self.BATCH:
+            self._wake.set()
+
+    def _load_spool(self):
+        try:
+            with open(self.spool_path, encoding="utf-8") as f:
+                spooled = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print(f"[scrobble] Spool ilegible, se ignora: {e}")
+            return
+        oldest = time.time() - self.MAX_AGE
+        self.pending[:0] = [s for s in spooled if s.get("timestamp", 0) > oldest]
+        self._spooled = True
+
+    def _save_spool(self):
+        if self.pending:
+            tmp = ensure_parent_dir(self.spool_path) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.pending, f, ensure_ascii=False)
+            os.replace(tmp, self.spool_path)
+            self._spooled = True
+        elif self._spooled:
+            try:
+                os.remove(self.spool_path)
+            except FileNotFoundError:
+                pass
+            self._spooled = False
+
+    async def _run(self):
+        backoff = 0.0
+        while True:
+            if backoff:
+                await asyncio.sleep(backoff)
+            else:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+            while self.pending:
+                batch = self.pending[:self.BATCH]
+                try:
+                    await self.client.scrobble(batch)
+                    self.sent += len(batch)
+                except LastFmError as e:
+                    if e.retryable:
+                        backoff = min(self.MAX_BACKOFF, backoff * 2 or 30)
+                        print(f"[scrobble] Last.fm no disponible ({e}); reintento en {int(backoff)} s")
+                        await asyncio.to_thread(self._save_spool)
+                        break
+                    # Lote rechazado (parámetros, autenticación): reintentarlo no serviría de nada
+                    print(f"[scrobble] Lote descartado: {e}")
+                del self.pending[:len(batch)]
+                backoff = 0.0
+            if not self.pending and self._spooled:
+                await asyncio.to_thread(self._save_spool)
+
+    def start(self):
+        self._load_spool()
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        """Al apagar: cancelar el envío y dejar lo pendiente en el spool."""
+        if self._task:
+            self._task.cancel()
+        try:
+            self._save_spool()
+        except OSError as e:
+            print(f"[scrobble] No se pudo guardar el spool: {e}")
+
+LASTFM = LastFmClient(LASTFM_API_KEY, LASTFM_API_SECRET, LASTFM_SESSION_KEY)
+SCROBBLER = Scrobbler(LASTFM, SCROBBLE_SPOOL_PATH, SCROBBLE_FLUSH_INTERVAL) if LASTFM.can_scrobble else None
+
+# =========================
+# SUGERENCIAS DE /play (autocompletado)
+# =========================
+# Discord descarta la respuesta de autocompletado a los 3 s: dejar margen para la red
+AUTOCOMPLETE_BUDGET = 2.3
+AUTOCOMPLETE_DEBOUNCE = 0.35
+AUTOCOMPLETE_MIN_LOCAL = 5
+AUTOCOMPLETE_MIN_CHARS = 3
+SUGGESTIONS_MAX_ENTRIES = 5000
+
+class SuggestionIndex:
+    """
+    Índice en memoria de títulos ya resueltos y búsquedas recientes para el autocompletado.
+    Cada palabra se indexa por sus prefijos de 1 y 2 letras; una entrada casa si todas las
+    palabras de la consulta son prefijo de alguna de sus palabras. Expulsa por LRU.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # valor de la opción → (texto visible, palabras indexadas, marca de uso)
+        self._entries: OrderedDict[str, tuple[str, frozenset[str], int]] = OrderedDict()
+        self._prefixes: dict[str, set[str]] = {}
+        self._clock = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _keys(words) -> set[str]:
+        return {word[:n] for word in words for n in (1, 2)}
+
+    def _unindex(self, value: str, words):
+        for key in self._keys(words):
+            bucket = self._prefixes.get(key)
+            if bucket is not None:
+                bucket.discard(value)
+                if not bucket:
+                    del self._prefixes[key]
+
+    def add(self, label: str, value: str, aliases=()):
+        """Añade o refresca una sugerencia; los alias (búsquedas que llevaron a ella) también casan."""
+        if not value or len(value) > 100:
+            return  # Discord limita el valor de una opción a 100 caracteres
+        words = set(normalize_query(" ".join((label, *aliases))).split())
+        old = self._entries.pop(value, None)
+        if old is not None:
+            words |= old[1]
+            self._unindex(value, old[1])
+        self._clock += 1
+        self._entries[value] = (label[:100], frozenset(words), self._clock)
+        for key in self._keys(words):
+            self._prefixes.setdefault(key, set()).add(value)
+        while len(self._entries) > self.max_entries:
+            evicted, (_, evicted_words, _) = self._entries.popitem(last=False)
+            self._unindex(evicted, evicted_words)
+
+    def add_track(self, item: "Track", alias: str | None = None):
+        self.add(f"{item.title} — {item.artist}", item.webpage_url, (alias,) if alias else ())
+
+    def search(self, query: str, limit: int = 25) -> list[tuple[str, str]]:
+        """(texto, valor) que casan con `query`; primero las que empiezan igual, luego las más recientes."""
+        words = normalize_query(query).split()
+        if not words:
+            recent = islice(reversed(self._entries.items()), limit)
+            return [(label, value) for value, (label, _, _) in recent]
+        buckets = [self._prefixes.get(word[:2], ()) for word in words]
+        candidates = min(buckets, key=len)
+        matches = []
+        for value in candidates:
+            label, entry_words, stamp = self._entries[value]
+            if all(any(w.startswith(word) for w in entry_words) for word in words):
+                starts = normalize_query(label).startswith(words[0])
+                matches.append((not starts, -stamp, label, value))
+        matches.sort()
+        return [(label, value) for _, _, label, value in matches[:limit]]
+
+class RemoteSuggester:
+    """
+    Búsqueda plana en YouTube (sin resolver formatos) para cuando el índice local no basta.
+    Las consultas iguales en vuelo se comparten, los resultados se guardan `ttl` segundos,
+    como mucho `concurrency` búsquedas ocupan el pool de extracción a la vez y cada usuario
+    sólo dispara búsqueda cuando deja de teclear (`debounce`).
+    """
+
+    def __init__(self, concurrency: int = 1, results: int = 5, ttl: float = 600, max_entries: int = 256):
+        self.results = results
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.searches = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._cache: OrderedDict[str, tuple[list[tuple[str, str]], float]] = OrderedDict()
+        self._inflight = SingleFlight()
+        self._latest: dict[int, int] = {}
+
+    async def debounce(self, user_id: int, delay: float) -> bool:
+        """Espera `delay`; True si en ese tiempo el usuario no ha pedido otra sugerencia."""
+        token = self._latest.get(user_id, 0) + 1
+        self._latest[user_id] = token
+        await asyncio.sleep(delay)
+        if self._latest.get(user_id) != token:
+            return False
+        del self._latest[user_id]
+        return True
+
+    def cached(self, query: str) -> list[tuple[str, str]] | None:
+        hit = self._cache.get(normalize_query(query))
+        if hit is None or hit[1] < time.monotonic():
+            return None
+        return hit[0]
+
+    async def search(self, query: str, timeout: float) -> list[tuple[str, str]]:
+        """Resultados para `query`, o [] si no llegan a tiempo (la búsqueda sigue y queda en caché)."""
+        key = normalize_query(query)
+        found = self.cached(key)
+        if found is not None:
+            return found
+        try:
+            return await asyncio.wait_for(self._inflight.run(key, lambda: self._fetch(key)), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            return []
+
+    async def _fetch(self, key: str) -> list[tuple[str, str]]:
+        async with self._semaphore:
+            # Mientras esperaba turno pudo resolverla otra petición
+            found = self.cached(key)
+            if found is not None:
+                return found
+            self.searches += 1
+            try:
+                # Alguien está esperando las sugerencias: turno de interactiva, sin gastar sus fichas
+                info = await search_ytdlp_async(f"ytsearch{self.results}:{key}", YDL_FLAT_OPTIONS,
+                                                job=ExtractionJob(PRIORITY_INTERACTIVE))
+            except Exception as e:
+                print(f"[autocomplete] Error buscando '{key}': {e}")
+                return []
+        found = []
+        for entry in (info or {}).get("entries") or []:
+            if not entry or not entry.get("id"):
+                continue
+            url = entry.get("url") or f"https://www.youtube.com/watch?v={entry['id']}"
+            label = f"{entry.get('title') or 'Sin título'} — {entry.get('channel') or entry.get('uploader') or 'Desconocido'}"
+            found.append((label[:100], url))
+            # Alimentar el índice: las siguientes pulsaciones casan en local sin volver a buscar
+            SUGGESTIONS.add(label, url, (key,))
+        self._cache[key] = (found, time.monotonic() + self.ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return found
+
+SUGGESTIONS = SuggestionIndex(SUGGESTIONS_MAX_ENTRIES)
+REMOTE_SUGGESTIONS = RemoteSuggester()
+
+async def seed_suggestions():
+    """Carga en el índice las pistas resueltas más recientes de RESOLUTION_CACHE."""
+    tracks = await asyncio.to_thread(RESOLUTION_CACHE.recent_tracks, SUGGESTIONS_MAX_ENTRIES)
+    for item in reversed(tracks):
+        SUGGESTIONS.add_track(item)
+
+async def suggest_songs(user_id: int, current: str, guild_id: str | None = None) -> list[tuple[str, str]]:
+    """Sugerencias para lo que el usuario lleva escrito en /play, dentro del plazo de Discord."""
+    deadline = asyncio.get_running_loop().time() + AUTOCOMPLETE_BUDGET
+    # Primero lo que más ha sonado en el servidor; luego el índice global
+    played = await asyncio.to_thread(HISTORY.search, guild_id, current, 10) if guild_id else []
+    found = [(f"{item.title} — {item.artist}"[:100], item.webpage_url) for item in played
+             if len(item.webpage_url) <= 100]
+    seen = {value for _, value in found}
+    found.extend(choice for choice in SUGGESTIONS.search(current) if choice[1] not in seen)
+    found = found[:25]
+    text = current.strip()
+    if len(found) >= AUTOCOMPLETE_MIN_LOCAL or len(text) < AUTOCOMPLETE_MIN_CHARS or text.startswith("http"):
+        return found
+    remote = REMOTE_SUGGESTIONS.cached(text)
+    if remote is None:
+        # Sólo la última pulsación del usuario llega a buscar; las anteriores se quedan con lo local
+        if not await REMOTE_SUGGESTIONS.debounce(user_id, AUTOCOMPLETE_DEBOUNCE):
+            return found
+        remote = await REMOTE_SUGGESTIONS.search(text, deadline - asyncio.get_running_loop().time())
+    seen = {value for _, value in found}
+    found.extend(choice for choice in remote if choice[1] not in seen)
+    return found[:25]
+
+# =========================
+# EVENTOS
+# =========================
+# Segundos desde que empezó a cargarse el módulo hasta cada fase del arranque (informe y /metrics);
+# "command_sync" no es un tiempo sino el resultado del sync de comandos
+STARTUP_TIMES: dict[str, float] = {}
+COMMAND_SYNC_SKIPPED, COMMAND_SYNC_DONE, COMMAND_SYNC_FAILED = 0.0, 1.0, -1.0
+COMMAND_SYNC_RESULTS = {COMMAND_SYNC_SKIPPED: "sin cambios", COMMAND_SYNC_DONE: "sí", COMMAND_SYNC_FAILED: "falló"}
+LAST_DISCONNECT: float | None = None
+LAST_RECONNECT_SECONDS = 0.0
+
+def mark_startup(phase: str):
+    STARTUP_TIMES.setdefault(phase, time.perf_counter() - STARTUP_T0)
+
+async def sync_command_tree() -> bool:
+    """Sincroniza los comandos con Discord sólo si el árbol cambió desde el último sync guardado."""
+    payload = [cmd.to_dict(bot.tree) for cmd in sorted(bot.tree.get_commands(), key=lambda c: c.name)]
+    blob = json.dumps({"app": bot.application_id, "commands": payload}, sort_keys=True, default=str)
+    digest = hashlib.sha256(blob.encode("utf-8")).hexdigest()
+    try:
+        with open(COMMAND_SYNC_STATE_PATH, encoding="utf-8") as f:
+            previous = f.read().strip()
+    except FileNotFoundError:
+        previous = None
+    if digest == previous and not FORCE_COMMAND_SYNC:
+        return False
+    await bot.tree.sync()
+    with open(ensure_parent_dir(COMMAND_SYNC_STATE_PATH), "w", encoding="utf-8") as f:
+        f.write(digest)
+    return True
+
+def note_reconnect():
+    global LAST_DISCONNECT, LAST_RECONNECT_SECONDS
+    if LAST_DISCONNECT is not None:
+        LAST_RECONNECT_SECONDS = time.perf_counter() - LAST_DISCONNECT
+        LAST_DISCONNECT = None
+        print(f"[arranque] Reconectado al gateway en {LAST_RECONNECT_SECONDS * 1000:.0f} ms")
+
+@bot.event
+async def on_ready():
+    if "ready" not in STARTUP_TIMES:
+        mark_startup("ready")
+        t = STARTUP_TIMES
+        print(
+            f"{bot.user} is online! Arranque: importación {t['import'] * 1000:.0f} ms, "
+            f"login+setup {(t['setup'] - t['import']) * 1000:.0f} ms "
+            f"(sync de comandos: {COMMAND_SYNC_RESULTS[t['command_sync']]}), "
+            f"gateway listo a los {t['ready'] * 1000:.0f} ms"
+        )
+    else:
+        note_reconnect()
+    # on_ready se repite en cada reconexión; restore_players sólo actúa la primera vez
+    run_in_background(restore_players())
+
+@bot.event
+async def on_resumed():
+    note_reconnect()
+
+@bot.event
+async def on_disconnect():
+    global LAST_DISCONNECT
+    if LAST_DISCONNECT is None:
+        LAST_DISCONNECT = time.perf_counter()
+
+# =========================
+# MENSAJES SALIENTES
+# =========================
+class OutboundScheduler:
+    """
+    Cola de salida por canal para los mensajes que el bot manda por su cuenta ("Ahora suena",
+    progreso de las importaciones). Una tarea por canal los envía en orden, con al menos
+    `interval` segundos entre llamadas, y de cada ranura sólo guarda la última actualización
+    pendiente: una ráfaga de skips acaba en una sola edición en vez de en una cola de envíos
+    esperando al rate limit dentro del event loop.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.calls = 0
+        self.coalesced = 0   # actualizaciones que otra más reciente dejó sin enviar
+        self._lanes: dict[int, OrderedDict] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return sum(len(pending) for pending in self._lanes.values())
+
+    def post(self, channel_id: int, slot, factory):
+        """Programa `factory()` (corrutina) en el canal; sustituye a lo pendiente en la misma ranura."""
+        pending = self._lanes.setdefault(channel_id, OrderedDict())
+        if slot in pending:
+            self.coalesced += 1
+        pending[slot] = factory   # conserva su turno en el canal
+        if channel_id not in self._tasks:
+            self._tasks[channel_id] = asyncio.create_task(self._drain(channel_id, pending))
+
+    async def _drain(self, channel_id: int, pending: OrderedDict):
+        loop = asyncio.get_running_loop()
+        try:
+            while pending:
+                _, factory = pending.popitem(last=False)
+                started = loop.time()
+                try:
+                    await factory()
+                    self.calls += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"[outbox] Error al enviar al canal {channel_id}: {e}")
+                # Mientras tanto las siguientes actualizaciones se acumulan y se funden
+                await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+        finally:
+            self._tasks.pop(channel_id, None)
+            if not pending:
+                self._lanes.pop(channel_id, None)
+
+OUTBOX = OutboundScheduler(OUTBOUND_MIN_INTERVAL)
+
+# =========================
+# REPRODUCCIÓN
+# =========================
+class TrackedSource(discord.AudioSource):
+    """Envuelve la fuente real y cuenta los frames entregados (20 ms cada uno) para saber la posición."""
+
+    def __init__(self, original: discord.AudioSource, start_seconds: float = 0):
+        self.original = original
+        self.start_seconds = start_seconds
+        self.frames = 0
+        self.created = time.perf_counter()       # ffmpeg se lanza al crear la fuente original
+        self.gap_start: float | None = None      # fin de la canción anterior, para medir el hueco
+        self.primed: deque[bytes] = deque()      # frames leídos por adelantado (prime)
+        self.warmed = False
+        # Fundido con la siguiente pista: (su fuente, posición de inicio, segundos); lo lee el hilo de audio
+        self.fade: tuple["TrackedSource", float, float] | None = None
+
+    def read(self) -> bytes:
+        data = self.primed.popleft() if self.primed else self.original.read()
+        if data:
+            if not self.frames:
+                self._first_packet()
+            self.frames += 1
+            fade = self.fade
+            if fade is not None and self.position >= fade[1]:
+                data = self._mix(data, *fade)
+        return data
+
+    def prime(self, frames: int) -> bool:
+        """
+        Lee por adelantado los primeros frames (bloquea: conexión y sondeo de ffmpeg). Se llama
+        en un hilo antes de vc.play, así el primer read del hilo de audio ya no espera a nada.
+        """
+        while len(self.primed) < frames:
+            data = self.original.read()
+            if not data:
+                break
+            if not self.warmed:
+                self.warmed = True
+                FFMPEG_FIRST_PACKET_SECONDS.observe(time.perf_counter() - self.created)
+            self.primed.append(data)
+        return bool(self.primed)
+
+    def _first_packet(self):
+        now = time.perf_counter()
+        if not self.warmed:
+            FFMPEG_FIRST_PACKET_SECONDS.observe(now - self.created)
+        if self.gap_start is not None:
+            TRANSITION_GAP_SECONDS.observe(now - self.gap_start)
+
+    def _mix(self, data: bytes, incoming_source: "TrackedSource", start: float, seconds: float) -> bytes:
+        """Mezcla lineal (PCM s16le) del final de esta pista con el principio de la siguiente."""
+        try:
+            incoming = incoming_source.read()
+        except (OSError, ValueError, AttributeError):
+            # La siguiente se descartó (skip, seek...) mientras este hilo la leía
+            self.fade = None
+            return data
+        if len(incoming) != len(data):
+            return data
+        t = min(1.0, (self.position - start) / seconds)
+        return audioop.add(audioop.mul(data, 2, 1 - t), audioop.mul(incoming, 2, t), 2)
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    @property
+    def elapsed(self) -> float:
+        return self.frames * 0.02
+
+    @property
+    def position(self) -> float:
+        return self.start_seconds + self.elapsed
+
+    def set_volume(self, volume: float) -> bool:
+        """Cambia el volumen en caliente si la fuente es PCM. En modo Opus lo aplica ffmpeg y hay que reiniciar."""
+        if isinstance(self.original, discord.PCMVolumeTransformer):
+            self.original.volume = volume
+            return True
+        return False
+
+def build_audio_source(url: str, start_seconds: float = 0, volume: float = 0.5, acodec: str | None = None,
+                       mode: str | None = None, gain_db: float = 0.0) -> TrackedSource:
+    """
+    Construye la fuente de audio para vc.play según PLAYBACK_MODE:
+    - "pcm": ffmpeg decodifica a PCM, Python aplica el volumen y discord.py codifica a Opus.
+    - "opus": ffmpeg entrega Opus listo para enviar (volumen como filtro de ffmpeg). Si la pista
+      ya es Opus, el volumen es 100% y no hay ganancia, los paquetes se copian sin decodificar.
+    `gain_db` es la normalización de sonoridad de la pista (LoudnessAnalyzer), siempre en ffmpeg.
+    """
+    gain_db = round(gain_db, 1)
+    mode = mode or PLAYBACK_MODE
+    # Las opciones de reconexión son del protocolo HTTP: con un archivo de AUDIO_CACHE ffmpeg las rechaza
+    before = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5" if url.startswith("http") else ""
+    if start_seconds and start_seconds > 0:
+        before = f"-ss {int(start_seconds)} {before}".strip()
+
+    if mode == "opus":
+        if acodec == "opus" and abs(volume - 1.0) < 0.005 and not gain_db:
+            original = discord.FFmpegOpusAudio(
+                url, executable=get_ffmpeg_path(), before_options=before, codec="copy", options="-vn"
+            )
+        else:
+            original = discord.FFmpegOpusAudio(
+                url, executable=get_ffmpeg_path(), before_options=before, bitrate=OPUS_BITRATE,
+                options=f"-vn -af volume={volume * 10 ** (gain_db / 20):.3f}"
+            )
+    else:
+        # 🔧 Cambio clave: options="-vn" (sin forzar libopus)
+        options = f"-vn -af volume={gain_db}dB" if gain_db else "-vn"
+        original = discord.PCMVolumeTransformer(
+            discord.FFmpegPCMAudio(url, executable=get_ffmpeg_path(), before_options=before, options=options),
+            volume=volume,
+        )
+    return TrackedSource(original, start_seconds=start_seconds or 0)
+
+@dataclass(eq=False)
+class Preroll:
+    """La siguiente pista con su ffmpeg ya lanzado y sus primeros frames en memoria."""
+    item: Track
+    handle: int | None
+    task: asyncio.Task | None = None
+    source: TrackedSource | None = None
+    volume: float = 0.5
+
+    @property
+    def ready(self) -> bool:
+        return self.source is not None and self.task is not None and self.task.done()
+
+PREROLL_COUNTS = {"used": 0, "discarded": 0}
+
+class GuildPlayer:
+    """
+    Estado y reproducción de un servidor: cola, canción actual, loop y volumen.
+
+    Una tarea asyncio propia atiende la cola de eventos (fin de pista, skip, seek, stop...)
+    de uno en uno. El 'after' de discord.py sólo deposita un evento desde el hilo de audio,
+    así que nunca bloquea ese hilo, y comandos y fin de pista no pueden pisarse.
+    """
+
+    def __init__(self, guild_id: str):
+        self.guild_id = guild_id
+        # La cabeza de la cola es la canción que suena; el loop decide qué pasa con ella al terminar
+        self.queue = TrackQueue()
+        self.current: Track | None = None
+        self.current_handle: int | None = None
+        self.loop_mode = "off"          # "off" | "one" | "all"
+        self.volume = 0.5               # 0.0 - 1.0
+        self.autoplay = False           # al acabarse la cola, seguir con el historial (HISTORY)
+        self.last_played: Track | None = None
+        self.recent: deque[str] = deque(maxlen=AUTOPLAY_RECENT)   # webpage_url que el autoplay no repite
+        self.vc: discord.VoiceClient | None = None
+        self.channel: discord.abc.Messageable | None = None
+        self.source: TrackedSource | None = None
+        self.ingest_tasks: set[asyncio.Task] = set()
+        self.prefetch_task: asyncio.Task | None = None
+        self.preroll: Preroll | None = None
+        self.now_playing: discord.Message | None = None   # el "Ahora suena", editado en cada pista
+        # Cada fuente lanzada recibe una generación nueva; los fines de pista de fuentes ya
+        # reemplazadas (seek, skip, stop) llevan una generación vieja y se ignoran
+        self._generation = 0
+        self._recoveries = 0
+        self._started_at = 0.0          # epoch de inicio de la pista actual (timestamp del scrobble)
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    # ---------- API para comandos ----------
+    def post(self, kind: str, **data) -> asyncio.Future:
+        """Encola un evento; el futuro devuelto se resuelve con el resultado del manejador."""
+        fut = asyncio.get_running_loop().create_future()
+        if self._closed:
+            fut.set_result(None)
+        else:
+            self._events.put_nowait((kind, data, fut))
+        return fut
+
+    def attach(self, vc: discord.VoiceClient, channel: discord.abc.Messageable | None):
+        self.vc = vc
+        self.channel = channel
+        self._journal("channels", vc=vc.channel.id if vc.channel else None, tc=getattr(channel, "id", None))
+
+    def enqueue(self, item: Track) -> int:
+        handle = self.queue.append(item)
+        self._journal("add", h=handle, t=item.to_dict())
+        self.kick()
+        if len(self.queue) == 2:
+            # Pasa a ser la siguiente: precargarla como si hubiera estado desde el principio
+            self._refresh_prefetch()
+        return handle
+
+    def restore(self, state: dict):
+        """Carga una cola guardada (ver QueueJournal) y la retoma en su pista y posición."""
+        self.loop_mode = state.get("loop", "off")
+        self.volume = state.get("volume", 0.5)
+        self.autoplay = state.get("autoplay", False)
+        self._journal("loop", m=self.loop_mode)
+        self._journal("volume", v=self.volume)
+        self._journal("autoplay", on=self.autoplay)
+        queue = state.get("queue") or []
+        # La pista que sonaba es siempre la cabeza; si ya no está en la cola se empieza por la siguiente
+        resume_at = int(state.get("position") or 0) if queue and queue[0][0] == state.get("current") else 0
+        for _, data in queue:
+            track = Track.from_dict(data)
+            self._journal("add", h=self.queue.append(track), t=track.to_dict())
+        self.post("resume", seconds=resume_at)
+
+    def kick(self):
+        """Pide al reproductor que arranque la cola si está parado."""
+        if not self._closed and self.current is None:
+            self._events.put_nowait(("play", {}, None))
+
+    def set_loop(self, mode: str):
+        self.loop_mode = mode
+        self._journal("loop", m=mode)
+        self._discard_preroll()
+        if mode != "off" and self.current:
+            AUDIO_CACHE.want(self.current)
+        self._refresh_prefetch()
+
+    def set_autoplay(self, enabled: bool):
+        self.autoplay = enabled
+        self._journal("autoplay", on=enabled)
+        # Si lo que suena ya es lo último, elegir ahora la siguiente para que se precargue
+        if self._autofill():
+            self._refresh_prefetch()
+
+    def clear(self) -> bool:
+        """Vacía la cola (la pista actual termina de sonar). Devuelve True si canceló una importación."""
+        cancelled = self.cancel_ingest()
+        self.queue.clear()
+        self._journal("clear")
+        self._discard_preroll()
+        return cancelled
+
+    def _editable(self, index: int) -> bool:
+        # Con algo sonando, la posición 0 es la pista actual y no se toca (para eso está /skip)
+        return 0 <= index < len(self.queue) and not (index == 0 and self.current is not None)
+
+    def remove_at(self, index: int) -> Track | None:
+        """Quita la pista de la posición (0 = cabeza). None si la posición no es válida."""
+        if not self._editable(index):
+            return None
+        handle = self.queue.handle_at(index)
+        track = self.queue.remove(handle)
+        self._journal("remove", h=handle)
+        self._refresh_prefetch()
+        return track
+
+    def move(self, index: int, to: int) -> Track | None:
+        if not self._editable(index) or not self._editable(min(to, len(self.queue) - 1)):
+            return None
+        handle = self.queue.handle_at(index)
+        self.queue.move(handle, to)
+        self._journal("move", h=handle, to=to)
+        self._refresh_prefetch()
+        return self.queue.get(handle)
+
+    def shuffle(self):
+        self.queue.shuffle(keep_head=self.current is not None)
+        self._journal("order", hs=list(self.queue.handles()))
+        self._refresh_prefetch()
+
+    def _refresh_prefetch(self):
+        if self.current is not None:
+            self._schedule_prefetch()
+
+    def cancel_ingest(self) -> bool:
+        """Cancela las importaciones de playlist en curso. Devuelve True si había alguna."""
+        cancelled = False
+        for task in self.ingest_tasks:
+            if not task.done():
+                task.cancel()
+                cancelled = True
+        self.ingest_tasks.clear()
+        return cancelled
+
+    def save_position(self):
+        """Anota en el diario por dónde va la pista actual (lo llama persistence_loop)."""
+        if self.source and self.vc and self.vc.is_playing():
+            self._journal("position", h=self.current_handle, p=round(self.source.position, 1))
+
+    def snapshot(self) -> dict:
+        """Estado completo en el formato de QueueJournal, para las instantáneas."""
+        return {
+            "queue": [[h, self.queue.get(h).to_dict()] for h in self.queue.handles()],
+            "current": self.current_handle,
+            "position": round(self.source.position, 1) if self.source else 0,
+            "loop": self.loop_mode,
+            "volume": self.volume,
+            "autoplay": self.autoplay,
+            "voice": self.vc.channel.id if self.vc and self.vc.channel else None,
+            "text": getattr(self.channel, "id", None),
+        }
+
+    def upcoming(self) -> Track | None:
+        """La pista que sonará después de la actual según el modo de loop."""
+        nxt = self._upcoming()
+        return nxt[1] if nxt else None
+
+    def _upcoming(self) -> tuple[int | None, Track] | None:
+        if not self.queue:
+            return None
+        if self.loop_mode == "one":
+            return (self.current_handle, self.current) if self.current else (self.queue.head_handle(), self.queue[0])
+        if len(self.queue) > 1:
+            handle = self.queue.handle_at(1)
+            return handle, self.queue.get(handle)
+        return (self.queue.head_handle(), self.queue[0]) if self.loop_mode == "all" else None
+
+    # ---------- bucle de eventos ----------
+    async def _run(self):
+        while not self._closed:
+            kind, data, fut = await self._events.get()
+            try:
+                result = await getattr(self, f"_on_{kind}")(**data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[player {self.guild_id}] Error procesando '{kind}': {e}")
+                if fut and not fut.done():
+                    fut.set_exception(e)
+                continue
+            if fut and not fut.done():
+                fut.set_result(result)
+
+        # Cerrado: no dejar colgado a nadie que esperaba un evento pendiente
+        while not self._events.empty():
+            _, _, fut = self._events.get_nowait()
+            if fut and not fut.done():
+                fut.set_result(None)
+
+    def _make_after(self, generation: int, source: TrackedSource):
+        loop = bot.loop
+
+        def after(error):
+            # Hilo de audio: sólo avisar al bucle del reproductor, sin esperar a nada
+            if error:
+                print(f"[after] Error en reproducción: {error}")
+            loop.call_soon_threadsafe(
+                self._events.put_nowait,
+                ("track_end", {"generation": generation, "error": error, "position": source.position,
+                               "ended": time.perf_counter()}, None),
+            )
+
+        return after
+
+    # ---------- manejadores ----------
+    async def _on_play(self):
+        """Arranca la cola si no está sonando nada."""
+        if self.current is None:
+            await self._play_head()
+
+    async def _on_resume(self, seconds: int):
+        """Arranca una cola restaurada en la posición guardada de su primera pista."""
+        if self.current is not None:
+            return
+        handle = self.queue.head_handle()
+        if handle is not None and seconds > 0 and await self._start(self.queue.get(handle), seconds, handle=handle):
+            return
+        await self._play_head()
+
+    async def _on_track_end(self, generation: int, error, position: float, ended: float):
+        if generation != self._generation or self.current is None:
+            return
+        current = self.current
+
+        # ¿Se cortó antes de tiempo? (URL caducada, conexión caída) Re-resolver y retomar
+        duration = current.duration or 0
+        played = position - (self.source.start_seconds if self.source else 0)
+        cut_short = error is not None or (position < duration - 5 if duration else played < 3)
+        if cut_short and self._recoveries < STREAM_MAX_RECOVERIES and self.vc and self.vc.is_connected():
+            print(f"[player {self.guild_id}] Stream cortado en {int(position)}s, re-resolviendo URL de {current.title}")
+            invalidate_stream_url(current)
+            recoveries = self._recoveries + 1
+            if await self._start(current, int(position), announce=False, handle=self.current_handle):
+                self._recoveries = recoveries
+                return
+
+        self._scrobble(position)
+        self._advance()
+        await self._play_head(gap_start=ended)
+
+    async def _on_skip(self) -> bool:
+        if self.current is None:
+            return False
+        self._scrobble(self.source.position if self.source else 0)
+        self._halt()
+        self._advance(skipped=True)
+        await self._play_head()
+        return True
+
+    async def _on_seek(self, seconds: int) -> bool:
+        if self.current is None:
+            return False
+        self._halt()
+        # Tras un /seek suele venir otro: con la pista en disco los siguientes son instantáneos
+        AUDIO_CACHE.want(self.current)
+        await self._start(self.current, max(0, int(seconds)), handle=self.current_handle)
+        return True
+
+    async def _on_volume(self, volume: float):
+        self.volume = volume
+        self._journal("volume", v=volume)
+        if self.source is None or self.source.set_volume(volume):
+            return
+        # Modo Opus: el volumen va en el filtro de ffmpeg, así que se reinicia en la posición actual
+        paused = self.vc.is_paused()
+        position = self.source.position
+        self._halt()
+        if await self._start(self.current, int(position), announce=False, handle=self.current_handle) and paused:
+            self.vc.pause()
+
+    async def _on_stop(self):
+        self.cancel_ingest()
+        if self.source:
+            self._scrobble(self.source.position)
+        self._halt()
+        self.queue.clear()
+        await self._close()
+
+    # ---------- internos ----------
+    def _journal(self, op: str, **data):
+        STATE_STORE.record(self.guild_id, op, **data)
+
+    def _scrobble(self, position: float):
+        if SCROBBLER is not None and self.current is not None:
+            SCROBBLER.track_finished(self.current, self._started_at, position)
+
+    def _halt(self):
+        """Detiene la fuente actual sin que su fin de pista encadene nada."""
+        self._generation += 1
+        if self.vc and (self.vc.is_playing() or self.vc.is_paused()):
+            self.vc.stop()
+
+    def _advance(self, skipped: bool = False):
+        """Mueve la cola al terminar la pista actual según el loop (un skip sale también de loop one)."""
+        handle = self.current_handle
+        self.current = self.current_handle = self.source = None
+        mode = "off" if skipped and self.loop_mode == "one" else self.loop_mode
+        if handle is None:
+            return
+        if mode == "off":
+            # O(1) por manejador, aunque la cola haya cambiado mientras sonaba
+            if self.queue.remove(handle) is not None:
+                self._journal("remove", h=handle)
+        elif mode == "all" and self.queue.head_handle() == handle:
+            self.queue.rotate()
+            self._journal("rotate")
+
+    async def _play_head(self, gap_start: float | None = None):
+        while self.queue or self._autofill():
+            if not self.vc or not self.vc.is_connected():
+                await self._close()
+                return
+            handle = self.queue.head_handle()
+            if await self._start(self.queue.get(handle), 0, handle=handle, gap_start=gap_start):
+                return
+            # No se pudo reproducir: descartarla y probar la siguiente
+            self.queue.remove(handle)
+            self._journal("remove", h=handle)
+        # Cola vacía y nada que sacar del historial: si aún llega una playlist, esperar; si no, desconectar
+        if not any(not t.done() for t in self.ingest_tasks):
+            await self._close()
+
+    async def _start(self, item: Track, start_seconds: int = 0, announce: bool = True, handle: int | None = None,
+                     gap_start: float | None = None) -> bool:
+        # Sólo el paso natural a la siguiente pista usa la precarga; skip, seek o reinicios la descartan
+        source = self._take_preroll(item, handle) if gap_start is not None and not start_seconds else None
+        self._discard_preroll()
+        if source is None:
+            local = AUDIO_CACHE.lookup(item)
+            try:
+                url, acodec = local or await resolve_stream_url(item, job=ExtractionJob(PRIORITY_INTERACTIVE, self.guild_id))
+            except Exception as e:
+                print(f"[player {self.guild_id}] No se pudo resolver el audio de {item.title}: {e}")
+                return False
+            source = build_audio_source(url, start_seconds, self.volume, acodec, gain_db=LOUDNESS.gain_db(item))
+
+        self._generation += 1
+        if source.frames and gap_start is not None:
+            # Ya empezó a sonar dentro del fundido: no hubo silencio entre las dos
+            TRANSITION_GAP_SECONDS.observe(0.0)
+        else:
+            source.gap_start = gap_start
+        try:
+            self.vc.play(source, after=self._make_after(self._generation, source))
+        except Exception as e:
+            print(f"[player {self.guild_id}] Error al iniciar reproducción: {e}")
+            source.cleanup()
+            return False
+
+        if handle != self.current_handle or item is not self.current:
+            self._recoveries = 0
+            self._started_at = time.time() - start_seconds
+            if LYRICS_PREFETCH:
+                LYRICS.prefetch(item)
+            AUDIO_CACHE.note_play(item, self.loop_mode != "off")
+            try:
+                HISTORY.record(self.guild_id, item, self.last_played)
+            except Exception as e:
+                # El historial es un extra: nunca debe parar la reproducción
+                print(f"[historial] No se pudo anotar {item.title}: {e}")
+            self.last_played = item
+            self.recent.append(item.webpage_url)
+        self.current = item
+        self.current_handle = handle
+        self.source = source
+        self._journal("current", h=handle, p=start_seconds)
+        self._autofill()
+        self._schedule_prefetch()
+        if announce:
+            self._announce()
+        return True
+
+    def _schedule_prefetch(self):
+        """Resuelve en segundo plano la URL de la siguiente pista mientras suena la actual."""
+        nxt = self.upcoming()
+        self._schedule_preroll()
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
+        if nxt is not None:
+            # También si es la misma (loop): así la repetición ya suena normalizada
+            LOUDNESS.schedule(nxt)
+        if not nxt or nxt is self.current or nxt in AUDIO_CACHE:
+            return
+        remaining = max(0, (self.current.duration or 0) - self.source.position) if self.current and self.source else 0
+
+        async def prefetch():
+            try:
+                # Debe seguir siendo válida cuando le toque sonar
+                await resolve_stream_url(nxt, min_valid=remaining + 60, job=ExtractionJob(guild_id=self.guild_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[prefetch] No se pudo precargar {nxt.title}: {e}")
+
+        self.prefetch_task = asyncio.create_task(prefetch())
+
+    def _autofill(self) -> bool:
+        """
+        Autoplay: si después de la pista actual no sonaría nada, añade a la cola la que más suele
+        sonar tras la última en este servidor. Devuelve True si añadió alguna.
+        """
+        if (not self.autoplay or self.last_played is None or self.upcoming() is not None
+                or any(not t.done() for t in self.ingest_tasks)):
+            return False
+        pick = HISTORY.next_track(self.guild_id, self.last_played, exclude=set(self.recent))
+        if pick is None:
+            return False
+        # Aunque luego no se pueda reproducir, que no se vuelva a elegir enseguida
+        self.recent.append(pick.webpage_url)
+        handle = self.queue.append(pick)
+        self._journal("add", h=handle, t=pick.to_dict())
+        return True
+
+    # ---------- precarga de la siguiente pista ----------
+    def _schedule_preroll(self):
+        """Prepara la precarga de la siguiente pista; descarta la que haya si ya no es la siguiente."""
+        nxt = self._upcoming()
+        pre = self.preroll
+        if pre is not None and (nxt is None or pre.handle != nxt[0] or pre.item is not nxt[1]):
+            self._discard_preroll()
+        # Sin duración (directos) no hay final que anticipar
+        if (self.preroll is not None or nxt is None or not PREROLL_SECONDS or self.current is None
+                or not self.current.duration):
+            return
+        pre = self.preroll = Preroll(nxt[1], nxt[0])
+        pre.task = asyncio.create_task(self._warm(pre))
+
+    async def _warm(self, pre: Preroll):
+        # Esperar hasta PREROLL_SECONDS del final (el fundido necesita margen para empezar a tiempo)
+        lead = max(PREROLL_SECONDS, CROSSFADE_SECONDS + 2)
+        while True:
+            if self.source is None or self.current is None:
+                return
+            remaining = (self.current.duration or 0) - self.source.position
+            if remaining <= lead:
+                break
+            await asyncio.sleep(min(remaining - lead, 5))
+
+        try:
+            # Si se está midiendo su sonoridad, mejor lanzar ffmpeg ya con la ganancia buena
+            await LOUDNESS.settle(pre.item, lead / 2)
+            url, acodec = AUDIO_CACHE.lookup(pre.item) or await resolve_stream_url(
+                pre.item, min_valid=lead + 60, job=ExtractionJob(guild_id=self.guild_id))
+            pre.volume = self.volume
+            source = pre.source = build_audio_source(url, 0, pre.volume, acodec, gain_db=LOUDNESS.gain_db(pre.item))
+            primed = await asyncio.to_thread(source.prime, PREROLL_FRAMES)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[preroll] No se pudo precargar {pre.item.title}: {e}")
+            primed = False
+        if not primed:
+            # La transición lanzará ffmpeg en frío, como sin precarga
+            if pre.source is not None:
+                pre.source.cleanup()
+                pre.source = None
+            return
+        current = self.source
+        if (CROSSFADE_SECONDS > 0 and self.preroll is pre and current is not None and self.current is not None
+                and not current.is_opus() and not source.is_opus()):
+            current.fade = (source, self.current.duration - CROSSFADE_SECONDS, CROSSFADE_SECONDS)
+
+    def _take_preroll(self, item: Track, handle: int | None) -> TrackedSource | None:
+        """
+        La fuente precargada de `item`, si ya está lista y admite el volumen actual. Si la sonoridad
+        se midió después de lanzarla suena esta vez sin normalizar: mejor eso que un hueco.
+        """
+        pre = self.preroll
+        if pre is None or pre.item is not item or pre.handle != handle:
+            return None
+        if not pre.task.done():
+            # Aún esperando su turno o arrancando ffmpeg (puede tardar segundos): el llamante la
+            # descarta y arranca en frío en vez de esperarla
+            return None
+        source = pre.source
+        if source is None:
+            return None
+        if pre.volume != self.volume and not source.set_volume(self.volume):
+            return None
+        self.preroll = None
+        PREROLL_COUNTS["used"] += 1
+        return source
+
+    def _discard_preroll(self):
+        """Cancela la precarga y mata su ffmpeg (skip, seek, /clearqueue, cambio de loop...)."""
+        pre, self.preroll = self.preroll, None
+        if pre is None:
+            return
+        if pre.task is not None:
+            pre.task.cancel()
+        if self.source is not None and self.source.fade is not None and self.source.fade[0] is pre.source:
+            self.source.fade = None
+        if pre.source is not None:
+            pre.source.cleanup()
+            PREROLL_COUNTS["discarded"] += 1
+
+    def _announce(self):
+        """Pide actualizar el "Ahora suena"; lo que se muestra es la pista que suene al enviarlo."""
+        if self.channel is not None:
+            OUTBOX.post(self.channel.id, ("now_playing", self), self._update_now_playing)
+
+    async def _update_now_playing(self):
+        item = self.current
+        if item is not None:
+            embed = discord.Embed(
+                title="🎵 Ahora suena",
+                description=f"[{item.title}]({item.webpage_url})",
+                color=0x1DB954
+            )
+            embed.add_field(name="Artista", value=item.artist, inline=True)
+            embed.add_field(name="Duración", value=format_duration(item.duration), inline=True)
+            if item.thumbnail:
+                embed.set_thumbnail(url=item.thumbnail)
+        elif self.now_playing is not None:
+            embed = discord.Embed(title="⏹️ Reproducción terminada", color=0x99AAB5)
+        else:
+            return
+        # Un único mensaje por reproductor: se edita en cada cambio de pista
+        if self.now_playing is not None:
+            try:
+                await self.now_playing.edit(embed=embed)
+                return
+            except discord.NotFound:
+                self.now_playing = None
+        if item is not None and self.channel is not None:
+            self.now_playing = await self.channel.send(embed=embed)
+
+    async def _close(self):
+        """Desconecta y olvida el estado del servidor; el próximo /play crea un reproductor nuevo."""
+        self._closed = True
+        self._generation += 1
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+        self._discard_preroll()
+        self.cancel_ingest()
+        self.current = self.current_handle = None
+        self.source = None
+        if self.now_playing is not None:
+            self._announce()
+        if PLAYERS.get(self.guild_id) is self:
+            PLAYERS.pop(self.guild_id, None)
+            self._journal("drop")
+        try:
+            if self.vc:
+                await self.vc.disconnect()
+        except Exception:
+            pass
+
+def get_player(guild_id: str) -> GuildPlayer:
+    player = PLAYERS.get(guild_id)
+    if player is None:
+        player = PLAYERS[guild_id] = GuildPlayer(guild_id)
+    return player
+
+async def live_player(interaction: discord.Interaction, player: GuildPlayer) -> GuildPlayer | None:
+    """
+    El reproductor vigente del servidor tras una espera larga: si mientras tanto se cerró
+    (inactividad, desconexión) se crea otro y se vuelve a conectar al canal del usuario.
+    None si ya no hay canal al que volver.
+    """
+    if PLAYERS.get(player.guild_id) is player:
+        return player
+    vc = interaction.guild.voice_client
+    if vc is None or not vc.is_connected():
+        if interaction.user.voice is None:
+            return None
+        vc = await interaction.user.voice.channel.connect()
+    player = get_player(player.guild_id)
+    player.attach(vc, interaction.channel)
+    return player
+
+# =========================
+# PERSISTENCIA DE COLAS
+# =========================
+class StateStore(ABC):
+    """
+    Interfaz de los almacenes del estado de las colas (cola, pista actual, loop, volumen y canales).
+
+    GuildPlayer anuncia cada cambio con record() sin esperar a nada; persistence_loop llama a flush()
+    cada QUEUE_FLUSH_INTERVAL segundos y al apagar se llama a close() con el estado vivo. load()
+    devuelve el estado guardado de todos los servidores; cada proceso se queda con los suyos.
+    """
+    closed = False
+
+    @abstractmethod
+    def record(self, guild_id: str, op: str, **data):
+        ...
+
+    @abstractmethod
+    async def load(self) -> dict[str, dict]:
+        ...
 
-from datetime import timedelta
+    def needs_snapshot(self) -> bool:
+        return False
 
-# =========================
-# CARGA DE CONFIGURACIÓN
-# =========================
-load_dotenv()
-TOKEN = os.getenv("DISCORD_TOKEN")
-SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
-SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+    @abstractmethod
+    async def flush(self, guilds: dict | None = None):
+        ...
 
-# Opcional para Last.fm (para /lastfm)
-LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")   # Recomendado
-LASTFM_USER = os.getenv("LASTFM_USER")         # Recomendado
+    @abstractmethod
+    async def close(self, guilds: dict):
+        ...
 
-# Ruta estática a FFmpeg (ajústala a tu sistema)
-FFMPEG_PATH = ffmpeg.get_ffmpeg_exe()
+class QueueJournal(StateStore):
+    """
+    Diario append-only de cambios en las colas (una línea JSON por cambio) más una instantánea
+    compactada del estado completo, para sobrevivir a reinicios y caídas.
 
-# Aviso si la ruta no existe (no bloquea la ejecución)
-if not os.path.isfile(FFMPEG_PATH):
-    print(f"[AVISO] No se encontró FFmpeg en: {FFMPEG_PATH}. Verifica la ruta o ponlo en el PATH.")
+    - record() sólo añade al búfer en memoria: persistence_loop lo vuelca al disco en un hilo
+      cada QUEUE_FLUSH_INTERVAL segundos, así que los comandos no esperan al disco.
+    - Cada registro lleva un número de secuencia y la instantánea guarda el último que incluye:
+      un corte entre escribir la instantánea y vaciar el diario no aplica nada dos veces.
+    - Al cargar se descarta una última línea a medias (corte en plena escritura) y el diario se
+      corta ahí, para que lo que se añada después no quede pegado a ella.
 
-# =========================
-# CLIENTES EXTERNOS
-# =========================
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyClientCredentials
+    Estado por servidor: {"queue": [[manejador, pista], ...], "current", "position", "loop",
+    "volume", "autoplay", "voice", "text"}.
+    Los manejadores son los de TrackQueue en el proceso que escribió.
+    """
 
-# Inicialización de Spotify con credenciales desde variables de entorno
-spotify = Spotify(auth_manager=SpotifyClientCredentials(
-    client_id=os.getenv("SPOTIPY_CLIENT_ID"),
-    client_secret=os.getenv("SPOTIPY_CLIENT_SECRET")
-))
-# =========================
-# ESTRUCTURAS DE ESTADO
-# =========================
-# Cola por servidor: deque de dicts con metadata completa de la pista
-# { url, title, webpage_url, duration, thumbnail, artist }
-SONG_QUEUES: dict[str, deque] = {}
+    def __init__(self, journal_path: str, snapshot_path: str):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.closed = False
+        self._buffer: list[str] = []
+        self._io_lock = threading.Lock()
 
-# Modo de loop por servidor: "off" | "one" | "all"
-LOOP_MODE: dict[str, str] = {}
+    def record(self, guild_id: str, op: str, **data):
+        if self.closed:
+            return
+        self.seq += 1
+        data.update(s=self.seq, g=guild_id, op=op)
+        self._buffer.append(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
 
-# Volumen actual por servidor (0.0 - 1.0)
-VOLUME: dict[str, float] = {}
+    @staticmethod
+    def _apply(state: dict, rec: dict):
+        guild_id, op = rec["g"], rec["op"]
+        if op == "drop":
+            state.pop(guild_id, None)
+            return
+        st = state.setdefault(guild_id, {"queue": [], "current": None, "position": 0, "loop": "off",
+                                         "volume": 0.5, "autoplay": False, "voice": None, "text": None})
+        queue = st["queue"]
+        if op == "add":
+            queue.append([rec["h"], rec["t"]])
+        elif op in ("remove", "move"):
+            index = next((i for i, (h, _) in enumerate(queue) if h == rec["h"]), None)
+            if index is not None:
+                entry = queue.pop(index)
+                if op == "move":
+                    queue.insert(max(0, rec["to"]), entry)
+        elif op == "order":
+            by_handle = dict(queue)
+            st["queue"] = [[h, by_handle[h]] for h in rec["hs"] if h in by_handle]
+        elif op == "rotate":
+            if queue:
+                queue.append(queue.pop(0))
+        elif op == "clear":
+            queue.clear()
+        elif op in ("current", "position"):
+            st["current"], st["position"] = rec["h"], rec["p"]
+        elif op == "loop":
+            st["loop"] = rec["m"]
+        elif op == "volume":
+            st["volume"] = rec["v"]
+        elif op == "autoplay":
+            st["autoplay"] = rec["on"]
+        elif op == "channels":
+            st["voice"], st["text"] = rec["vc"], rec["tc"]
 
-# Canción actual por servidor (dict con la misma forma que los items de la cola)
-CURRENT_SONG: dict[str, dict] = {}
+    async def load(self) -> dict[str, dict]:
+        return self._read()
 
-# =========================
-# BOT
-# =========================
-intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+    def _read(self) -> dict[str, dict]:
+        """Reconstruye el estado guardado: instantánea + registros posteriores del diario."""
+        state, seq = {}, 0
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            state, seq = snapshot["guilds"], snapshot["seq"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            print(f"[persistencia] Instantánea ilegible, se ignora: {e}")
 
-# =========================
-# UTILIDADES
-# =========================
-async def search_ytdlp_async(query, ydl_opts):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _extract(query, ydl_opts))
+        try:
+            with open(self.journal_path, "r+b") as f:
+                good = 0   # bytes hasta el final de la última línea completa y legible
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if rec["s"] > seq:
+                        self._apply(state, rec)
+                        seq = rec["s"]
+                # Cortar el resto: lo que se añada después no debe quedar pegado a una línea a medias
+                if good < f.seek(0, os.SEEK_END):
+                    print(f"[persistencia] Diario cortado a {good} bytes (última escritura incompleta)")
+                    f.truncate(good)
+        except FileNotFoundError:
+            pass
+        self.seq = self.snapshot_seq = seq
+        return state
 
-def _extract(query, ydl_opts):
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return ydl.extract_info(query, download=False)
+    def _write(self, lines: list[str], snapshot: dict | None):
+        with self._io_lock:
+            if snapshot is not None:
+                tmp = ensure_parent_dir(self.snapshot_path) + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.snapshot_path)
+                # Todo lo anterior ya está en la instantánea
+                open(ensure_parent_dir(self.journal_path), "w").close()
+            if lines:
+                with open(ensure_parent_dir(self.journal_path), "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
 
-def format_duration(seconds: int | float | None) -> str:
-    if seconds is None:
-        return "Desconocido"
-    try:
-        seconds = int(seconds)
-        return str(timedelta(seconds=seconds))
-    except Exception:
-        return "Desconocido"
+    def _take(self, guilds: dict | None) -> tuple[list[str], dict | None]:
+        lines, self._buffer = self._buffer, []
+        if guilds is None:
+            return lines, None
+        # La instantánea se construye ahora mismo e incluye todo lo registrado hasta aquí
+        self.snapshot_seq = self.seq
+        return [], {"seq": self.seq, "guilds": guilds}
 
-def make_queue_item(from_info: dict) -> dict:
-    """Convierte la info cruda de yt_dlp en un objeto estándar para la cola."""
-    return {
-        "url": from_info.get("url"),
-        "title": from_info.get("title", "Sin título"),
-        "webpage_url": from_info.get("webpage_url", from_info.get("original_url", from_info.get("url", ""))),
-        "duration": from_info.get("duration"),
-        "thumbnail": from_info.get("thumbnail", ""),
-        "artist": from_info.get("uploader") or from_info.get("artist") or "Desconocido",
-    }
-
-def get_spotify_playlist_tracks(playlist_id: str):
-    tracks = []
-    response = spotify.playlist_items(playlist_id, additional_types=['track'], limit=100)
-    tracks.extend(response['items'])
-    while response['next']:
-        response = spotify.next(response)
-        tracks.extend(response['items'])
-    return tracks
+    def needs_snapshot(self) -> bool:
+        return self.seq != self.snapshot_seq
 
-# =========================
-# EVENTOS
-# =========================
-@bot.event
-async def on_ready():
-    await bot.tree.sync()
-    print(f"{bot.user} is online!")
+    async def flush(self, guilds: dict | None = None):
+        """Vuelca el búfer al diario o, si se pasa el estado completo, escribe una instantánea."""
+        lines, snapshot = self._take(guilds)
+        if not lines and snapshot is None:
+            return
+        try:
+            await asyncio.to_thread(self._write, lines, snapshot)
+        except OSError as e:
+            print(f"[persistencia] Error al escribir: {e}")
+            # Forzar una instantánea completa en la próxima vuelta para no perder lo del búfer
+            self.snapshot_seq = -1
 
-# =========================
-# REPRODUCCIÓN
-# =========================
-async def start_playback(vc: discord.VoiceClient, guild_id: str, channel: discord.abc.Messageable, start_seconds: int = 0):
+    async def close(self, guilds: dict):
+        """Instantánea final síncrona; lo que se registre después (desconexiones) se descarta."""
+        self._write(*self._take(guilds))
+        self.closed = True
+
+class MemoryStateStore(StateStore):
     """
-    Inicia/reinicia la reproducción de la canción actual (CURRENT_SONG[guild_id])
-    con soporte de 'after' para encadenar a la siguiente canción y respetar el loop.
+    Estado en memoria, mantenido con los mismos registros que el diario (QueueJournal._apply).
+    No sobrevive a un reinicio; sirve para pruebas y de base a RedisStateStore.
     """
-    current = CURRENT_SONG.get(guild_id)
-    if not current:
-        # Si no hay actual, intenta tomar de la cola
-        if SONG_QUEUES.get(guild_id):
-            CURRENT_SONG[guild_id] = SONG_QUEUES[guild_id][0]
-            current = CURRENT_SONG[guild_id]
-        else:
-            # Nada que reproducir
-            try:
-                if vc:
-                    await vc.disconnect()
-            except Exception:
-                pass
-            SONG_QUEUES[guild_id] = deque()
-            CURRENT_SONG.pop(guild_id, None)
-            VOLUME.pop(guild_id, None)
-            LOOP_MODE[guild_id] = "off"
+
+    def __init__(self):
+        self.state: dict[str, dict] = {}
+        self.closed = False
+        self._dirty: set[str] = set()
+        self._dirty_positions: set[str] = set()
+
+    def record(self, guild_id: str, op: str, **data):
+        if self.closed:
             return
+        data.update(g=guild_id, op=op)
+        QueueJournal._apply(self.state, data)
+        # La posición cambia cada pocos segundos: se guarda aparte para no reescribir colas largas
+        (self._dirty_positions if op in ("current", "position") else self._dirty).add(guild_id)
 
-    url = current["url"]
-    volume = VOLUME.get(guild_id, 0.5)
+    async def load(self) -> dict[str, dict]:
+        return json.loads(json.dumps(self.state))
 
-    before = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
-    if start_seconds and start_seconds > 0:
-        before = f"-ss {int(start_seconds)} " + before
+    async def flush(self, guilds: dict | None = None):
+        self._dirty.clear()
+        self._dirty_positions.clear()
+
+    async def close(self, guilds: dict):
+        self.closed = True
+
+class RedisError(Exception):
+    pass
 
-    def after(error):
-        if error:
-            print(f"[after] Error en reproducción: {error}")
+class RedisConnection:
+    """Cliente RESP mínimo sobre una sola conexión: lo justo para RedisStateStore (comandos en tubería)."""
 
-        # Al finalizar, mover cola según loop
-        mode = LOOP_MODE.get(guild_id, "off")
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.username = unquote(parts.username) if parts.username else None
+        self.db = int(parts.path.strip("/") or 0)
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(out)
+
+    async def _reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Conexión con Redis cerrada")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            return RedisError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            return None if size < 0 else (await self._reader.readexactly(size + 2))[:-2]
+        if kind == b"*":
+            size = int(body)
+            return None if size < 0 else [await self._reply() for _ in range(size)]
+        raise RedisError(f"Respuesta RESP desconocida: {line!r}")
+
+    async def _send(self, commands: list) -> list:
+        self._writer.write(b"".join(self._encode(c) for c in commands))
+        await self._writer.drain()
+        replies = [await self._reply() for _ in commands]
+        error = next((r for r in replies if isinstance(r, RedisError)), None)
+        if error is not None:
+            raise error
+        return replies
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
         try:
-            if mode == "off":
-                # Sacar la actual
-                if SONG_QUEUES.get(guild_id):
-                    try:
-                        # Si la actual coincide con el primer elemento, popleft.
-                        if SONG_QUEUES[guild_id] and SONG_QUEUES[guild_id][0] is current:
-                            SONG_QUEUES[guild_id].popleft()
-                        else:
-                            # Si no coincide, aún así intentamos remover por igualdad.
-                            if current in SONG_QUEUES[guild_id]:
-                                SONG_QUEUES[guild_id].remove(current)
-                    except Exception:
-                        pass
-            elif mode == "all":
-                # Rotar (mover la primera al final)
-                if SONG_QUEUES.get(guild_id) and len(SONG_QUEUES[guild_id]) > 0:
-                    SONG_QUEUES[guild_id].rotate(-1)
-            elif mode == "one":
-                # No mover la cola; dejamos la misma canción en cabeza
+            if setup:
+                await self._send(setup)
+        except RedisError:
+            await self.close()
+            raise
+
+    async def execute(self, *commands) -> list:
+        """Envía todos los comandos de una vez y devuelve sus respuestas en orden."""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._send(list(commands))
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                # Tras un fallo la conexión puede haber quedado a medio leer: se abre otra la próxima vez
+                await self.close()
+                raise
+
+    async def close(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ConnectionError):
                 pass
-        except Exception as e:
-            print(f"[after] Error gestionando loop/cola: {e}")
 
-        # Llamar recursivo a play_next
-        fut = asyncio.run_coroutine_threadsafe(play_next(vc, guild_id, channel), bot.loop)
+class RedisStateStore(MemoryStateStore):
+    """
+    Estado compartido en Redis (o compatible): un hash con el estado de cada servidor y otro con
+    su pista actual y posición. Cualquier proceso puede retomar un servidor al cambiar el reparto
+    de shards. Cada flush escribe, en una tubería, sólo los servidores que cambiaron.
+    """
+
+    def __init__(self, url: str, key: str):
+        super().__init__()
+        self.key = key
+        self.positions_key = f"{key}:positions"
+        self.redis = RedisConnection(url)
+
+    async def load(self) -> dict[str, dict]:
+        try:
+            states, positions = await self.redis.execute(("HGETALL", self.key), ("HGETALL", self.positions_key))
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, RedisError) as e:
+            print(f"[persistencia] No se pudo leer el estado de Redis: {e}")
+            return {}
+        saved = {}
+        for raw_id, raw in zip(states[::2], states[1::2]):
+            saved[raw_id.decode()] = json.loads(raw)
+        for raw_id, raw in zip(positions[::2], positions[1::2]):
+            if raw_id.decode() in saved:
+                saved[raw_id.decode()].update(json.loads(raw))
+        return saved
+
+    async def flush(self, guilds: dict | None = None):
+        dirty, self._dirty = self._dirty, set()
+        moved, self._dirty_positions = self._dirty_positions, set()
+        commands = []
+        for guild_id in dirty:
+            st = self.state.get(guild_id)
+            commands.append(("HSET", self.key, guild_id, json.dumps(st, ensure_ascii=False, separators=(",", ":")))
+                            if st is not None else ("HDEL", self.key, guild_id))
+        for guild_id in moved | dirty:
+            st = self.state.get(guild_id)
+            commands.append(("HSET", self.positions_key, guild_id, json.dumps({"current": st["current"], "position": st["position"]}))
+                            if st is not None else ("HDEL", self.positions_key, guild_id))
+        if not commands:
+            return
+        try:
+            await self.redis.execute(*commands)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, RedisError) as e:
+            print(f"[persistencia] Error al escribir en Redis: {e}")
+            # Se reintenta en la próxima vuelta con el estado de entonces
+            self._dirty |= dirty
+            self._dirty_positions |= moved
+
+    async def close(self, guilds: dict):
+        # El estado vivo trae la posición exacta del momento del apagado
+        for guild_id, st in guilds.items():
+            self.state[guild_id] = st
+            self._dirty.add(guild_id)
+        await self.flush()
+        self.closed = True
+        await self.redis.close()
+
+def make_state_store() -> StateStore:
+    if STATE_STORE_BACKEND == "redis":
+        return RedisStateStore(REDIS_URL, REDIS_STATE_KEY)
+    if STATE_STORE_BACKEND == "memory":
+        return MemoryStateStore()
+    return QueueJournal(QUEUE_JOURNAL_PATH, QUEUE_SNAPSHOT_PATH)
+
+STATE_STORE = make_state_store()
+PERSISTENCE_TASK: asyncio.Task | None = None
+
+def live_queue_state() -> dict[str, dict]:
+    return {guild_id: player.snapshot() for guild_id, player in PLAYERS.items()}
+
+async def persistence_loop():
+    last_snapshot = last_position = time.monotonic()
+    while True:
+        await asyncio.sleep(QUEUE_FLUSH_INTERVAL)
+        now = time.monotonic()
+        if now - last_position >= QUEUE_POSITION_INTERVAL:
+            last_position = now
+            for player in list(PLAYERS.values()):
+                player.save_position()
+        if now - last_snapshot >= QUEUE_SNAPSHOT_INTERVAL and STATE_STORE.needs_snapshot():
+            last_snapshot = now
+            await STATE_STORE.flush(live_queue_state())
+        else:
+            await STATE_STORE.flush()
+
+async def start_queue_persistence():
+    global PERSISTENCE_TASK, SAVED_QUEUES
+    # Con varios procesos cada uno retoma sólo los servidores de sus shards
+    SAVED_QUEUES = {guild_id: st for guild_id, st in (await STATE_STORE.load()).items() if owns_guild(guild_id)}
+    PERSISTENCE_TASK = asyncio.create_task(persistence_loop())
+
+async def stop_queue_persistence():
+    if PERSISTENCE_TASK is None or STATE_STORE.closed:
+        return
+    PERSISTENCE_TASK.cancel()
+    try:
+        await STATE_STORE.close(live_queue_state())
+    except OSError as e:
+        print(f"[persistencia] Error al guardar las colas: {e}")
+
+async def restore_players():
+    """Vuelve a los canales de voz guardados y retoma cada cola en su pista y posición."""
+    global SAVED_QUEUES
+    saved, SAVED_QUEUES = SAVED_QUEUES, {}
+    # Los manejadores cambian al reconstruir las colas: cada servidor se vuelve a registrar desde cero
+    for guild_id in saved:
+        STATE_STORE.record(guild_id, "drop")
+
+    async def restore(guild_id: str, state: dict):
+        guild = bot.get_guild(int(guild_id))
+        voice = guild.get_channel(state["voice"]) if guild and state.get("voice") else None
+        if voice is None or not state.get("queue"):
+            return
         try:
-            fut.result()
+            vc = guild.voice_client or await voice.connect()
         except Exception as e:
-            print(f"[after] Error al continuar reproducción: {e}")
+            print(f"[persistencia] No se pudo volver a {voice} en {guild}: {e}")
+            return
+        player = get_player(guild_id)
+        player.attach(vc, guild.get_channel(state["text"]) if state.get("text") else None)
+        player.restore(state)
+        print(f"[persistencia] Restaurada la cola de {guild} ({len(state['queue'])} canciones)")
+
+    await asyncio.gather(*(restore(g, st) for g, st in saved.items()))
+
+# =========================
+# IMPORTACIÓN DE PLAYLISTS
+# =========================
+# Listados de Spotify que se importan enteros: tipo de enlace → (nombre en los mensajes, método de SPOTIFY)
+SPOTIFY_COLLECTIONS = {
+    "playlist": ("la playlist", "playlist_tracks"),
+    "album": ("el álbum", "album_tracks"),
+    "artist": ("las canciones más populares del artista", "artist_top_tracks"),
+}
+
+async def ingest_spotify(interaction: discord.Interaction, player: GuildPlayer, kind: str, spotify_id: str, ydl_opts: dict, previous: set[asyncio.Task]):
+    """
+    Resuelve las pistas de una playlist, álbum o artista de Spotify en paralelo (hasta
+    SPOTIFY_PLAYLIST_CONCURRENCY búsquedas a la vez) y las añade a la cola en su orden conforme
+    van llegando. La reproducción arranca en cuanto la primera pista está lista y el progreso
+    se muestra editando un único mensaje.
+    """
+    name, method = SPOTIFY_COLLECTIONS[kind]
+    progress = await interaction.followup.send(f"⏳ Cargando {name} de Spotify...", wait=True)
+
+    def edit_progress(content: str):
+        # Sólo cuenta la última: las intermedias que no dio tiempo a enviar se descartan
+        OUTBOX.post(interaction.channel_id, ("progress", progress), lambda: progress.edit(content=content))
 
-    # Construir la fuente de audio y reproducir
     try:
-        # 🔧 Cambio clave: options="-vn" (sin forzar libopus)
-        source = discord.FFmpegPCMAudio(
-            url,
-            executable=FFMPEG_PATH,
-            before_options=before,
-            options="-vn"
-        )
-        vc.play(discord.PCMVolumeTransformer(source, volume=volume), after=after)
+        items = await SPOTIFY_LOOKUPS.run(f"{kind}:{spotify_id}", lambda: getattr(SPOTIFY, method)(spotify_id))
     except Exception as e:
-        print(f"[start_playback] Error al iniciar reproducción: {e}")
-        # Intentar saltar a la siguiente
-        fut = asyncio.run_coroutine_threadsafe(play_next(vc, guild_id, channel), bot.loop)
-        try:
-            fut.result()
-        except Exception as er:
-            print(f"[start_playback] Error al encadenar: {er}")
+        edit_progress(f"Error al procesar {name} de Spotify: {e}")
+        return
+
+    tracks = [track for track in items if track and track.get('artists')]
+    total = len(tracks)
+    if total == 0:
+        edit_progress(f"No hay canciones reproducibles en {name} de Spotify.")
         return
 
-    # Enviar Embed "Ahora suena"
+    sem = asyncio.Semaphore(SPOTIFY_PLAYLIST_CONCURRENCY)
+    job = ExtractionJob(PRIORITY_BULK, str(interaction.guild_id), interaction.user.id)
+
+    async def resolve(track: dict):
+        query = spotify_query(track)
+        keys = [f"sp:{track['id']}"] if track.get("id") else []
+        keys.append(query_cache_key(query))
+        async with sem:
+            try:
+                return await resolve_item(keys, ydl_opts, lambda: match_spotify_track(track, job), job)
+            except Exception:
+                return None
+
+    # El semáforo despierta a las tareas en orden de creación, así que la resolución
+    # avanza aproximadamente en el orden de la playlist.
+    pending = [asyncio.create_task(resolve(t)) for t in tracks]
+    added = failed = 0
+    last_edit = 0.0
+    loop = asyncio.get_running_loop()
     try:
-        embed = discord.Embed(
-            title="🎵 Ahora suena",
-            description=f"[{current['title']}]({current['webpage_url']})",
-            color=0x1DB954
-        )
-        embed.add_field(name="Artista", value=current["artist"], inline=True)
-        embed.add_field(name="Duración", value=format_duration(current["duration"]), inline=True)
-        if current.get("thumbnail"):
-            embed.set_thumbnail(url=current["thumbnail"])
-        await channel.send(embed=embed)
-    except Exception as e:
-        print(f"[start_playback] Error al enviar embed: {e}")
+        # Si ya había otra playlist cargándose, sus pistas van primero
+        waiting = [t for t in previous if not t.done()]
+        if waiting:
+            await asyncio.wait(waiting)
+
+        for task in pending:
+            item = await task
+            if item is None:
+                failed += 1
+            else:
+                player.enqueue(item)
+                added += 1
+
+            # Limitar las ediciones del mensaje para no chocar con los rate limits de Discord
+            now = loop.time()
+            if now - last_edit >= 2.0:
+                last_edit = now
+                edit_progress(f"⏳ Cargando {name} de Spotify: {added + failed}/{total} (✅ {added})")
+
+        summary = f"✅ Añadidas {added} canciones desde {name} de Spotify."
+        if failed:
+            summary += f" ({failed} sin resultado)"
+        edit_progress(summary)
+    except asyncio.CancelledError:
+        edit_progress(f"🛑 Importación cancelada ({added}/{total} añadidas).")
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+        player.ingest_tasks.discard(asyncio.current_task())
+        # Si la cola se vació esperando a esta playlist, que el reproductor decida si desconectar
+        player.kick()
 
-async def play_next(vc: discord.VoiceClient, guild_id: str, channel: discord.abc.Messageable):
+YOUTUBE_PLAYLIST_RE = re.compile(r"(?:youtube\.com|youtu\.be)/\S*[?&]list=([A-Za-z0-9_-]+)")
+
+def is_youtube_playlist(url: str) -> bool:
     """
-    Obtiene el siguiente elemento que debería sonar (según el loop) y llama a start_playback.
+    Enlace a una playlist o mix para importar entera: /playlist?list=... o un list= sin vídeo.
+    Un vídeo abierto desde una playlist (watch?v=...&list=...) es ese vídeo, como en YouTube.
     """
-    # Si la cola está vacía, desconectarse y limpiar
-    if not SONG_QUEUES.get(guild_id) or len(SONG_QUEUES[guild_id]) == 0:
-        try:
-            if vc:
-                await vc.disconnect()
-        except Exception:
-            pass
-        SONG_QUEUES[guild_id] = deque()
-        CURRENT_SONG.pop(guild_id, None)
-        VOLUME.pop(guild_id, None)
-        LOOP_MODE[guild_id] = "off"
-        return
+    if not YOUTUBE_PLAYLIST_RE.search(url):
+        return False
+    return "/playlist?" in url or not YOUTUBE_ID_RE.search(url)
+# Tramos de la lectura plana: el primero es una sola página de YouTube y cada siguiente dobla el anterior
+YOUTUBE_PLAYLIST_FIRST_CHUNK = 100
+YOUTUBE_PLAYLIST_MAX_CHUNK = 400
+# Entradas que la playlist lista pero no se pueden reproducir
+UNAVAILABLE_VIDEO_TITLES = {"[Private video]", "[Deleted video]", "[Unavailable video]"}
+
+def flat_queue_item(entry: dict) -> Track:
+    """Item de cola a partir de una entrada plana de playlist (la URL de audio se resuelve al acercarse a la cabeza)."""
+    video_id = entry["id"]
+    return Track(
+        id=video_id,
+        title=entry.get("title") or "Sin título",
+        webpage_url=f"https://www.youtube.com/watch?v={video_id}",
+        duration=int(entry["duration"]) if entry.get("duration") else None,
+        thumbnail=f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+        artist=entry.get("channel") or entry.get("uploader") or "Desconocido",
+    )
+
+async def ingest_youtube_playlist(interaction: discord.Interaction, player: GuildPlayer, url: str, previous: set[asyncio.Task]):
+    """
+    Importa una playlist o mix de YouTube leyéndola en plano por tramos crecientes
+    (playlist_items), así que cada tramo es una llamada corta al pool de extracción y la
+    primera página ya está en la cola en lo que tarda una búsqueda. Los vídeos se encolan
+    sin resolver: la URL de audio se pide al llegar a la cabeza (resolve_stream_url y la precarga).
+    """
+    progress = await interaction.followup.send("⏳ Cargando playlist de YouTube...", wait=True)
+
+    def edit_progress(content: str):
+        # Sólo cuenta la última: las intermedias que no dio tiempo a enviar se descartan
+        OUTBOX.post(interaction.channel_id, ("progress", progress), lambda: progress.edit(content=content))
+
+    name = "la playlist de YouTube"
+    job = ExtractionJob(PRIORITY_BULK, str(interaction.guild_id), interaction.user.id)
+    added = skipped = 0
+    first, size = 1, YOUTUBE_PLAYLIST_FIRST_CHUNK
+    waiting = [t for t in previous if not t.done()]
+    try:
+        while first <= YOUTUBE_PLAYLIST_MAX_ENTRIES:
+            last = min(first + size - 1, YOUTUBE_PLAYLIST_MAX_ENTRIES)
+            try:
+                info = await search_ytdlp_async(url, YDL_FLAT_OPTIONS, {"playlist_items": f"{first}-{last}"}, job)
+            except Exception as e:
+                if added == 0:
+                    edit_progress(f"Error al procesar la playlist de YouTube: {e}")
+                    return
+                print(f"[ingest] Playlist {url} cortada en {first}: {e}")
+                break
+            info = info or {}
+            if info.get("title"):
+                name = f"**{info['title']}**"
+            entries = info.get("entries") or []
+
+            # Si ya había otra playlist cargándose, sus pistas van primero
+            if waiting:
+                await asyncio.wait(waiting)
+                waiting = []
+            for entry in entries:
+                if not entry or not entry.get("id") or entry.get("title") in UNAVAILABLE_VIDEO_TITLES:
+                    skipped += 1
+                    continue
+                player.enqueue(flat_queue_item(entry))
+                added += 1
 
-    # La canción "actual" debe ser el primer elemento de la cola
-    CURRENT_SONG[guild_id] = SONG_QUEUES[guild_id][0]
-    # Iniciar reproducción desde 0s
-    await start_playback(vc, guild_id, channel, start_seconds=0)
+            # Un tramo incompleto es el final de la playlist
+            if len(entries) < last - first + 1:
+                break
+            edit_progress(f"⏳ Cargando {name}: {added} canciones...")
+            first, size = last + 1, min(size * 2, YOUTUBE_PLAYLIST_MAX_CHUNK)
+
+        if added == 0:
+            edit_progress("La playlist de YouTube no tiene vídeos reproducibles.")
+            return
+        summary = f"✅ Añadidas {added} canciones desde {name}."
+        if skipped:
+            summary += f" ({skipped} no disponibles)"
+        if first > YOUTUBE_PLAYLIST_MAX_ENTRIES:
+            summary += f" (límite de {YOUTUBE_PLAYLIST_MAX_ENTRIES})"
+        edit_progress(summary)
+    except asyncio.CancelledError:
+        edit_progress(f"🛑 Importación cancelada ({added} añadidas).")
+        raise
+    finally:
+        player.ingest_tasks.discard(asyncio.current_task())
+        # Si la cola se vació esperando a esta playlist, que el reproductor decida si desconectar
+        player.kick()
 
 # =========================
 # COMANDOS
@@ -251,142 +3843,160 @@ async def play_next(vc: discord.VoiceClient, guild_id: str, channel: discord.abc
 @app_commands.describe(song_query="Search term or URL from YouTube, Spotify, or SoundCloud")
 async def play(interaction: discord.Interaction, song_query: str):
     await interaction.response.defer()
+    if interaction.guild.voice_client is None and interaction.user.voice is None:
+        await interaction.followup.send("¡Debes estar en un canal de voz para reproducir música!")
+        return
+    link = SPOTIFY_URL_RE.search(song_query) if "open.spotify.com" in song_query else None
+    if "open.spotify.com" in song_query and not link:
+        await interaction.followup.send("Enlace de Spotify no soportado: usa uno de canción, playlist, álbum o artista.")
+        return
+
+    # Una ficha por comando válido y con plazo: si el pool no va a poder a tiempo, se avisa en vez de dejarla colgada
+    job = interactive_job(interaction)
+    try:
+        EXTRACTION_SCHEDULER.admit(job)
+    except ExtractionRejected as e:
+        await interaction.followup.send(f"⏳ {e}")
+        return
 
     # Conectar/encaminar al canal de voz
     if interaction.guild.voice_client is None:
-        if interaction.user.voice is None:
-            await interaction.followup.send("¡Debes estar en un canal de voz para reproducir música!")
-            return
         vc = await interaction.user.voice.channel.connect()
     else:
         vc = interaction.guild.voice_client
         if interaction.user.voice and vc.channel != interaction.user.voice.channel:
             await vc.move_to(interaction.user.voice.channel)
 
-    ydl_options = {
-        "format": "bestaudio[abr<=96]/bestaudio",
-        "noplaylist": True,
-        "cookiefile": "cookies.txt",
-    }
-
+    ydl_options = YDL_OPTIONS
 
     guild_id = str(interaction.guild_id)
-    SONG_QUEUES.setdefault(guild_id, deque())
-    LOOP_MODE.setdefault(guild_id, "off")
-    VOLUME.setdefault(guild_id, 0.5)
+    player = get_player(guild_id)
+    player.attach(vc, interaction.channel)
+
+    # Soporte Spotify (canción, playlist, álbum o artista)
+    if link:
+        kind, spotify_id = link.groups()
 
-    # Soporte Spotify (track o playlist)
-    if "open.spotify.com" in song_query:
         # Track individual
-        if "/track/" in song_query:
-            track_id = re.search(r"track/([a-zA-Z0-9]+)", song_query)
-            if track_id:
-                try:
-                    track = spotify.track(track_id.group(1))
-                    query = f"{track['name']} {track['artists'][0]['name']}"
-                    # Búsqueda en YouTube con ese query
-                    results = await search_ytdlp_async(f"ytsearch1:{query}", ydl_options)
-                    if not results:
-                        await interaction.followup.send(f"No se encontró resultado para: {query}")
-                        return
-                    first = results['entries'][0] if 'entries' in results else results
-                    item = make_queue_item(first)
-                    SONG_QUEUES[guild_id].append(item)
-                    await interaction.followup.send(f"✅ Añadido a la cola: **{item['title']}**")
-                except Exception as e:
-                    await interaction.followup.send(f"Error con Spotify track: {e}")
-                    return
+        if kind == "track":
+            try:
+                async def spotify_search():
+                    track = await SPOTIFY_LOOKUPS.run(f"track:{spotify_id}", lambda: SPOTIFY.track(spotify_id))
+                    return await match_spotify_track(track, job)
 
-        # Playlist completa
-        elif "/playlist/" in song_query:
-            playlist_id = re.search(r"playlist/([a-zA-Z0-9]+)", song_query)
-            if playlist_id:
-                try:
-                    items = get_spotify_playlist_tracks(playlist_id.group(1))
-                    added = 0
-                    for entry in items:
-                        track = entry.get('track')
-                        if not track:
-                            continue
-                        query = f"{track['name']} {track['artists'][0]['name']}"
-                        try:
-                            results = await search_ytdlp_async(f"ytsearch1:{query}", ydl_options)
-                            if not results:
-                                continue
-                            first = results['entries'][0] if 'entries' in results else results
-                            SONG_QUEUES[guild_id].append(make_queue_item(first))
-                            added += 1
-                        except Exception:
-                            continue
-                    await interaction.followup.send(f"✅ Añadidas {added} canciones desde la playlist de Spotify.")
-                except Exception as e:
-                    await interaction.followup.send(f"Error al procesar la playlist de Spotify: {e}")
+                item = await EXTRACTION_SCHEDULER.within(
+                    job, resolve_item([f"sp:{spotify_id}"], ydl_options, spotify_search, job))
+                if not item:
+                    await interaction.followup.send(f"No se encontró resultado para: {song_query}")
+                    return
+                player = await live_player(interaction, player)
+                if player is None:
+                    await interaction.followup.send("¡Debes estar en un canal de voz para reproducir música!")
                     return
+                player.enqueue(item)
+                await interaction.followup.send(f"✅ Añadido a la cola: **{item.title}**")
+            except ExtractionRejected as e:
+                await interaction.followup.send(f"⏳ {e}")
+            except Exception as e:
+                await interaction.followup.send(f"Error con Spotify track: {e}")
 
-        # Si era Spotify, empezamos a reproducir si no hay nada sonando
-        vc = interaction.guild.voice_client
-        if vc and not vc.is_playing():
-            await play_next(vc, guild_id, interaction.channel)
+        # Playlist, álbum o artista completo
+        else:
+            # La importación corre en segundo plano: encola y arranca la reproducción por su cuenta
+            previous = set(player.ingest_tasks)
+            task = asyncio.create_task(
+                ingest_spotify(interaction, player, kind, spotify_id, ydl_options, previous)
+            )
+            player.ingest_tasks.add(task)
         return
 
-    # Si no es Spotify: búsqueda o URL directa
+    # Playlist o mix de YouTube: se importa en segundo plano, como las de Spotify
+    if is_youtube_playlist(song_query):
+        previous = set(player.ingest_tasks)
+        task = asyncio.create_task(ingest_youtube_playlist(interaction, player, song_query.strip(), previous))
+        player.ingest_tasks.add(task)
+        return
+
+    # Si no es Spotify: búsqueda o URL directa. Repetir una búsqueda que ya sonó en el servidor (o
+    # elegir en el autocompletado una pista del historial) no vuelve a buscar
     try:
-        search_q = f"ytsearch1:{song_query}" if not song_query.startswith("http") else song_query
-        results = await search_ytdlp_async(search_q, ydl_options)
+        item = await asyncio.to_thread(HISTORY.find, guild_id, song_query)
     except Exception as e:
-        await interaction.followup.send(f"Error while searching: {str(e)}")
-        return
+        print(f"[historial] No se pudo consultar: {e}")
+        item = None
+    if item is None:
+        try:
+            search_q = f"ytsearch1:{song_query}" if not song_query.startswith("http") else song_query
+            item = await EXTRACTION_SCHEDULER.within(
+                job, resolve_item([query_cache_key(song_query)], ydl_options, search_q, job))
+        except ExtractionRejected as e:
+            await interaction.followup.send(f"⏳ {e}")
+            return
+        except Exception as e:
+            await interaction.followup.send(f"Error while searching: {str(e)}")
+            return
+        if item:
+            try:
+                await asyncio.to_thread(HISTORY.remember_query, guild_id, song_query, item)
+            except Exception as e:
+                print(f"[historial] No se pudo anotar la búsqueda '{song_query}': {e}")
 
-    if not results:
+    if not item:
         await interaction.followup.send(f"No results for: {song_query}")
         return
+    if not song_query.startswith("http"):
+        SUGGESTIONS.add_track(item, alias=song_query)
 
-    first = results['entries'][0] if 'entries' in results else results
-    item = make_queue_item(first)
-    SONG_QUEUES[guild_id].append(item)
-    await interaction.followup.send(f"{'Reproduciendo ahora' if not vc.is_playing() else '✅ Añadido a la cola'}: **{item['title']}**")
+    # La búsqueda puede tardar: el reproductor del principio quizá ya se cerró
+    player = await live_player(interaction, player)
+    if player is None:
+        await interaction.followup.send("¡Debes estar en un canal de voz para reproducir música!")
+        return
+    idle = player.current is None
+    player.enqueue(item)
+    await interaction.followup.send(f"{'Reproduciendo ahora' if idle else '✅ Añadido a la cola'}: **{item.title}**")
 
-    if not vc.is_playing():
-        await play_next(vc, guild_id, interaction.channel)
+@play.autocomplete("song_query")
+async def play_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    try:
+        found = await suggest_songs(interaction.user.id, current, str(interaction.guild_id))
+    except Exception as e:
+        print(f"[autocomplete] {e}")
+        return []
+    return [app_commands.Choice(name=label, value=value) for label, value in found]
 
 @bot.tree.command(name="nowplaying", description="Muestra info detallada de la canción actual")
 async def nowplaying_cmd(interaction: discord.Interaction):
-    guild_id = str(interaction.guild_id)
-    current = CURRENT_SONG.get(guild_id)
+    player = PLAYERS.get(str(interaction.guild_id))
+    current = player.current if player else None
     if not current:
         await interaction.response.send_message("No hay canción sonando ahora.")
         return
 
     embed = discord.Embed(
         title="🎶 Ahora sonando",
-        description=f"[{current['title']}]({current['webpage_url']})",
+        description=f"[{current.title}]({current.webpage_url})",
         color=0x00ccff
     )
-    embed.add_field(name="Artista", value=current.get("artist", "Desconocido"), inline=True)
-    embed.add_field(name="Duración", value=format_duration(current.get("duration")), inline=True)
-    if current.get("thumbnail"):
-        embed.set_thumbnail(url=current["thumbnail"])
+    embed.add_field(name="Artista", value=current.artist, inline=True)
+    embed.add_field(name="Duración", value=format_duration(current.duration), inline=True)
+    if current.thumbnail:
+        embed.set_thumbnail(url=current.thumbnail)
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="seek", description="Avanza o retrocede en la canción actual a un tiempo (segundos)")
 @app_commands.describe(seconds="Tiempo en segundos al que deseas ir (ej. 90 para 1:30)")
 async def seek_cmd(interaction: discord.Interaction, seconds: int):
     vc = interaction.guild.voice_client
-    guild_id = str(interaction.guild_id)
-    current = CURRENT_SONG.get(guild_id)
+    player = PLAYERS.get(str(interaction.guild_id))
 
-    if not vc or not current:
+    if not vc or not player or not player.current:
         await interaction.response.send_message("No hay canción en reproducción.")
         return
 
     # Reiniciar la reproducción en el offset solicitado
-    try:
-        vc.stop()
-    except Exception:
-        pass
-
-    await start_playback(vc, guild_id, interaction.channel, start_seconds=max(0, int(seconds)))
     await interaction.response.send_message(f"⏩ Saltado a {format_duration(seconds)}")
+    await player.post("seek", seconds=seconds)
 
 @bot.tree.command(name="loop", description="Configura el modo de repetición (off/one/all)")
 @app_commands.describe(mode="off/one/all")
@@ -394,16 +4004,37 @@ async def loop_cmd(interaction: discord.Interaction, mode: str):
     if mode not in ["off", "one", "all"]:
         await interaction.response.send_message("Opciones válidas: `off`, `one`, `all`")
         return
-    LOOP_MODE[str(interaction.guild_id)] = mode
+    player = PLAYERS.get(str(interaction.guild_id))
+    if not player:
+        await interaction.response.send_message("No hay nada sonando.")
+        return
+    player.set_loop(mode)
     icon = {"off": "❌", "one": "🔂", "all": "🔁"}[mode]
     await interaction.response.send_message(f"{icon} Loop configurado en **{mode}**")
 
+@bot.tree.command(name="autoplay", description="Al acabarse la cola, sigue con canciones del historial del servidor")
+@app_commands.describe(mode="on/off")
+async def autoplay_cmd(interaction: discord.Interaction, mode: str):
+    if mode not in ["on", "off"]:
+        await interaction.response.send_message("Opciones válidas: `on`, `off`")
+        return
+    player = PLAYERS.get(str(interaction.guild_id))
+    if not player:
+        await interaction.response.send_message("No hay nada sonando.")
+        return
+    player.set_autoplay(mode == "on")
+    if mode == "on":
+        await interaction.response.send_message("📻 Autoplay **activado**: al acabarse la cola sonará lo que suele venir después")
+    else:
+        await interaction.response.send_message("📻 Autoplay **desactivado**")
+
 @bot.tree.command(name="skip", description="Salta la canción actual")
 async def skip(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
-    if vc and vc.is_playing():
-        vc.stop()  # Dispara el after y encadena
+    player = PLAYERS.get(str(interaction.guild_id))
+    if vc and player and player.current:
         await interaction.response.send_message("⏭️ Saltado")
+        await player.post("skip")
     else:
         await interaction.response.send_message("No hay nada sonando.")
 
@@ -428,50 +4059,112 @@ async def resume_cmd(interaction: discord.Interaction):
 @bot.tree.command(name="stop", description="Detiene la reproducción, limpia la cola y desconecta")
 async def stop_cmd(interaction: discord.Interaction):
     vc = interaction.guild.voice_client
-    gid = str(interaction.guild_id)
+    player = PLAYERS.get(str(interaction.guild_id))
+    if player:
+        player.cancel_ingest()
     if vc:
-        SONG_QUEUES.pop(gid, None)
-        CURRENT_SONG.pop(gid, None)
-        VOLUME.pop(gid, None)
-        LOOP_MODE.pop(gid, None)
-        try:
-            vc.stop()
-        except Exception:
-            pass
-        await vc.disconnect()
         await interaction.response.send_message("🛑 Detenido y desconectado")
+        if player:
+            await player.post("stop")
+        else:
+            await vc.disconnect()
     else:
         await interaction.response.send_message("No estoy conectado.")
 
+class QueueView(ui.View):
+    """Páginas de /queue: cada una se construye al pedirla, a partir de la cola tal como esté entonces."""
+
+    def __init__(self, player: "GuildPlayer"):
+        super().__init__(timeout=180)
+        self.player = player
+        self.current_page = 0
+
+    def pages(self) -> int:
+        return max(1, math.ceil(len(self.player.queue) / QUEUE_PAGE_SIZE))
+
+    def render(self) -> str:
+        queue = self.player.queue
+        # La cola puede haber menguado desde la última página vista
+        self.current_page = min(self.current_page, self.pages() - 1)
+        start = self.current_page * QUEUE_PAGE_SIZE
+        lines = [f"**Cola de canciones** ({len(queue)}) — página {self.current_page + 1}/{self.pages()}"]
+        for i, item in enumerate(islice(queue, start, start + QUEUE_PAGE_SIZE), start):
+            mark = "▶️ " if i == 0 and self.player.current is not None else ""
+            lines.append(f"{mark}{i + 1}. {item.title} — {item.artist}")
+        if not queue:
+            lines.append("La cola está vacía.")
+        return "\n".join(lines)[:2000]
+
+    async def update_message(self, interaction: discord.Interaction):
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    @ui.button(label="Anterior", style=discord.ButtonStyle.primary)
+    async def previous(self, interaction: discord.Interaction, button: ui.Button):
+        if self.current_page > 0:
+            self.current_page -= 1
+            await self.update_message(interaction)
+        else:
+            await interaction.response.defer()
+
+    @ui.button(label="Siguiente", style=discord.ButtonStyle.primary)
+    async def next(self, interaction: discord.Interaction, button: ui.Button):
+        if self.current_page < self.pages() - 1:
+            self.current_page += 1
+            await self.update_message(interaction)
+        else:
+            await interaction.response.defer()
+
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True
+
 @bot.tree.command(name="queue", description="Muestra la cola de canciones actuales")
 async def queue_cmd(interaction: discord.Interaction):
-    guild_id = str(interaction.guild_id)
-    queue = SONG_QUEUES.get(guild_id, deque())
-    if not queue:
+    player = PLAYERS.get(str(interaction.guild_id))
+    if not player or not player.queue:
         await interaction.response.send_message("La cola está vacía.")
         return
 
-    message = "**Cola de canciones:**\n"
-    for i, item in enumerate(queue):
-        title = item.get("title", "Sin título")
-        artist = item.get("artist", "Desconocido")
-        message += f"{i + 1}. {title} — {artist}\n"
-
-    # Partir si excede 2000 chars
-    if len(message) > 2000:
-        chunks = [message[i:i+2000] for i in range(0, len(message), 2000)]
-        await interaction.response.send_message(chunks[0])
-        for chunk in chunks[1:]:
-            await interaction.channel.send(chunk)
+    view = QueueView(player)
+    if view.pages() > 1:
+        await interaction.response.send_message(view.render(), view=view)
     else:
-        await interaction.response.send_message(message)
+        await interaction.response.send_message(view.render())
 
 @bot.tree.command(name="clearqueue", description="Limpia la cola de canciones")
 async def clearqueue_cmd(interaction: discord.Interaction):
-    guild_id = str(interaction.guild_id)
-    if guild_id in SONG_QUEUES:
-        SONG_QUEUES[guild_id].clear()
-    await interaction.response.send_message("Cola limpiada ✅")
+    player = PLAYERS.get(str(interaction.guild_id))
+    cancelled = player.clear() if player else False
+    await interaction.response.send_message("Cola limpiada ✅" + (" (importación de playlist cancelada)" if cancelled else ""))
+
+@bot.tree.command(name="remove", description="Quita una canción de la cola por su posición")
+@app_commands.describe(position="Posición en /queue")
+async def remove_cmd(interaction: discord.Interaction, position: int):
+    player = PLAYERS.get(str(interaction.guild_id))
+    track = player.remove_at(position - 1) if player else None
+    if track is None:
+        await interaction.response.send_message("Posición no válida (la canción que suena se quita con /skip).")
+        return
+    await interaction.response.send_message(f"🗑️ Quitada de la cola: **{track.title}**")
+
+@bot.tree.command(name="move", description="Mueve una canción de la cola a otra posición")
+@app_commands.describe(position="Posición actual en /queue", new_position="Nueva posición")
+async def move_cmd(interaction: discord.Interaction, position: int, new_position: int):
+    player = PLAYERS.get(str(interaction.guild_id))
+    track = player.move(position - 1, new_position - 1) if player else None
+    if track is None:
+        await interaction.response.send_message("Posición no válida (la canción que suena no se puede mover).")
+        return
+    await interaction.response.send_message(f"↕️ **{track.title}** movida a la posición {new_position}")
+
+@bot.tree.command(name="shuffle", description="Baraja la cola de canciones")
+async def shuffle_cmd(interaction: discord.Interaction):
+    player = PLAYERS.get(str(interaction.guild_id))
+    if not player or len(player.queue) < 2:
+        await interaction.response.send_message("No hay suficientes canciones en la cola.")
+        return
+    player.shuffle()
+    await interaction.response.send_message("🔀 Cola barajada")
 
 @bot.tree.command(name="volume", description="Ajusta el volumen. Rango: 1-100")
 @app_commands.describe(level="Nivel de volumen entre 1 y 100")
@@ -484,16 +4177,14 @@ async def volume_cmd(interaction: discord.Interaction, level: int):
     if not vc or not vc.is_connected():
         await interaction.response.send_message("No estoy conectado a un canal de voz")
         return
+    player = PLAYERS.get(str(interaction.guild_id))
+    if not player:
+        await interaction.response.send_message("No hay nada sonando.")
+        return
 
-    guild_id = str(interaction.guild_id)
-    vol = level / 100
-    VOLUME[guild_id] = vol
-
-    # Cambiar volumen de la fuente actual
-    if vc.source and isinstance(vc.source, discord.PCMVolumeTransformer):
-        vc.source.volume = vol
-
+    # Cambiar volumen de la fuente actual (en modo Opus el reproductor reinicia en la posición actual)
     await interaction.response.send_message(f"🔊 Volumen ajustado a {level}%")
+    await player.post("volume", volume=level / 100)
 
 # ====== LETRAS CON PAGINACIÓN ======
 class LyricsView(ui.View):
@@ -526,47 +4217,39 @@ class LyricsView(ui.View):
             child.disabled = True
         # Puedes editar el mensaje para deshabilitar los botones si lo deseas
 
-@bot.tree.command(name="letra", description="Busca la letra de una canción.")
+@bot.tree.command(name="letra", description="Busca la letra de una canción (sin argumentos: la que suena).")
 @app_commands.describe(artista="Nombre del artista", cancion="Título de la canción")
-async def letra(interaction: discord.Interaction, artista: str, cancion: str):
-    await interaction.response.defer()
-
-    artist_url = artista.replace(" ", "%20")
-    title_url = cancion.replace(" ", "%20")
-
-    url = f"https://api.lyrics.ovh/v1/{artist_url}/{title_url}"
+async def letra(interaction: discord.Interaction, artista: str | None = None, cancion: str | None = None):
+    if not artista and not cancion:
+        player = PLAYERS.get(str(interaction.guild_id))
+        if not player or not player.current:
+            await interaction.response.send_message("No hay canción sonando: indica `artista` y `cancion`.")
+            return
+        artista, cancion = guess_artist_title(player.current)
+    elif not artista or not cancion:
+        await interaction.response.send_message("Indica `artista` y `cancion`, o ninguno para la canción actual.")
+        return
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    lyrics = data.get("lyrics", "Letra no encontrada.")
-                else:
-                    lyrics = "No encontré la letra. Asegúrate de que el nombre sea correcto."
-    except Exception:
-        lyrics = "Hubo un error al consultar la API de letras."
-
-    # Dividir letra en trozos de máximo ~1800 caracteres
-    max_chunk_len = 1800
-    lyrics_chunks = []
-    text = lyrics
-    while len(text) > max_chunk_len:
-        cut_index = text.rfind('\n', 0, max_chunk_len)
-        if cut_index == -1:
-            cut_index = max_chunk_len
-        lyrics_chunks.append(text[:cut_index])
-        text = text[cut_index:]
-    lyrics_chunks.append(text)
+    # Con la letra ya en caché (p. ej. precargada al empezar la canción) se responde sin esperar
+    found, lyrics_chunks = LYRICS.cached(artista, cancion)
+    if not found:
+        await interaction.response.defer()
+        try:
+            lyrics_chunks = await LYRICS.get(artista, cancion)
+        except LyricsError:
+            lyrics_chunks = ("Hubo un error al consultar la API de letras.",)
+    if not lyrics_chunks:
+        lyrics_chunks = ("No encontré la letra. Asegúrate de que el nombre sea correcto.",)
 
     header = f"**Letra de {cancion.title()} - {artista.title()}**:\n"
+    send = interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
 
     # Enviar con paginación si hay varias páginas
     if len(lyrics_chunks) > 1:
         view = LyricsView(lyrics_chunks)
-        await interaction.followup.send(content=header + f"```{lyrics_chunks[0]}```", view=view)
+        await send(content=header + f"```{lyrics_chunks[0]}```", view=view)
     else:
-        await interaction.followup.send(content=header + f"```{lyrics_chunks[0]}```")
+        await send(content=header + f"```{lyrics_chunks[0]}```")
 
 # ====== LAST.FM INTEGRACIÓN ======
 @bot.tree.command(name="lastfm", description="Muestra tu última canción escuchada en Last.fm")
@@ -575,14 +4258,13 @@ async def lastfm_cmd(interaction: discord.Interaction):
         await interaction.response.send_message("Configura LASTFM_API_KEY y LASTFM_USER en tu .env para usar este comando.")
         return
 
+    await interaction.response.defer()
     try:
-        url = (
-            "http://ws.audioscrobbler.com/2.0/"
-            f"?method=user.getrecenttracks&user={LASTFM_USER}"
-            f"&api_key={LASTFM_API_KEY}&format=json&limit=1"
-        )
-        resp = requests.get(url, timeout=10).json()
-        track = resp["recenttracks"]["track"][0]
+        tracks = await LASTFM.recent_tracks(LASTFM_USER, limit=1)
+        if not tracks:
+            await interaction.followup.send("No hay canciones recientes en Last.fm.")
+            return
+        track = tracks[0]
         title = track.get("name", "Desconocido")
         artist = track.get("artist", {}).get("#text", "Desconocido")
         img_list = track.get("image", [])
@@ -595,50 +4277,188 @@ async def lastfm_cmd(interaction: discord.Interaction):
         )
         if img:
             embed.set_thumbnail(url=img)
-        await interaction.response.send_message(embed=embed)
-    except Exception as e:
-        await interaction.response.send_message(f"No se pudo consultar Last.fm: {e}")
+        await interaction.followup.send(embed=embed)
+    except LastFmError as e:
+        await interaction.followup.send(f"No se pudo consultar Last.fm: {e}")
+
+# ====== ADMINISTRACIÓN ======
+@bot.tree.command(name="stats", description="(Admin) Estado de la cola de extracciones de yt-dlp")
+@app_commands.default_permissions(administrator=True)
+async def stats_cmd(interaction: discord.Interaction):
+    queue = EXTRACTION_SCHEDULER.stats()
+    pool = EXTRACTOR.stats()
+    labels = {"interactive": "Comandos", "background": "Fondo", "bulk": "Importaciones"}
+    embed = discord.Embed(title="📊 Extracciones", color=discord.Color.blue())
+    guild_limit = queue["guild_limit"] or "sin tope"
+    embed.add_field(name="Pool", value=(
+        f"En marcha: **{queue['active']}/{queue['limit']}** (por servidor: {guild_limit})\n"
+        f"Procesos: {pool['workers']} · llamadas: {pool['calls']} · errores: {pool['errors']}\n"
+        f"Extracción p50/p95: {pool['work_p50']:.2f} s / {pool['work_p95']:.2f} s"), inline=False)
+    embed.add_field(name="Esperando turno", value="\n".join(
+        f"{labels[name]}: {queue['waiting'][name]} (espera p50/p95 {queue['wait_p50'][name]:.2f} s / "
+        f"{queue['wait_p95'][name]:.2f} s, admitidas {queue['admitted'][name]})" for name in PRIORITY_NAMES), inline=False)
+    embed.add_field(name="Rechazadas", value=(
+        f"Límite por usuario: {queue['rejected']['rate']} · fuera de plazo: {queue['rejected']['deadline']}"), inline=False)
+    if queue["guilds"]:
+        def guild_name(guild_id: str) -> str:
+            guild = bot.get_guild(int(guild_id))
+            return guild.name if guild else guild_id
+
+        embed.add_field(name="Servidores con más trabajo", value="\n".join(
+            f"{guild_name(guild_id)}: {active} en marcha, {waiting} esperando"
+            for guild_id, active, waiting in queue["guilds"]), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
 # ====== HELP ======
 @bot.tree.command(name="help", description="Muestra todos los comandos disponibles")
 async def help_cmd(interaction: discord.Interaction):
     embed = discord.Embed(title="📜 Comandos de Música", color=discord.Color.blue())
-    embed.add_field(name="/play <canción/url>", value="Reproduce una canción o añade a la cola (YouTube/Spotify).", inline=False)
+    embed.add_field(name="/play <canción/url>", value="Reproduce una canción o añade a la cola (YouTube: vídeo, playlist o mix; Spotify: canción, playlist, álbum o artista).", inline=False)
     embed.add_field(name="/skip", value="Salta la canción actual.", inline=False)
     embed.add_field(name="/pause", value="Pausa la canción que se está reproduciendo.", inline=False)
     embed.add_field(name="/resume", value="Reanuda la canción pausada.", inline=False)
     embed.add_field(name="/stop", value="Detiene la reproducción, limpia la cola y desconecta.", inline=False)
     embed.add_field(name="/loop <off/one/all>", value="Configura el modo repetición: sin loop, repetir una, o repetir toda la cola.", inline=False)
-    embed.add_field(name="/queue", value="Muestra la cola de canciones (se divide si es muy larga).", inline=False)
+    embed.add_field(name="/autoplay <on/off>", value="Al acabarse la cola, sigue con lo que suele sonar después en este servidor.", inline=False)
+    embed.add_field(name="/queue", value="Muestra la cola de canciones por páginas (botones Anterior/Siguiente).", inline=False)
     embed.add_field(name="/clearqueue", value="Limpia la cola de canciones.", inline=False)
+    embed.add_field(name="/remove <posición>", value="Quita una canción de la cola.", inline=False)
+    embed.add_field(name="/move <posición> <nueva posición>", value="Mueve una canción dentro de la cola.", inline=False)
+    embed.add_field(name="/shuffle", value="Baraja la cola (la canción actual sigue sonando).", inline=False)
     embed.add_field(name="/volume <1-100>", value="Ajusta el volumen de la música.", inline=False)
     embed.add_field(name="/nowplaying", value="Muestra info detallada de la canción actual (título, artista, duración y miniatura).", inline=False)
     embed.add_field(name="/seek <segundos>", value="Avanza o retrocede a un tiempo específico de la canción actual.", inline=False)
-    embed.add_field(name="/letra <artista> <canción>", value="Busca la letra con paginación.", inline=False)
+    embed.add_field(name="/letra [artista] [canción]", value="Busca la letra con paginación (sin argumentos, la de la canción actual).", inline=False)
     embed.add_field(name="/lastfm", value="Muestra tu última canción escuchada en Last.fm.", inline=False)
+    embed.add_field(name="/stats", value="(Admin) Estado de la cola de extracciones: en marcha, esperando y rechazadas.", inline=False)
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
 
-from threading import Thread
-from http.server import HTTPServer, BaseHTTPRequestHandler
-
+# =========================
+# SERVIDOR HTTP (salud y métricas)
+# =========================
 PORT = int(os.environ.get("PORT", 10000))
+HTTP_RUNNER: web.AppRunner | None = None
+
+def gateway_connected() -> bool:
+    # AutoShardedBot: una conexión por shard, todas deben estar abiertas
+    return (bot.is_ready() and not bot.is_closed() and bool(bot.shards)
+            and not any(shard.is_closed() for shard in bot.shards.values()))
+
+def render_metrics() -> str:
+    """Métricas en formato de texto de Prometheus; los gauges se calculan en cada consulta."""
+    lines = []
+
+    def gauge(name: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    def counter(name: str, help_text: str, value):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        # Un valor suelto o, como en gauge, una lista de (etiquetas, valor)
+        for labels, sample in value if isinstance(value, list) else [({}, value)]:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {sample}" if label_text else f"{name} {sample}")
+
+    for histogram in (EXTRACTION_SECONDS, FFMPEG_FIRST_PACKET_SECONDS, TRANSITION_GAP_SECONDS,
+                      SPOTIFY_MATCH_CONFIDENCE, LOOP_LAG_SECONDS):
+        lines.extend(histogram.render())
+
+    gauge("musicbot_event_loop_lag_last_seconds", "Último retraso medido del event loop.", [({}, LOOP_LAG_SECONDS.last)])
+    gauge("musicbot_queue_depth", "Canciones en la cola por servidor.",
+          [({"guild": guild_id}, len(player.queue)) for guild_id, player in list(PLAYERS.items())])
+    gauge("musicbot_voice_clients", "Conexiones de voz activas.", [({}, len(bot.voice_clients))])
+    gauge("musicbot_extraction_pending", "Extracciones enviadas al pool de yt-dlp y sin terminar.", [({}, EXTRACTOR.pending)])
+    gauge("musicbot_extraction_backlog", "Extracciones esperando un proceso libre del pool.", [({}, EXTRACTOR.queue_depth)])
+    gauge("musicbot_gateway_connected", "1 si la conexión con el gateway de Discord está activa.", [({}, int(gateway_connected()))])
+    gauge("musicbot_shard_latency_seconds", "Latencia del heartbeat de cada shard de este proceso.",
+          [({"shard": shard_id}, latency) for shard_id, latency in bot.latencies if not math.isnan(latency)])
+    gauge("musicbot_startup_seconds", "Segundos desde la carga del módulo hasta cada fase del arranque.",
+          [({"phase": phase}, value) for phase, value in STARTUP_TIMES.items() if phase != "command_sync"])
+    gauge("musicbot_command_sync_failed", "1 si falló la sincronización de comandos al arrancar.",
+          [({}, int(STARTUP_TIMES.get("command_sync") == COMMAND_SYNC_FAILED))])
+    gauge("musicbot_last_reconnect_seconds", "Duración de la última reconexión al gateway.", [({}, LAST_RECONNECT_SECONDS)])
+    counter("musicbot_extraction_errors_total", "Extracciones de yt-dlp fallidas.", EXTRACTOR.errors)
+    gauge("musicbot_extraction_waiting", "Extracciones esperando turno de admisión, por prioridad.",
+          [({"priority": name}, EXTRACTION_SCHEDULER.waiting(p)) for p, name in enumerate(PRIORITY_NAMES)])
+    counter("musicbot_extraction_admitted_total", "Extracciones admitidas en el pool, por prioridad.",
+            [({"priority": name}, EXTRACTION_SCHEDULER.admitted[p]) for p, name in enumerate(PRIORITY_NAMES)])
+    counter("musicbot_extraction_rejected_total", "Extracciones rechazadas por límite de usuario o de plazo.",
+            [({"reason": reason}, count) for reason, count in EXTRACTION_SCHEDULER.rejected.items()])
+    flights = {"extraction": EXTRACTIONS, "resolution": RESOLUTIONS, "stream": STREAM_RESOLVING, "spotify": SPOTIFY_LOOKUPS}
+    counter("musicbot_singleflight_shared_total", "Llamadas que se unieron a una petición idéntica ya en vuelo.",
+            [({"kind": kind}, flight.shared) for kind, flight in flights.items()])
+    if SCROBBLER is not None:
+        gauge("musicbot_scrobbles_pending", "Scrobbles esperando envío a Last.fm.", [({}, len(SCROBBLER.pending))])
+        counter("musicbot_scrobbles_sent_total", "Scrobbles enviados a Last.fm.", SCROBBLER.sent)
+
+    cache = RESOLUTION_CACHE.stats()
+    counter("musicbot_resolution_cache_hits_total", "Aciertos de la caché de resolución.", cache["hits"])
+    counter("musicbot_resolution_cache_misses_total", "Fallos de la caché de resolución.", cache["misses"])
+    gauge("musicbot_audio_cache_bytes", "Bytes de audio guardados en disco.", [({}, AUDIO_CACHE.bytes)])
+    gauge("musicbot_audio_cache_tracks", "Pistas guardadas en la caché de audio.", [({}, len(AUDIO_CACHE))])
+    counter("musicbot_audio_cache_hits_total", "Reproducciones servidas desde la caché de audio.", AUDIO_CACHE.hits)
+    counter("musicbot_audio_cache_downloaded_bytes_total", "Bytes descargados para la caché de audio.",
+            AUDIO_CACHE.downloaded_bytes)
+    counter("musicbot_preroll_total", "Precargas de la siguiente pista, usadas o descartadas.",
+            [({"outcome": outcome}, count) for outcome, count in PREROLL_COUNTS.items()])
+    counter("musicbot_history_plays_total", "Reproducciones anotadas en el historial de los servidores.", HISTORY.recorded)
+    counter("musicbot_history_replays_total", "/play resueltos desde el historial del servidor, sin extracción.",
+            HISTORY.replays)
+    counter("musicbot_autoplay_picks_total", "Pistas añadidas por el autoplay.", HISTORY.picks)
+    counter("musicbot_loudness_analyses_total", "Pistas analizadas para normalizar la sonoridad.", LOUDNESS.analyses)
+    counter("musicbot_loudness_failures_total", "Análisis de sonoridad fallidos.", LOUDNESS.failures)
+    gauge("musicbot_outbound_pending", "Mensajes del bot esperando su turno en la cola de salida.", [({}, len(OUTBOX))])
+    counter("musicbot_outbound_calls_total", "Envíos y ediciones hechos por la cola de salida.", OUTBOX.calls)
+    counter("musicbot_outbound_coalesced_total", "Actualizaciones sustituidas por otra más reciente antes de enviarse.",
+            OUTBOX.coalesced)
+    gauge("musicbot_suggestions_indexed", "Sugerencias de /play en el índice local.", [({}, len(SUGGESTIONS))])
+    counter("musicbot_autocomplete_remote_searches_total", "Búsquedas planas lanzadas por el autocompletado.",
+            REMOTE_SUGGESTIONS.searches)
+    return "\n".join(lines) + "\n"
+
+async def handle_root(request: web.Request) -> web.Response:
+    return web.Response(text="Bot corriendo")
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    connected = gateway_connected()
+    latency = bot.latency
+    body = {"gateway": "connected" if connected else "disconnected",
+            "latency_ms": None if math.isnan(latency) else round(latency * 1000),
+            "shards": sorted(bot.shards)}
+    return web.json_response(body, status=200 if connected else 503)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
 
-class DummyHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot corriendo")
+async def start_http_server():
+    """Servidor aiohttp en el mismo event loop del bot (sustituye al antiguo servidor de relleno)."""
+    global HTTP_RUNNER
+    app = web.Application()
+    app.router.add_get("/", handle_root)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/metrics", handle_metrics)
+    HTTP_RUNNER = web.AppRunner(app, access_log=None)
+    await HTTP_RUNNER.setup()
+    await web.TCPSite(HTTP_RUNNER, "0.0.0.0", PORT).start()
+    print(f"Servidor HTTP en el puerto {PORT} (/healthz, /metrics)")
 
-def start_dummy_server():
-    server = HTTPServer(("0.0.0.0", PORT), DummyHandler)
-    server.serve_forever()
+async def stop_http_server():
+    if HTTP_RUNNER is not None:
+        await HTTP_RUNNER.cleanup()
 
-Thread(target=start_dummy_server, daemon=True).start()
-print(f"Bot corriendo en Render (dummy port {PORT})")
+mark_startup("import")
 
-# Luego tu bot
-bot.run(TOKEN)
+if __name__ == "__main__":
+    # Los procesos de ExtractionEngine (spawn) importan este archivo: sólo el proceso principal arranca el bot
+    EXTRACTOR.start()
 
+    # Luego tu bot
+    bot.run(TOKEN)
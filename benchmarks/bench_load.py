@@ -0,0 +1,446 @@
+"""
+Prueba de carga offline del pipeline de reproducción (sin Discord, YouTube ni Spotify).
+
+Usa los dobles de offline_stubs.py: yt-dlp falso con latencia configurable dentro del pool
+real de ExtractionEngine, la Web API de Spotify simulada, un VoiceClient que consume frames
+a tiempo real y audio local servido por HTTP a un ffmpeg real. Con ellos ejecuta los comandos del bot
+(play.callback, skip, seek...) en muchos servidores a la vez.
+
+Escenarios:
+    play      cada servidor hace --per-guild /play de búsquedas y deja sonar la cola --seconds
+              (mide además qué parte de los frames esperados llegó a tiempo)
+    playlist  cada servidor importa una playlist de Spotify de --playlist-size canciones
+    storm     tormenta de skip/seek en todos los servidores durante --seconds
+    fair      el primer servidor importa una playlist de Spotify mientras los demás hacen
+              --per-guild /play sueltos (mide si la importación deja sin turno a los comandos)
+
+Informa de throughput, latencias (comando, primer audio, hueco entre canciones, primer
+paquete de ffmpeg), lag del event loop, CPU (bot e hijos: ffmpeg y pool) y RSS.
+Con --json guarda los resultados y con --baseline los compara con una ejecución anterior
+(código de salida 1 si alguna métrica empeora más de --tolerance).
+
+Uso:
+    python benchmarks/bench_load.py --guilds 10 --scenarios play,playlist,storm
+    python benchmarks/bench_load.py --json base.json
+    python benchmarks/bench_load.py --baseline base.json --tolerance 0.25
+    PREROLL_SECONDS=0 python benchmarks/bench_load.py --scenarios play --stream-latency 0.5   # huecos sin precarga
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_DATA_DIR", tempfile.mkdtemp(prefix="musicbot-bench-"))
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "bench")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "bench")
+
+import discord  # noqa: E402
+import MusicBot  # noqa: E402
+import offline_stubs as stubs  # noqa: E402
+
+# Métricas donde "más es peor" (para --baseline); el resto de claves no se comparan
+LOWER_IS_BETTER = (
+    "command_p95", "first_audio_p95", "gap_p95", "skip_to_audio_p95", "first_packet_p95",
+    "loop_lag_p95", "bot_cpu_pct", "children_cpu_pct", "bot_rss_mb",
+)
+HIGHER_IS_BETTER = ("throughput", "audio_realtime")
+
+class Recorder(MusicBot.Histogram):
+    """Histogram que además guarda cada valor, para sacar percentiles exactos."""
+
+    def __init__(self, name: str):
+        super().__init__(name, "", (1,))
+        self.values: list[float] = []
+
+    def observe(self, value: float):
+        super().observe(value)
+        self.values.append(value)
+
+class OfflineExtractionEngine(MusicBot.ExtractionEngine):
+    """El mismo pool de procesos, pero con FakeYoutubeDL instalado en cada proceso."""
+
+    def __init__(self, workers: int, init_args: tuple):
+        super().__init__(workers)
+        self.init_args = init_args
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=stubs.install_fake_ytdlp,
+                initargs=self.init_args,
+            )
+        return self._pool
+
+def pct(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def proc_stat(pid) -> tuple[float, int] | None:
+    """(CPU user + sys en segundos, ppid) de un proceso vivo, leído de /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), int(fields[1])
+
+def proc_rss_mb(pid) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+def child_pids() -> list[int]:
+    me = os.getpid()
+    pids = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            stat = proc_stat(name)
+            if stat and stat[1] == me:
+                pids.append(int(name))
+    return pids
+
+def children_cpu() -> float:
+    """CPU de los hijos: los ya recogidos (os.times) más los que siguen vivos (/proc)."""
+    times = os.times()
+    live = sum((proc_stat(pid) or (0.0, 0))[0] for pid in child_pids())
+    return times.children_user + times.children_system + live
+
+class Bench:
+    def __init__(self, args, audio_url: str, encoder):
+        self.args = args
+        self.audio_url = audio_url
+        self.encoder = encoder
+        self.guilds: list[stubs.FakeGuild] = []
+        self.rounds = 0
+        self.command_times: list[float] = []
+        self.first_audio: list[float] = []
+        self.skip_to_audio: list[float] = []
+        self.audio_realtime: float | None = None
+
+    # ---------- utilidades ----------
+    def reset(self):
+        self.command_times, self.first_audio, self.skip_to_audio = [], [], []
+        self.audio_realtime = None
+        MusicBot.FFMPEG_FIRST_PACKET_SECONDS = Recorder("first_packet")
+        MusicBot.TRANSITION_GAP_SECONDS = Recorder("gap")
+        MusicBot.LOOP_LAG_SECONDS = Recorder("loop_lag")
+        MusicBot.EXTRACTION_SECONDS = Recorder("extraction")
+        MusicBot.SPOTIFY_MATCH_CONFIDENCE = Recorder("match_confidence")
+        # IDs nuevos en cada escenario para no mezclar estado con el anterior
+        self.rounds += 1
+        base = 1000 * self.rounds
+        self.guilds = [stubs.FakeGuild(base + i, self.encoder) for i in range(self.args.guilds)]
+
+    async def command(self, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.command_times.append(time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    async def wait_audio(guild_id: int, previous=None, timeout: float = 30) -> float | None:
+        """Espera al primer frame de una fuente nueva (distinta de `previous`). Devuelve el momento."""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            player = MusicBot.PLAYERS.get(str(guild_id))
+            source = player.source if player else None
+            if source is not None and source is not previous and source.frames:
+                return time.perf_counter()
+            await asyncio.sleep(0.005)
+        return None
+
+    async def time_first_audio(self, guild_id: int, start: float, timeout: float = 30):
+        at = await self.wait_audio(guild_id, timeout=timeout)
+        if at:
+            self.first_audio.append(at - start)
+
+    def frames(self) -> int:
+        return sum(vc.frames for g in self.guilds for vc in g.voice_history)
+
+    async def stop_all(self):
+        for player in list(MusicBot.PLAYERS.values()):
+            player.cancel_ingest()
+            await player.post("stop")
+        # Dar tiempo a que los hilos de audio salgan y ffmpeg se recoja
+        await asyncio.sleep(0.5)
+
+    # ---------- escenarios ----------
+    async def scenario_play(self) -> tuple[int, float]:
+        per_guild = self.args.per_guild
+
+        async def guild_run(guild: stubs.FakeGuild):
+            if self.args.loop != "off":
+                MusicBot.get_player(str(guild.id)).set_loop(self.args.loop)
+            first_audio = asyncio.create_task(self.time_first_audio(guild.id, time.perf_counter()))
+            for i in range(per_guild):
+                await self.command(MusicBot.play.callback(stubs.FakeInteraction(guild), f"cancion {guild.id} {i}"))
+            await first_audio
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guild_run(g) for g in self.guilds))
+        busy = time.perf_counter() - start
+        # Frames entregados frente a los que tocaban: por debajo de 1 el audio se entrecorta
+        frames0, window0 = self.frames(), time.perf_counter()
+        await asyncio.sleep(self.args.seconds)
+        expected = len(self.guilds) * (time.perf_counter() - window0) / stubs.FRAME
+        self.audio_realtime = (self.frames() - frames0) / expected
+        return len(self.guilds) * per_guild, busy
+
+    async def scenario_playlist(self) -> tuple[int, float]:
+        async def guild_run(guild: stubs.FakeGuild):
+            # loop all: nada sale de la cola, así que su tamaño final es lo importado
+            MusicBot.get_player(str(guild.id)).set_loop("all")
+            first_audio = asyncio.create_task(self.time_first_audio(guild.id, time.perf_counter(), timeout=120))
+            await self.command(MusicBot.play.callback(
+                stubs.FakeInteraction(guild), f"https://open.spotify.com/playlist/bench{guild.id}"
+            ))
+            player = MusicBot.PLAYERS[str(guild.id)]
+            while any(not t.done() for t in player.ingest_tasks):
+                await asyncio.sleep(0.05)
+            await first_audio
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guild_run(g) for g in self.guilds))
+        busy = time.perf_counter() - start
+        # Los dobles imitan resultados reales: un emparejado dudoso es que se midió el camino equivocado
+        doubtful = [c for c in MusicBot.SPOTIFY_MATCH_CONFIDENCE.values if c < 0.5]
+        assert not doubtful, f"{len(doubtful)} emparejados dudosos en la importación de playlists"
+        return sum(len(p.queue) for p in MusicBot.PLAYERS.values()), busy
+
+    async def scenario_storm(self) -> tuple[int, float]:
+        # Colas largas para que los skips nunca las vacíen
+        for guild in self.guilds:
+            interaction = stubs.FakeInteraction(guild)
+            await MusicBot.play.callback(interaction, f"https://open.spotify.com/playlist/storm{guild.id}")
+        players = [MusicBot.PLAYERS[str(g.id)] for g in self.guilds]
+        await asyncio.gather(*(self.wait_audio(g.id, timeout=120) for g in self.guilds))
+
+        deadline = time.perf_counter() + self.args.seconds
+        rng = random.Random(7)
+
+        async def storm(player: "MusicBot.GuildPlayer"):
+            done = 0
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(rng.uniform(0.5, 1.5) * self.args.storm_interval)
+                previous = player.source
+                start = time.perf_counter()
+                if rng.random() < 0.5:
+                    await self.command(player.post("skip"))
+                else:
+                    await self.command(player.post("seek", seconds=rng.randint(0, max(1, self.args.track_seconds - 5))))
+                at = await self.wait_audio(int(player.guild_id), previous)
+                if at:
+                    self.skip_to_audio.append(at - start)
+                done += 1
+            return done
+
+        start = time.perf_counter()
+        done = sum(await asyncio.gather(*(storm(p) for p in players)))
+        return done, time.perf_counter() - start
+
+    async def scenario_fair(self) -> tuple[int, float]:
+        bulk, *others = self.guilds
+        await MusicBot.play.callback(stubs.FakeInteraction(bulk), f"https://open.spotify.com/playlist/fair{bulk.id}")
+        # Que la importación ya tenga el pool ocupado antes de los comandos
+        await asyncio.sleep(1.0)
+
+        async def guild_run(guild: stubs.FakeGuild):
+            for i in range(self.args.per_guild):
+                await self.command(MusicBot.play.callback(stubs.FakeInteraction(guild), f"suelta {guild.id} {i}"))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guild_run(g) for g in others))
+        return len(others) * self.args.per_guild, time.perf_counter() - start
+
+    async def run(self, name: str) -> dict:
+        self.reset()
+        lag_task = asyncio.create_task(MusicBot.monitor_loop_lag(0.1))
+        peak = {"bot_rss": 0.0, "children_rss": 0.0}
+
+        async def sample_rss():
+            while True:
+                peak["bot_rss"] = max(peak["bot_rss"], proc_rss_mb("self"))
+                peak["children_rss"] = max(peak["children_rss"], sum(proc_rss_mb(p) for p in child_pids()))
+                await asyncio.sleep(0.5)
+
+        rss_task = asyncio.create_task(sample_rss())
+        wall0, cpu0, child0 = time.perf_counter(), time.process_time(), children_cpu()
+        rejected0 = sum(MusicBot.EXTRACTION_SCHEDULER.rejected.values())
+        # Cada escenario devuelve (operaciones, segundos de su fase activa) para el throughput
+        operations, busy = await getattr(self, f"scenario_{name}")()
+        wall = time.perf_counter() - wall0
+        cpu, child = time.process_time() - cpu0, children_cpu() - child0
+        # Lo que quede en la cola de salida también cuenta: esperar a que se vacíe
+        while len(MusicBot.OUTBOX):
+            await asyncio.sleep(0.1)
+        discord_calls = sum(g.text_channel.calls for g in self.guilds)
+        lag_task.cancel()
+        rss_task.cancel()
+        await self.stop_all()
+
+        gaps = MusicBot.TRANSITION_GAP_SECONDS.values
+        first_packets = MusicBot.FFMPEG_FIRST_PACKET_SECONDS.values
+        lags = MusicBot.LOOP_LAG_SECONDS.values
+        return {
+            "scenario": name,
+            "guilds": len(self.guilds),
+            "operations": operations,
+            "wall_s": wall,
+            "throughput": operations / busy if busy else 0.0,
+            "command_p50": pct(self.command_times, 0.5),
+            "command_p95": pct(self.command_times, 0.95),
+            "first_audio_p50": pct(self.first_audio, 0.5),
+            "first_audio_p95": pct(self.first_audio, 0.95),
+            "gap_p50": pct(gaps, 0.5),
+            "gap_p95": pct(gaps, 0.95),
+            "transitions": len(gaps),
+            "skip_to_audio_p50": pct(self.skip_to_audio, 0.5),
+            "skip_to_audio_p95": pct(self.skip_to_audio, 0.95),
+            "first_packet_p50": pct(first_packets, 0.5),
+            "first_packet_p95": pct(first_packets, 0.95),
+            "audio_realtime": self.audio_realtime or 0.0,
+            "discord_calls": discord_calls,
+            "extraction_rejected": sum(MusicBot.EXTRACTION_SCHEDULER.rejected.values()) - rejected0,
+            "spotify_matches": len(MusicBot.SPOTIFY_MATCH_CONFIDENCE.values),
+            "doubtful_matches": sum(c < 0.5 for c in MusicBot.SPOTIFY_MATCH_CONFIDENCE.values),
+            "loop_lag_p95": pct(lags, 0.95),
+            "loop_lag_max": max(lags, default=0.0),
+            "bot_cpu_pct": 100 * cpu / wall,
+            "children_cpu_pct": 100 * child / wall,
+            "bot_rss_mb": peak["bot_rss"],
+            "children_rss_mb": peak["children_rss"],
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+def print_result(r: dict):
+    ms = lambda v: f"{1000 * v:.0f} ms"  # noqa: E731
+    print(f"\n== {r['scenario']} ({r['guilds']} servidores, {r['operations']} operaciones en {r['wall_s']:.1f} s)")
+    print(f"  throughput            {r['throughput']:.2f} op/s")
+    print(f"  comando p50/p95       {ms(r['command_p50'])} / {ms(r['command_p95'])}")
+    print(f"  primer audio p50/p95  {ms(r['first_audio_p50'])} / {ms(r['first_audio_p95'])}")
+    print(f"  hueco entre canciones {ms(r['gap_p50'])} / {ms(r['gap_p95'])} ({r['transitions']} transiciones)")
+    print(f"  skip/seek→audio       {ms(r['skip_to_audio_p50'])} / {ms(r['skip_to_audio_p95'])}")
+    print(f"  ffmpeg primer paquete {ms(r['first_packet_p50'])} / {ms(r['first_packet_p95'])}")
+    if r["audio_realtime"]:
+        print(f"  audio en tiempo real  {r['audio_realtime']:.1%} de los frames esperados")
+    print(f"  llamadas a Discord    {r['discord_calls']} (envíos y ediciones de mensajes del bot)")
+    print(f"  extracciones fuera    {r['extraction_rejected']} (rechazadas por límite de usuario o de plazo)")
+    if r["spotify_matches"]:
+        print(f"  emparejados Spotify   {r['spotify_matches']} ({r['doubtful_matches']} dudosos)")
+    print(f"  lag event loop        p95 {ms(r['loop_lag_p95'])}, máx {ms(r['loop_lag_max'])}")
+    print(f"  CPU bot / hijos       {r['bot_cpu_pct']:.1f}% / {r['children_cpu_pct']:.1f}%")
+    print(f"  RSS bot / hijos       {r['bot_rss_mb']:.0f} MB / {r['children_rss_mb']:.0f} MB (pico bot {r['peak_rss_mb']:.0f} MB)")
+
+def compare(results: list[dict], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    ok = True
+    for r in results:
+        base = baseline.get(r["scenario"])
+        if not base:
+            continue
+        for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            old, new = base.get(key, 0), r.get(key, 0)
+            if not old:
+                continue
+            change = (new - old) / old if key in LOWER_IS_BETTER else (old - new) / old
+            if change > tolerance:
+                ok = False
+                print(f"[REGRESIÓN] {r['scenario']}.{key}: {old:.4g} → {new:.4g} ({change:+.0%})")
+    return ok
+
+async def amain(args) -> list[dict]:
+    encoder = None
+    try:
+        if not discord.opus.is_loaded():
+            discord.opus._load_default()
+        encoder = discord.opus.Encoder() if discord.opus.is_loaded() else None
+    except Exception:
+        pass
+    if encoder is None:
+        print("[AVISO] libopus no disponible: en modo pcm no se mide la codificación de discord.py")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stubs.make_test_audio(MusicBot.get_ffmpeg_path(), tmp, args.track_seconds)
+        server = stubs.serve_directory(tmp, args.stream_latency)
+        audio_url = f"http://127.0.0.1:{server.server_address[1]}/track.webm"
+
+        MusicBot.bot.loop = asyncio.get_running_loop()
+        await MusicBot.open_caches()
+        MusicBot.PLAYBACK_MODE = args.mode
+        MusicBot.EXTRACTION_INTERACTIVE_DEADLINE = args.deadline
+        MusicBot.SPOTIFY.get = stubs.FakeSpotify(
+            latency=args.spotify_latency, playlist_size=args.playlist_size, duration=args.track_seconds
+        ).get
+        MusicBot.LYRICS._fetch = stubs.FakeLyrics().fetch
+        MusicBot.EXTRACTOR = OfflineExtractionEngine(
+            args.workers, (args.extract_latency, args.extract_jitter, args.extract_cpu_ms, audio_url, args.track_seconds)
+        )
+        MusicBot.EXTRACTOR.start()
+        await MusicBot.start_queue_persistence()
+
+        bench = Bench(args, audio_url, encoder)
+        results = []
+        try:
+            for name in args.scenarios.split(","):
+                result = await bench.run(name)
+                print_result(result)
+                results.append(result)
+        finally:
+            await MusicBot.stop_queue_persistence()
+            MusicBot.EXTRACTOR.shutdown()
+            await MusicBot.close_http_session()
+            server.shutdown()
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="play,playlist,storm")
+    parser.add_argument("--guilds", type=int, default=10, help="servidores simultáneos")
+    parser.add_argument("--per-guild", type=int, default=5, help="/play por servidor (escenario play)")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=20, help="duración de la reproducción / tormenta")
+    parser.add_argument("--loop", default="off", choices=("off", "all"), help="modo de loop en el escenario play")
+    parser.add_argument("--storm-interval", type=float, default=2.0, help="segundos medios entre skip/seek")
+    parser.add_argument("--track-seconds", type=int, default=8, help="duración de cada pista falsa")
+    parser.add_argument("--mode", default=MusicBot.PLAYBACK_MODE, choices=("pcm", "opus"))
+    parser.add_argument("--workers", type=int, default=MusicBot.YTDLP_WORKERS, help="procesos de yt-dlp")
+    parser.add_argument("--extract-latency", type=float, default=0.4, help="latencia media de yt-dlp (s)")
+    parser.add_argument("--extract-jitter", type=float, default=0.3, help="desviación relativa de la latencia")
+    parser.add_argument("--extract-cpu-ms", type=float, default=30, help="CPU por extracción (parseo)")
+    parser.add_argument("--spotify-latency", type=float, default=0.1)
+    parser.add_argument("--deadline", type=float, default=MusicBot.EXTRACTION_INTERACTIVE_DEADLINE,
+                        help="plazo de los /play para tener su canción (0: sin plazo)")
+    parser.add_argument("--stream-latency", type=float, default=0.0, help="espera hasta el primer byte del audio (s)")
+    parser.add_argument("--json", help="guardar resultados en este archivo")
+    parser.add_argument("--baseline", help="comparar con un --json anterior")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="empeoramiento relativo permitido")
+    args = parser.parse_args()
+
+    results = asyncio.run(amain(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Benchmark de CPU por stream: modo "pcm" vs modo "opus" de build_audio_source.
+
+Genera un archivo WebM/Opus local, lo sirve por HTTP (como haría googlevideo) y reproduce
+N streams simultáneos a tiempo real, imitando el bucle de discord.py (AudioPlayer): un hilo
+por stream que lee un frame cada 20 ms y, si la fuente no es Opus, lo codifica.
+Mide la CPU del proceso del bot y la de los ffmpeg (vía /proc, sólo Linux) por stream.
+
+Uso:
+    python benchmarks/bench_playback_cpu.py --streams 1,5,10 --seconds 15 --volume 0.5
+"""
+import argparse
+import functools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_DATA_DIR", tempfile.mkdtemp(prefix="musicbot-bench-"))
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "bench")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "bench")
+
+import discord  # noqa: E402
+import MusicBot  # noqa: E402
+
+FRAME = 0.02
+
+def make_test_audio(directory: str, seconds: int) -> str:
+    path = os.path.join(directory, "bench.webm")
+    subprocess.run(
+        [MusicBot.get_ffmpeg_path(), "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-ac", "2", "-ar", "48000", "-c:a", "libopus", "-b:a", "96k", path],
+        check=True,
+    )
+    return path
+
+def serve_directory(directory: str) -> ThreadingHTTPServer:
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def ffmpeg_process(source: "MusicBot.TrackedSource"):
+    original = source.original
+    if isinstance(original, discord.PCMVolumeTransformer):
+        original = original.original
+    return original._process
+
+def process_cpu(pid: int) -> float:
+    """CPU (user + sys) consumida por un proceso vivo, leída de /proc."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def load_encoder():
+    try:
+        if not discord.opus.is_loaded():
+            discord.opus._load_default()
+        return discord.opus.Encoder() if discord.opus.is_loaded() else None
+    except Exception:
+        return None
+
+def player_loop(source, encoder, stop: threading.Event, counters: list, index: int):
+    """Réplica simplificada de discord.player.AudioPlayer._do_run."""
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        data = source.read()
+        if not data:
+            break
+        if not source.is_opus() and encoder is not None:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        counters[index] += 1
+        next_at += FRAME
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+def run(mode: str, url: str, streams: int, seconds: float, warmup: float, volume: float, encoder) -> dict:
+    sources = [MusicBot.build_audio_source(url, volume=volume, acodec="opus", mode=mode) for _ in range(streams)]
+    pids = [ffmpeg_process(src).pid for src in sources]
+    stop = threading.Event()
+    counters = [0] * streams
+    threads = [threading.Thread(target=player_loop, args=(src, encoder, stop, counters, i)) for i, src in enumerate(sources)]
+    for t in threads:
+        t.start()
+
+    # Tras el calentamiento ffmpeg ya llenó el pipe y va al ritmo de la lectura (tiempo real)
+    time.sleep(warmup)
+    start = time.perf_counter()
+    cpu_before = time.process_time()
+    ffmpeg_before = sum(process_cpu(pid) for pid in pids)
+    frames_before = sum(counters)
+    time.sleep(seconds)
+    ffmpeg_cpu = sum(process_cpu(pid) for pid in pids) - ffmpeg_before
+    bot_cpu = time.process_time() - cpu_before
+    wall = time.perf_counter() - start
+    frames = sum(counters) - frames_before
+
+    stop.set()
+    for t in threads:
+        t.join()
+    for src in sources:
+        src.cleanup()
+
+    return {
+        "mode": mode,
+        "streams": streams,
+        "frames_per_stream": frames / streams,
+        "bot_ms_per_stream_s": 1000 * bot_cpu / wall / streams,
+        "ffmpeg_ms_per_stream_s": 1000 * ffmpeg_cpu / wall / streams,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", default="1,5,10", help="lista de streams simultáneos")
+    parser.add_argument("--seconds", type=float, default=15, help="duración de la medición")
+    parser.add_argument("--warmup", type=float, default=5, help="segundos antes de empezar a medir")
+    parser.add_argument("--volume", type=float, default=0.5, help="1.0 activa la copia directa en modo opus")
+    parser.add_argument("--modes", default="pcm,opus")
+    args = parser.parse_args()
+
+    encoder = load_encoder()
+    if encoder is None:
+        print("[AVISO] libopus no disponible: el modo pcm se mide SIN la codificación de discord.py (cifras por debajo de lo real)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_test_audio(tmp, int(args.warmup + args.seconds) + 30)
+        server = serve_directory(tmp)
+        url = f"http://127.0.0.1:{server.server_address[1]}/bench.webm"
+        print(f"{'modo':<6} {'streams':>7} {'frames/stream':>13} {'bot ms/s':>9} {'ffmpeg ms/s':>12} {'total ms/s':>11}")
+        try:
+            for streams in (int(n) for n in args.streams.split(",")):
+                for mode in args.modes.split(","):
+                    r = run(mode, url, streams, args.seconds, args.warmup, args.volume, encoder)
+                    total = r["bot_ms_per_stream_s"] + r["ffmpeg_ms_per_stream_s"]
+                    print(f"{r['mode']:<6} {r['streams']:>7} {r['frames_per_stream']:>13.0f} "
+                          f"{r['bot_ms_per_stream_s']:>9.2f} {r['ffmpeg_ms_per_stream_s']:>12.2f} {total:>11.2f}")
+        finally:
+            server.shutdown()
+
+if __name__ == "__main__":
+    main()
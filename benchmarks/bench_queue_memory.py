@@ -0,0 +1,125 @@
+"""
+Benchmark de memoria y operaciones de la cola: deque de dicts (formato anterior) vs TrackQueue de Track.
+
+Construye colas con pistas sintéticas de tamaño realista (IDs, títulos y URLs de YouTube,
+~300 artistas distintos) y mide con tracemalloc los bytes por pista encolada. También mide
+el coste de quitar entradas sueltas (deque.remove por igualdad vs TrackQueue.remove por manejador),
+solas y seguidas de leer la siguiente pista, como hace /remove al refrescar la precarga.
+
+Uso:
+    python benchmarks/bench_queue_memory.py --sizes 10000,50000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_DATA_DIR", tempfile.mkdtemp(prefix="musicbot-bench-"))
+os.environ.setdefault("SPOTIPY_CLIENT_ID", "bench")
+os.environ.setdefault("SPOTIPY_CLIENT_SECRET", "bench")
+
+import MusicBot  # noqa: E402
+
+ARTISTS = [f"Artista número {i} - Topic" for i in range(300)]
+
+def fake_infos(n: int, seed: int = 1):
+    """Info de yt-dlp simulada; cada string es un objeto nuevo, como al parsear JSON."""
+    rng = random.Random(seed)
+    for i in range(n):
+        vid = "".join(rng.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_") for _ in range(11))
+        yield {
+            "id": vid,
+            "title": f"Canción de prueba {i} (Official Audio)",
+            "webpage_url": f"https://www.youtube.com/watch?v={vid}",
+            "duration": rng.randint(120, 420),
+            "thumbnail": f"https://i.ytimg.com/vi/{vid}/maxresdefault.jpg",
+            "uploader": "".join(rng.choice(ARTISTS)),  # copia nueva del nombre, no el objeto compartido
+        }
+
+def legacy_item(info: dict) -> dict:
+    """Forma de los items de cola antes de Track (dict por pista)."""
+    return {
+        "id": info.get("id"),
+        "title": info.get("title", "Sin título"),
+        "webpage_url": info.get("webpage_url", ""),
+        "duration": info.get("duration"),
+        "thumbnail": info.get("thumbnail", ""),
+        "artist": info.get("uploader") or "Desconocido",
+    }
+
+def measure(build) -> tuple[int, object]:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, obj
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,50000")
+    parser.add_argument("--removals", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'pistas':>8} {'dict+deque B/pista':>19} {'Track+TrackQueue B/pista':>25} {'ahorro':>7} "
+          f"{'remove deque (ms)':>18} {'remove handle (ms)':>19} {'+siguiente deque':>17} {'+siguiente handle':>18}")
+    for n in (int(x) for x in args.sizes.split(",")):
+        infos = list(fake_infos(n))
+
+        legacy_bytes, legacy = measure(lambda: deque(legacy_item(i) for i in infos))
+        handles = []
+
+        def build_tracks():
+            queue = MusicBot.TrackQueue()
+            for info in infos:
+                handles.append(queue.append(MusicBot.make_queue_item(info)))
+            return queue
+
+        track_bytes, queue = measure(build_tracks)
+
+        # Quitar entradas sueltas del medio de la cola
+        rng = random.Random(2)
+        picks = rng.sample(range(n), min(args.removals, n))
+        victims = [legacy[i] for i in picks]
+        start = time.perf_counter()
+        for item in victims:
+            legacy.remove(item)
+        legacy_ms = 1000 * (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in picks:
+            queue.remove(handles[i])
+        handle_ms = 1000 * (time.perf_counter() - start)
+
+        # Lo mismo que /remove: quitar y mirar cuál es la siguiente (GuildPlayer._upcoming)
+        legacy = deque(legacy_item(i) for i in infos)
+        victims = [legacy[i] for i in picks]
+        start = time.perf_counter()
+        for item in victims:
+            legacy.remove(item)
+            legacy[1]
+        legacy_peek_ms = 1000 * (time.perf_counter() - start)
+
+        queue = MusicBot.TrackQueue(MusicBot.make_queue_item(i) for i in infos)
+        handles = list(queue.handles())
+        start = time.perf_counter()
+        for i in picks:
+            queue.remove(handles[i])
+            queue.handle_at(1)
+        handle_peek_ms = 1000 * (time.perf_counter() - start)
+
+        saving = 1 - track_bytes / legacy_bytes
+        print(f"{n:>8} {legacy_bytes / n:>19.0f} {track_bytes / n:>25.0f} {saving:>7.0%} "
+              f"{legacy_ms:>18.1f} {handle_ms:>19.2f} {legacy_peek_ms:>17.1f} {handle_peek_ms:>18.2f}")
+
+if __name__ == "__main__":
+    main()
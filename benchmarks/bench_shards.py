@@ -0,0 +1,105 @@
+"""
+Capacidad de servidores según el número de procesos (modo multiproceso de launcher.py).
+
+Cada proceso del bot es independiente (sus shards, su pool de yt-dlp, sus hilos de audio), así
+que se simula con P ejecuciones simultáneas de bench_load.py (escenario play), cada una con G
+servidores. Para cada P se busca la mayor G con la que todos los procesos entregan el audio a
+tiempo (audio_realtime ≥ --min-realtime) y sin lag del event loop (p95 ≤ --max-lag): se dobla G
+hasta fallar y se afina con una búsqueda binaria. La capacidad total es P × G.
+
+Con tantos procesos como núcleos la capacidad debería crecer casi en línea; por encima, no.
+
+Uso:
+    python benchmarks/bench_shards.py --processes 1,2,4 --start-guilds 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_LOAD = os.path.join(HERE, "bench_load.py")
+
+def run_round(processes: int, guilds: int, args) -> dict:
+    """P bench_load.py a la vez con G servidores cada uno; devuelve el peor resultado de todos."""
+    with tempfile.TemporaryDirectory(prefix="musicbot-shards-") as tmp:
+        runs = []
+        for i in range(processes):
+            out = os.path.join(tmp, f"p{i}.json")
+            env = dict(os.environ, BOT_DATA_DIR=os.path.join(tmp, f"data{i}"))
+            # Con loop all nadie se queda en silencio: cualquier frame que falte es falta de CPU.
+            # Sin plazo para los /play: aquí interesa el audio, no rechazar comandos con el pool lleno
+            command = [sys.executable, BENCH_LOAD, "--scenarios", "play", "--guilds", str(guilds),
+                       "--per-guild", "2", "--loop", "all", "--seconds", str(args.seconds),
+                       "--track-seconds", str(args.track_seconds), "--mode", args.mode,
+                       "--workers", str(args.workers), "--deadline", "0", "--json", out]
+            runs.append((out, subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)))
+        results = []
+        for out, process in runs:
+            process.wait()
+            try:
+                with open(out) as f:
+                    results.append(json.load(f)["results"][0])
+            except (OSError, ValueError, IndexError):
+                results.append({"audio_realtime": 0.0, "loop_lag_p95": float("inf"), "first_audio_p95": 0.0})
+    return {
+        "audio_realtime": min(r["audio_realtime"] for r in results),
+        "loop_lag_p95": max(r["loop_lag_p95"] for r in results),
+        "first_audio_p95": max(r["first_audio_p95"] for r in results),
+    }
+
+def healthy(result: dict, args) -> bool:
+    return result["audio_realtime"] >= args.min_realtime and result["loop_lag_p95"] <= args.max_lag
+
+def capacity(processes: int, args) -> int:
+    """Mayor número de servidores por proceso que aguantan P procesos a la vez."""
+    def probe(guilds: int) -> bool:
+        result = run_round(processes, guilds, args)
+        ok = healthy(result, args)
+        print(f"  {processes} proc × {guilds:>4} servidores: audio {result['audio_realtime']:.1%}, "
+              f"lag p95 {1000 * result['loop_lag_p95']:.0f} ms → {'ok' if ok else 'saturado'}", flush=True)
+        return ok
+
+    good, bad = 0, args.start_guilds
+    while bad <= args.max_guilds and probe(bad):
+        good, bad = bad, bad * 2
+    bad = min(bad, args.max_guilds + 1)
+    # Afinar entre el último G que aguantó y el primero que no
+    while bad - good > max(1, good // 8):
+        middle = (good + bad) // 2
+        if probe(middle):
+            good = middle
+        else:
+            bad = middle
+    return good
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", default="1,2,4", help="lista de procesos del bot a probar")
+    parser.add_argument("--start-guilds", type=int, default=4, help="servidores por proceso de la primera prueba")
+    parser.add_argument("--max-guilds", type=int, default=512, help="tope de servidores por proceso")
+    parser.add_argument("--seconds", type=float, default=15, help="ventana de medida del audio")
+    parser.add_argument("--track-seconds", type=int, default=8)
+    parser.add_argument("--mode", default="pcm", choices=("pcm", "opus"))
+    parser.add_argument("--workers", type=int, default=1, help="procesos de yt-dlp por proceso del bot")
+    parser.add_argument("--min-realtime", type=float, default=0.97, help="fracción mínima de frames a tiempo")
+    parser.add_argument("--max-lag", type=float, default=0.1, help="lag p95 máximo del event loop (s)")
+    args = parser.parse_args()
+
+    print(f"Núcleos disponibles: {os.cpu_count()}")
+    table = []
+    for processes in (int(p) for p in args.processes.split(",")):
+        print(f"\n== {processes} proceso(s)")
+        per_process = capacity(processes, args)
+        table.append((processes, per_process))
+
+    base = table[0][1] * table[0][0] or 1
+    print(f"\n{'procesos':>8} {'servidores/proceso':>19} {'total':>7} {'escalado':>9}")
+    for processes, per_process in table:
+        total = processes * per_process
+        print(f"{processes:>8} {per_process:>19} {total:>7} {total / base:>8.2f}x")
+
+if __name__ == "__main__":
+    main()
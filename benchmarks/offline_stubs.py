@@ -0,0 +1,341 @@
+"""
+Dobles locales para medir MusicBot sin Discord, YouTube ni Spotify (ver bench_load.py).
+
+- FakeYoutubeDL: sustituye a yt_dlp.YoutubeDL dentro de los procesos de ExtractionEngine
+  (install_fake_ytdlp es el initializer del pool) con latencia y coste de CPU configurables.
+  Las URLs de stream apuntan a un archivo de audio local servido por HTTP, así que ffmpeg es real.
+- FakeSpotify: sustituye a SpotifyClient.get con respuestas de la Web API con la forma real
+  (/tracks por lotes, playlists y álbumes paginados con total, top de artista).
+- FakeLyrics: sustituye a LyricsService._fetch (lyrics.ovh) con letras generadas tras una latencia.
+- FakeVoiceClient: consume un frame cada 20 ms en un hilo, como discord.player.AudioPlayer.
+- FakeInteraction: lo mínimo que usan los comandos (response, followup, guild, user, channel).
+"""
+import asyncio
+import functools
+import hashlib
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+FRAME = 0.02
+
+# =========================
+# AUDIO LOCAL
+# =========================
+def make_test_audio(ffmpeg_path: str, directory: str, seconds: int) -> str:
+    path = os.path.join(directory, "track.webm")
+    subprocess.run(
+        [ffmpeg_path, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-ac", "2", "-ar", "48000", "-c:a", "libopus", "-b:a", "96k", path],
+        check=True,
+    )
+    return path
+
+def serve_directory(directory: str, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Sirve `directory` por HTTP; `latency` imita el tiempo hasta el primer byte de googlevideo."""
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            try:
+                super().do_GET()
+            except (BrokenPipeError, ConnectionResetError):
+                pass   # ffmpeg matado a media descarga (skip, seek, precarga descartada)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# =========================
+# YT-DLP FALSO (procesos del pool)
+# =========================
+_CONFIG = {"latency": 0.5, "jitter": 0.3, "cpu_ms": 20, "audio_url": "", "duration": 10}
+_WATCH_ID_RE = re.compile(r"[?&]v=([A-Za-z0-9_-]{11})")
+_FLAT_COST = 0.3   # latencia y CPU de una búsqueda plana respecto a una extracción completa
+# Versiones que salen tras el audio oficial en una búsqueda real y que el emparejado debe descartar
+_VARIANTS = ("Live", "Cover", "Karaoke", "Remix", "Sped Up")
+
+class FakeYoutubeDL:
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    @staticmethod
+    def _video(key: str) -> dict:
+        match = _WATCH_ID_RE.search(key)
+        vid = match.group(1) if match else hashlib.sha1(key.encode()).hexdigest()[:11]
+        return {
+            "id": vid,
+            "title": f"Pista {vid}",
+            "webpage_url": f"https://www.youtube.com/watch?v={vid}",
+            "duration": _CONFIG["duration"],
+            "thumbnail": f"https://i.ytimg.com/vi/{vid}/hqdefault.jpg",
+            "uploader": f"Artista {sum(map(ord, vid)) % 50}",
+            "url": f"{_CONFIG['audio_url']}?v={vid}",
+            "acodec": "opus",
+            "extractor_key": "Youtube",
+        }
+
+    def extract_info(self, query: str, download: bool = False):
+        # Una búsqueda plana es una sola petición sin resolver formatos: bastante más barata
+        flat = bool(self.params.get("extract_flat"))
+        cost = _FLAT_COST if flat else 1.0
+        latency, jitter = _CONFIG["latency"] * cost, _CONFIG["jitter"]
+        time.sleep(max(0.0, random.gauss(latency, latency * jitter)))
+        # Imitar el parseo de yt-dlp, que es CPU pura
+        deadline = time.process_time() + _CONFIG["cpu_ms"] * cost / 1000
+        while time.process_time() < deadline:
+            pass
+        if query.startswith("ytsearch"):
+            count, _, terms = query[len("ytsearch"):].partition(":")
+            if not flat:
+                return {"_type": "playlist", "entries": [self._video(terms)]}
+            # Resultados planos como los de YouTube para «canción artista»: el primero (el de una
+            # búsqueda completa) es el audio oficial con ese título en un canal "- Topic"; el resto,
+            # versiones del mismo título en canales cualquiera
+            entries = []
+            for i in range(int(count or 1)):
+                video = self._video(terms if i == 0 else f"{terms} #{i}")
+                entries.append({
+                    "id": video["id"],
+                    "title": f"{terms} ({_VARIANTS[(i - 1) % len(_VARIANTS)]})" if i else terms,
+                    "url": video["webpage_url"],
+                    "duration": video["duration"],
+                    "channel": f"{video['uploader']} - Topic" if i == 0 else video["uploader"],
+                })
+            return {"_type": "playlist", "entries": entries}
+        return self._video(query)
+
+    def sanitize_info(self, info):
+        return info
+
+def install_fake_ytdlp(latency: float, jitter: float, cpu_ms: float, audio_url: str, duration: int):
+    """Initializer del pool: cambia yt_dlp.YoutubeDL por FakeYoutubeDL en este proceso."""
+    import yt_dlp
+    import ytdl_worker
+
+    _CONFIG.update(latency=latency, jitter=jitter, cpu_ms=cpu_ms, audio_url=audio_url, duration=duration)
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    ytdl_worker._INSTANCES.clear()
+
+# =========================
+# SPOTIFY FALSO
+# =========================
+class FakeSpotify:
+    """Listados de `playlist_size` canciones; se instala con MusicBot.SPOTIFY.get = FakeSpotify(...).get."""
+
+    def __init__(self, latency: float = 0.1, playlist_size: int = 100, duration: int = 200):
+        self.latency = latency
+        self.playlist_size = playlist_size
+        self.duration = duration   # segundos, los mismos que las pistas de FakeYoutubeDL
+        self.calls = 0
+
+    def _track(self, track_id: str) -> dict:
+        return {"id": track_id, "name": f"Canción {track_id}", "duration_ms": self.duration * 1000,
+                "artists": [{"name": f"Artista {track_id[-2:]}"}]}
+
+    def _page(self, prefix: str, params: dict, wrap: bool) -> dict:
+        offset, limit = params["offset"], params["limit"]
+        end = min(self.playlist_size, offset + limit)
+        tracks = [self._track(f"{prefix}t{i}") for i in range(offset, end)]
+        return {"total": self.playlist_size, "items": [{"track": t} for t in tracks] if wrap else tracks}
+
+    async def get(self, path: str, params: dict | None = None) -> dict:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        params = params or {}
+        kind, _, rest = path.partition("/")
+        if kind == "tracks":
+            return {"tracks": [self._track(track_id) for track_id in params["ids"].split(",")]}
+        item_id = rest.split("/")[0]
+        if kind == "playlists":
+            return self._page(item_id, params, wrap=True)
+        if kind == "albums":
+            return self._page(item_id, params, wrap=False)
+        if kind == "artists":
+            return {"tracks": [self._track(f"{item_id}t{i}") for i in range(10)]}
+        raise ValueError(f"Ruta de Spotify no simulada: {path}")
+
+# =========================
+# LETRAS FALSAS
+# =========================
+class FakeLyrics:
+    """Letras de unas líneas para cualquier pista; se instala con MusicBot.LYRICS._fetch = FakeLyrics(...).fetch."""
+
+    def __init__(self, latency: float = 0.1):
+        self.latency = latency
+        self.calls = 0
+
+    async def fetch(self, artist: str, title: str) -> tuple[str, ...] | None:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        # Una sola página, como devuelve split_lyrics para una letra corta
+        return ("\n".join(f"{title} ({artist}), verso {i}" for i in range(20)),)
+
+# =========================
+# DISCORD FALSO
+# =========================
+class FakeVoiceClient:
+    """Reproduce como discord.player.AudioPlayer: un hilo que lee un frame cada 20 ms y codifica si es PCM."""
+
+    def __init__(self, channel: "FakeVoiceChannel", encoder=None):
+        self.channel = channel
+        self.encoder = encoder
+        self.frames = 0
+        self._connected = True
+        self._paused = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def _active(self) -> bool:
+        # Como en discord.py, tras stop() ya no cuenta como reproduciendo aunque el hilo aún no haya salido
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def is_playing(self) -> bool:
+        return self._active() and not self._paused.is_set()
+
+    def is_paused(self) -> bool:
+        return self._active() and self._paused.is_set()
+
+    def play(self, source, after=None):
+        if self._active():
+            raise RuntimeError("Already playing audio.")
+        stop = self._stop = threading.Event()
+        self._paused.clear()
+        self._thread = threading.Thread(target=self._run, args=(source, after, stop), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stop: threading.Event):
+        error = None
+        try:
+            next_at = time.perf_counter()
+            while not stop.is_set():
+                if self._paused.is_set():
+                    time.sleep(FRAME)
+                    next_at = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                if self.encoder is not None and not source.is_opus():
+                    self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+                self.frames += 1
+                next_at += FRAME
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            # discord.py marca el reproductor como terminado antes de llamar a after
+            stop.set()
+            if after is not None:
+                try:
+                    after(error)
+                except Exception:
+                    pass
+            source.cleanup()
+
+    def stop(self):
+        self._stop.set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False):
+        self._connected = False
+        self.stop()
+        self.channel.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild: "FakeGuild", channel_id: int, encoder=None):
+        self.guild = guild
+        self.id = channel_id
+        self.encoder = encoder
+
+    async def connect(self, **kwargs) -> FakeVoiceClient:
+        vc = self.guild.voice_client = FakeVoiceClient(self, self.encoder)
+        self.guild.voice_history.append(vc)
+        return vc
+
+class FakeMessage:
+    def __init__(self, content=None, channel: "FakeTextChannel | None" = None):
+        self.content = content
+        self.channel = channel
+        self.edits = 0
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        self.edits += 1
+        if self.channel is not None:
+            self.channel.calls += 1
+
+class FakeTextChannel:
+    """Cuenta las llamadas a Discord (envíos y ediciones) hechas en el canal."""
+
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent = 0
+        self.calls = 0
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        self.sent += 1
+        self.calls += 1
+        return FakeMessage(content, self)
+
+class FakeGuild:
+    def __init__(self, guild_id: int, encoder=None):
+        self.id = guild_id
+        self.voice_client: FakeVoiceClient | None = None
+        self.voice_history: list[FakeVoiceClient] = []   # también las ya desconectadas, para contar frames
+        self.voice_channel = FakeVoiceChannel(self, guild_id * 10 + 1, encoder)
+        self.text_channel = FakeTextChannel(guild_id * 10 + 2)
+
+    def get_channel(self, channel_id: int):
+        return {self.voice_channel.id: self.voice_channel, self.text_channel.id: self.text_channel}.get(channel_id)
+
+class _Response:
+    def __init__(self):
+        self.done = False
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+
+class _Followup:
+    def __init__(self, channel: FakeTextChannel):
+        self.channel = channel
+
+    async def send(self, content=None, wait: bool = False, **kwargs) -> FakeMessage:
+        self.channel.calls += 1
+        return FakeMessage(content, self.channel)
+
+class FakeInteraction:
+    """Interacción de un miembro conectado al canal de voz de `guild`."""
+
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = guild.text_channel
+        self.channel_id = guild.text_channel.id
+        self.user = SimpleNamespace(id=guild.id * 10 + 3, voice=SimpleNamespace(channel=guild.voice_channel))
+        self.response = _Response()
+        self.followup = _Followup(guild.text_channel)
@@ -0,0 +1,161 @@
+"""
+Lanzador multiproceso de MusicBot: reparte los shards de Discord entre N procesos, cada uno con
+su AutoShardedBot, su pool de yt-dlp y sus hilos de audio, y los vuelve a arrancar si se caen.
+
+- El número de shards es el recomendado por Discord (GET /gateway/bot) salvo que se pase --shards.
+- Los shards se reparten alternos (0, N, 2N... al proceso 0) para equilibrar servidores por proceso.
+- Los procesos arrancan escalonados: Discord limita los IDENTIFY a max_concurrency cada 5 s.
+- Sólo el proceso 0 sincroniza los comandos; cada proceso tiene su puerto HTTP (PORT + índice),
+  su diario de colas, su cola de scrobbles y su parte de la caché de audio.
+
+Para que un servidor pueda cambiar de proceso al repartir de nuevo los shards (otro --processes u
+otro total) el estado de las colas tiene que ser compartido: STATE_STORE=redis.
+
+Uso:
+    python launcher.py --processes 4
+    STATE_STORE=redis python launcher.py --processes 4 --shards 16
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BOT_SCRIPT = os.path.join(ROOT, "MusicBot.py")
+GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+IDENTIFY_WINDOW = 5.0          # segundos por tanda de IDENTIFY
+RESTART_BACKOFF = (2.0, 60.0)  # espera inicial y máxima antes de rearrancar un proceso caído
+STABLE_AFTER = 120.0           # un proceso que aguanta esto vuelve a la espera inicial
+
+def recommended_sharding(token: str) -> tuple[int, int]:
+    """(shards recomendados, max_concurrency) según Discord."""
+    request = urllib.request.Request(GATEWAY_BOT_URL, headers={
+        "Authorization": f"Bot {token}", "User-Agent": "DiscordBot (MusicBot launcher, 1.0)",
+    })
+    with urllib.request.urlopen(request, timeout=15) as response:
+        data = json.load(response)
+    return int(data["shards"]), int(data.get("session_start_limit", {}).get("max_concurrency", 1))
+
+def split_shards(shard_count: int, processes: int) -> list[list[int]]:
+    return [list(range(i, shard_count, processes)) for i in range(processes)]
+
+class Worker:
+    """Un proceso de MusicBot con su grupo de shards."""
+
+    def __init__(self, index: int, shard_ids: list[int], env: dict):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = env
+        self.process: subprocess.Popen | None = None
+        self.started_at = 0.0
+        self.backoff = RESTART_BACKOFF[0]
+        self.restart_at: float | None = None
+
+    def start(self):
+        # Sesión propia: un Ctrl+C en la terminal sólo llega al lanzador, que lo reenvía en orden
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=ROOT, env=self.env, start_new_session=True)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        print(f"[launcher] Proceso {self.index} (pid {self.process.pid}) con los shards {self.shard_ids}")
+
+def worker_env(index: int, shard_ids: list[int], args, shard_count: int) -> dict:
+    env = dict(os.environ)
+    data_dir = env.get("BOT_DATA_DIR", os.path.join(ROOT, "data"))
+    process_dir = os.path.join(data_dir, f"p{index}")
+    os.makedirs(process_dir, exist_ok=True)
+    env.update(
+        BOT_DATA_DIR=data_dir,
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=",".join(map(str, shard_ids)),
+        PORT=str(args.base_port + index),
+        COMMAND_SYNC="1" if index == 0 else "0",
+        QUEUE_JOURNAL_PATH=os.path.join(process_dir, "queues.journal"),
+        QUEUE_SNAPSHOT_PATH=os.path.join(process_dir, "queues.snapshot.json"),
+        SCROBBLE_SPOOL_PATH=os.path.join(process_dir, "scrobbles.spool.json"),
+        AUDIO_CACHE_DIR=os.path.join(process_dir, "audio"),
+        AUDIO_CACHE_MAX_MB=str(int(env.get("AUDIO_CACHE_MAX_MB", 2048)) // args.processes),
+    )
+    if args.ytdlp_workers:
+        env["YTDLP_WORKERS"] = str(args.ytdlp_workers)
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="procesos del bot")
+    parser.add_argument("--shards", type=int, default=0, help="total de shards (0: el recomendado por Discord)")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="IDENTIFY simultáneos (0: el de Discord)")
+    parser.add_argument("--base-port", type=int, default=int(os.getenv("PORT", 10000)), help="puerto HTTP del proceso 0")
+    parser.add_argument("--ytdlp-workers", type=int, default=0, help="procesos de yt-dlp por proceso del bot")
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(ROOT, ".env"))
+    shard_count, max_concurrency = args.shards, args.max_concurrency or 1
+    if not shard_count:
+        token = os.getenv("DISCORD_TOKEN")
+        if not token:
+            sys.exit("[launcher] Falta DISCORD_TOKEN para consultar los shards recomendados (o usa --shards)")
+        shard_count, recommended_concurrency = recommended_sharding(token)
+        max_concurrency = args.max_concurrency or recommended_concurrency
+    args.processes = max(1, min(args.processes, shard_count))
+    if args.processes > 1 and os.getenv("STATE_STORE", "file").lower() != "redis":
+        print("[launcher] AVISO: sin STATE_STORE=redis cada proceso guarda sus colas aparte; "
+              "si cambia el reparto de shards, un servidor que cambie de proceso no recupera su cola")
+
+    workers = [Worker(i, ids, worker_env(i, ids, args, shard_count))
+               for i, ids in enumerate(split_shards(shard_count, args.processes))]
+    print(f"[launcher] {shard_count} shards en {len(workers)} procesos")
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Cada proceso identifica sus shards de max_concurrency en max_concurrency, uno detrás de otro
+    for worker in workers:
+        if stopping:
+            break
+        worker.start()
+        deadline = time.monotonic() + IDENTIFY_WINDOW * -(-len(worker.shard_ids) // max_concurrency)
+        while not stopping and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+    while not stopping:
+        now = time.monotonic()
+        for worker in workers:
+            if worker.process is None or worker.process.poll() is None:
+                continue
+            if worker.restart_at is None:
+                if now - worker.started_at >= STABLE_AFTER:
+                    worker.backoff = RESTART_BACKOFF[0]
+                worker.restart_at = now + worker.backoff
+                print(f"[launcher] El proceso {worker.index} salió con código {worker.process.returncode}; "
+                      f"se reinicia en {worker.backoff:.0f} s")
+                worker.backoff = min(worker.backoff * 2, RESTART_BACKOFF[1])
+            elif now >= worker.restart_at:
+                worker.start()
+        time.sleep(0.5)
+
+    # Apagado ordenado: cada bot guarda sus colas en close() antes de salir
+    print("[launcher] Deteniendo procesos...")
+    alive = [w.process for w in workers if w.process is not None and w.process.poll() is None]
+    for process in alive:
+        process.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + 30
+    for process in alive:
+        try:
+            process.wait(timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+"""
+Configuración común de las pruebas: MusicBot lee su configuración al importarse, así que los
+datos van a una carpeta temporal antes de cargarlo.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_DATA_DIR", tempfile.mkdtemp(prefix="musicbot-tests-"))
@@ -0,0 +1,67 @@
+import MusicBot
+from MusicBot import PlayHistory, Track
+
+def track(n: int, title: str, artist: str = "Adele") -> Track:
+    return Track(str(n), title, f"https://www.youtube.com/watch?v={n:011d}", 200, "", artist)
+
+def test_replay_after_restart(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    hello, other = track(1, "Hello"), track(2, "Someone Like You")
+    first = PlayHistory(path, max_tracks=10)
+    first.remember_query("g", "Hello", hello)
+    first.record("g", hello)
+    first.record("g", other, hello)
+
+    # Proceso nuevo sobre la misma base: el servidor ya tiene pistas que no ha contado
+    restarted = PlayHistory(path, max_tracks=10)
+    restarted.record("g", hello, other)
+    restarted.record("g", other, hello)
+
+    assert restarted.find("g", "  HELLO ") == hello
+    plays = dict(restarted._conn.execute("SELECT url, plays FROM tracks WHERE guild = 'g'").fetchall())
+    assert plays == {hello.webpage_url: 2, other.webpage_url: 2}
+    assert restarted.next_track("g", hello) == other
+
+def test_eviction_counts_existing_tracks(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    history = PlayHistory(path, max_tracks=10)
+    for n in range(8):
+        history.record("g", track(n, f"Pista {n}"))
+
+    restarted = PlayHistory(path, max_tracks=10)
+    for n in range(8, 11):
+        restarted.remember_query("g", f"pista {n}", track(n, f"Pista {n}"))
+        restarted.record("g", track(n, f"Pista {n}"))
+    # La pista 11 pasa del límite: se quedan las 9 (90%) más recientes
+    assert restarted._conn.execute("SELECT COUNT(*) FROM tracks WHERE guild = 'g'").fetchone()[0] == 9
+    assert restarted.find("g", "pista 10") == track(10, "Pista 10")
+    assert restarted.find("g", track(1, "Pista 1").webpage_url) is None
+    assert restarted.find("g", track(5, "Pista 5").webpage_url) == track(5, "Pista 5")
+
+def test_search_by_prefix_and_find_by_exact_query(tmp_path):
+    history = PlayHistory(str(tmp_path / "history.sqlite3"), max_tracks=10)
+    deep = track(3, "Rolling in the Deep")
+    history.remember_query("g", "rolling in the deep adele", deep)
+    history.record("g", deep)
+    assert history.search("g", "roll dee") == [deep]
+    assert history.find("g", "Rolling  in the Deep ADELE") == deep
+    assert history.find("g", deep.webpage_url) == deep
+    assert history.find("otro", "rolling in the deep adele") is None
+    assert MusicBot.history_words("Hello - Adele") == ["hello", "adele"]
+
+def test_new_query_sharing_words_is_not_replaced(tmp_path):
+    history = PlayHistory(str(tmp_path / "history.sqlite3"), max_tracks=10)
+    hello = track(1, "Hello")
+    history.remember_query("g", "hello adele", hello)
+    history.record("g", hello)
+    # Otra canción que comparte palabras con lo que ya sonó se busca de nuevo
+    assert history.find("g", "hello") is None
+    assert history.find("g", "hello lionel richie") is None
+    assert history.find("g", "adele") is None
+    assert history.replays == 0
+
+def test_remembered_query_needs_a_played_track(tmp_path):
+    history = PlayHistory(str(tmp_path / "history.sqlite3"), max_tracks=10)
+    # Resuelta pero nunca sonó (p. ej. /clearqueue antes de llegar): no hay nada que repetir
+    history.remember_query("g", "hello adele", track(1, "Hello"))
+    assert history.find("g", "hello adele") is None
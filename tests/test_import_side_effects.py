@@ -0,0 +1,30 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+from MusicBot import PlayHistory, QueueJournal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_import_leaves_data_dir_alone(tmp_path):
+    """Los procesos de extracción importan el módulo: no deben crear carpetas, abrir bases ni tocar la caché de audio."""
+    audio = tmp_path / "audio_cache"
+    audio.mkdir()
+    (audio / "abc.webm.part").write_bytes(b"descargando")
+    data = tmp_path / "data"
+    env = {**os.environ, "BOT_DATA_DIR": str(data), "AUDIO_CACHE_DIR": str(audio)}
+    subprocess.run([sys.executable, "-c", "import MusicBot"], cwd=ROOT, env=env, check=True, timeout=60)
+
+    assert (audio / "abc.webm.part").exists()
+    assert not data.exists()
+
+def test_files_create_their_directory_on_first_write(tmp_path):
+    history = PlayHistory(str(tmp_path / "a" / "history.sqlite3"), max_tracks=10)
+    assert history.search("g", "nada") == []
+    journal = QueueJournal(str(tmp_path / "b" / "queues.journal"), str(tmp_path / "c" / "queues.snapshot.json"))
+    journal.record("1", "loop", m="all")
+    asyncio.run(journal.flush({"1": {"loop": "all"}}))
+    assert (tmp_path / "a" / "history.sqlite3").exists()
+    assert (tmp_path / "c" / "queues.snapshot.json").exists()
+    assert (tmp_path / "b" / "queues.journal").exists()
@@ -0,0 +1,51 @@
+import asyncio
+
+from MusicBot import QueueJournal
+
+def track(n: int) -> dict:
+    return {"id": str(n), "title": f"Pista {n}", "webpage_url": f"https://example.com/{n}",
+            "duration": 100, "thumbnail": "", "artist": "Artista"}
+
+def journal(tmp_path) -> QueueJournal:
+    return QueueJournal(str(tmp_path / "queues.journal"), str(tmp_path / "queues.snapshot.json"))
+
+def titles(state: dict, guild_id: str = "1") -> list[str]:
+    return [t["title"] for _, t in state[guild_id]["queue"]]
+
+def test_recovery_after_torn_write(tmp_path):
+    first = journal(tmp_path)
+    for n in range(3):
+        first.record("1", "add", h=n, t=track(n))
+    asyncio.run(first.flush())
+    # Caída a media escritura: la última línea queda incompleta
+    with open(first.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"h":3,"t":{"id":"3","tit')
+
+    second = journal(tmp_path)
+    assert titles(asyncio.run(second.load())) == ["Pista 0", "Pista 1", "Pista 2"]
+    for n in (10, 11):
+        second.record("1", "add", h=n, t=track(n))
+    asyncio.run(second.flush())
+
+    # Los registros escritos tras la recuperación sobreviven a la siguiente carga
+    third = journal(tmp_path)
+    assert titles(asyncio.run(third.load())) == ["Pista 0", "Pista 1", "Pista 2", "Pista 10", "Pista 11"]
+    assert third.seq == second.seq
+
+def test_snapshot_plus_journal_applies_each_record_once(tmp_path):
+    first = journal(tmp_path)
+    first.record("1", "add", h=0, t=track(0))
+    first.record("1", "add", h=1, t=track(1))
+    asyncio.run(first.flush())
+    state = asyncio.run(journal(tmp_path).load())
+    asyncio.run(first.flush(state))
+    first.record("1", "rotate")
+    first.record("2", "add", h=0, t=track(5))
+    asyncio.run(first.flush())
+
+    state = asyncio.run(journal(tmp_path).load())
+    assert titles(state) == ["Pista 1", "Pista 0"]
+    assert titles(state, "2") == ["Pista 5"]
+
+def test_missing_files_load_empty(tmp_path):
+    assert asyncio.run(journal(tmp_path).load()) == {}
@@ -0,0 +1,26 @@
+import asyncio
+import os
+
+import MusicBot
+from MusicBot import AudioCache, PlayHistory, ResolutionCache
+
+def test_metrics_do_not_touch_the_disk(tmp_path, monkeypatch):
+    audio = tmp_path / "audio"
+    audio.mkdir()
+    (audio / "abc.webm").write_bytes(b"x" * 100)
+    monkeypatch.setattr(MusicBot, "RESOLUTION_CACHE", ResolutionCache(str(tmp_path / "cache.sqlite3"), 3600, 100))
+    monkeypatch.setattr(MusicBot, "HISTORY", PlayHistory(str(tmp_path / "history.sqlite3"), 100))
+    monkeypatch.setattr(MusicBot, "AUDIO_CACHE", AudioCache(str(audio), 10_000, 600))
+
+    text = MusicBot.render_metrics()
+    assert MusicBot.RESOLUTION_CACHE._db is None
+    assert MusicBot.HISTORY._db is None
+    assert MusicBot.AUDIO_CACHE._files is None
+    assert "musicbot_audio_cache_bytes 0" in text
+
+    asyncio.run(MusicBot.open_caches())
+    assert os.path.exists(tmp_path / "cache.sqlite3")
+    assert os.path.exists(tmp_path / "history.sqlite3")
+    text = MusicBot.render_metrics()
+    assert "musicbot_audio_cache_bytes 100" in text
+    assert "musicbot_audio_cache_tracks 1" in text
@@ -0,0 +1,17 @@
+import pytest
+
+from MusicBot import is_youtube_playlist
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.youtube.com/playlist?list=PLabc123", True),
+    ("https://music.youtube.com/playlist?list=OLAK5uy_abc", True),
+    ("https://www.youtube.com/watch?list=RDabc123", True),
+    # Un vídeo abierto desde una playlist o un mix suena solo
+    ("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=RDdQw4w9WgXcQ&start_radio=1", False),
+    ("https://www.youtube.com/watch?list=PLabc123&v=dQw4w9WgXcQ&index=3", False),
+    ("https://youtu.be/dQw4w9WgXcQ?list=PLabc123", False),
+    ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", False),
+    ("never gonna give you up", False),
+])
+def test_playlist_only_without_video(url, expected):
+    assert is_youtube_playlist(url) is expected
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from collections import deque
+
+import pytest
+
+import MusicBot
+from MusicBot import ExtractionJob, ExtractionRejected, ExtractionScheduler, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+class FakeExtractor:
+    """Un proceso de yt-dlp: anota el orden de las extracciones y tarda `delay` en cada una."""
+
+    def __init__(self, delay: float = 0.05):
+        self.workers = 1
+        self.work_times = deque()
+        self.delay = delay
+        self.calls: list[str] = []
+
+    async def extract(self, query, ydl_opts, overrides=None):
+        self.calls.append(query)
+        await asyncio.sleep(self.delay)
+        return {"query": query}
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    extractor = FakeExtractor()
+    scheduler = ExtractionScheduler(max_active=1, user_rate=60, user_burst=2)
+    monkeypatch.setattr(MusicBot, "EXTRACTOR", extractor)
+    monkeypatch.setattr(MusicBot, "EXTRACTION_SCHEDULER", scheduler)
+    monkeypatch.setattr(MusicBot, "EXTRACTIONS", MusicBot.SingleFlight())
+    return scheduler
+
+def test_deadline_rejects_only_the_late_caller(scheduler):
+    async def main():
+        late = ExtractionJob(PRIORITY_INTERACTIVE, "g1", 1, time.monotonic() + 0.01)
+        patient = ExtractionJob(PRIORITY_INTERACTIVE, "g2", 2)
+        first = asyncio.ensure_future(scheduler.within(late, MusicBot.search_ytdlp_async("q", {}, job=late)))
+        second = asyncio.ensure_future(MusicBot.search_ytdlp_async("q", {}, job=patient))
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        return results
+
+    late_result, patient_result = asyncio.run(main())
+    assert isinstance(late_result, ExtractionRejected) and late_result.reason == "deadline"
+    assert patient_result == {"query": "q"}
+    assert MusicBot.EXTRACTOR.calls == ["q"]
+    assert scheduler.active == 0
+
+def test_rate_limit_is_per_command_and_per_user(scheduler):
+    async def main():
+        a = ExtractionJob(PRIORITY_INTERACTIVE, "g1", 1)
+        b = ExtractionJob(PRIORITY_INTERACTIVE, "g1", 2)
+        scheduler.admit(a)
+        # Varias extracciones internas de un mismo comando no gastan más fichas
+        for query in ("x", "y", "z"):
+            await MusicBot.search_ytdlp_async(query, {}, job=a)
+        scheduler.admit(a)
+        with pytest.raises(ExtractionRejected) as rejected:
+            scheduler.admit(a)
+        # El límite de A no afecta a B aunque se una a la misma extracción
+        scheduler.admit(b)
+        assert await MusicBot.search_ytdlp_async("x", {}, job=b) == {"query": "x"}
+        return rejected.value
+
+    rejected = asyncio.run(main())
+    assert rejected.reason == "rate" and rejected.retry_after > 0
+    assert scheduler.rejected == {"rate": 1, "deadline": 0}
+
+def test_interactive_first_and_promotion_of_shared_keys(scheduler):
+    async def main():
+        bulk = ExtractionJob(PRIORITY_BULK, "g1")
+        interactive = ExtractionJob(PRIORITY_INTERACTIVE, "g2")
+        tasks = [asyncio.ensure_future(MusicBot.search_ytdlp_async(f"bulk{i}", {}, job=bulk)) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(MusicBot.search_ytdlp_async("play", {}, job=interactive)))
+        # Un comando se une a una extracción de importación que aún espera turno: sube con él
+        tasks.append(asyncio.ensure_future(MusicBot.search_ytdlp_async("bulk3", {}, job=interactive)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    calls = MusicBot.EXTRACTOR.calls
+    assert calls[0] == "bulk0"                       # ya estaba en marcha
+    assert set(calls[1:3]) == {"play", "bulk3"}      # las interactivas adelantan a la importación
+    assert calls[3:] == ["bulk1", "bulk2"]
+    assert scheduler.active == 0 and not scheduler._queued
+
+def test_cancelled_waiter_leaves_no_slot_behind(scheduler):
+    extractor = MusicBot.EXTRACTOR
+
+    async def main():
+        running = asyncio.ensure_future(scheduler.run(None, lambda: extractor.extract("a", {}), "a"))
+        waiting = asyncio.ensure_future(scheduler.run(None, lambda: extractor.extract("b", {}), "b"))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await running
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert extractor.calls == ["a"]
+    assert scheduler.active == 0 and scheduler.waiting(1) == 0 and not scheduler._queued
+
+def test_admit_rejects_when_queue_cannot_answer_in_time(scheduler):
+    MusicBot.EXTRACTOR.work_times.extend([1.0] * 5)
+    scheduler._waiting.extend(MusicBot._Waiter(ExtractionJob(), PRIORITY_INTERACTIVE, i, None, 0) for i in range(3))
+    with pytest.raises(ExtractionRejected):
+        scheduler.admit(ExtractionJob(PRIORITY_INTERACTIVE, "g", 1, time.monotonic() + 2))
+    scheduler.admit(ExtractionJob(PRIORITY_INTERACTIVE, "g", 1, time.monotonic() + 10))
+
+def test_rejected_admission_costs_no_token(scheduler):
+    MusicBot.EXTRACTOR.work_times.extend([1.0] * 5)
+    scheduler._waiting.extend(MusicBot._Waiter(ExtractionJob(), PRIORITY_INTERACTIVE, i, None, 0) for i in range(3))
+    for _ in range(5):
+        with pytest.raises(ExtractionRejected) as rejected:
+            scheduler.admit(ExtractionJob(PRIORITY_INTERACTIVE, "g", 1, time.monotonic() + 2))
+        assert rejected.value.reason == "deadline"
+    # Los rechazos por plazo no gastaron el cubo: las dos fichas siguen ahí
+    scheduler.admit(ExtractionJob(PRIORITY_INTERACTIVE, "g", 1))
+    scheduler.admit(ExtractionJob(PRIORITY_INTERACTIVE, "g", 1))
+    with pytest.raises(ExtractionRejected) as rejected:
+        scheduler.admit(ExtractionJob(PRIORITY_INTERACTIVE, "g", 1))
+    assert rejected.value.reason == "rate"
@@ -0,0 +1,29 @@
+import asyncio
+
+import discord
+import pytest
+
+import MusicBot
+
+async def nothing():
+    pass
+
+@pytest.fixture
+def quiet_setup(monkeypatch):
+    """setup_hook sin persistencia, servidor HTTP ni tareas de fondo."""
+    for name in ("open_caches", "start_queue_persistence", "start_http_server", "monitor_loop_lag", "seed_suggestions"):
+        monkeypatch.setattr(MusicBot, name, nothing)
+    monkeypatch.setattr(MusicBot, "SCROBBLER", None)
+    monkeypatch.setattr(MusicBot, "COMMAND_SYNC", True)
+    monkeypatch.setattr(MusicBot, "STARTUP_TIMES", {})
+
+def test_failed_command_sync_does_not_abort_startup(quiet_setup, monkeypatch, capsys):
+    async def failing_sync():
+        raise discord.HTTPException(type("Response", (), {"status": 429, "reason": "Too Many Requests"})(), "rate limited")
+
+    monkeypatch.setattr(MusicBot, "sync_command_tree", failing_sync)
+    asyncio.run(MusicBot.bot.setup_hook())
+
+    assert MusicBot.STARTUP_TIMES["command_sync"] == MusicBot.COMMAND_SYNC_FAILED
+    assert "setup" in MusicBot.STARTUP_TIMES
+    assert "No se pudieron sincronizar los comandos" in capsys.readouterr().out
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from MusicBot import MemoryStateStore, RedisStateStore, StateStore
+
+def track(n: int) -> dict:
+    return {"id": str(n), "title": f"Pista {n}", "webpage_url": f"https://example.com/{n}",
+            "duration": 100, "thumbnail": "", "artist": "Artista"}
+
+def fill(store: StateStore):
+    for n in range(3):
+        store.record("1", "add", h=n, t=track(n))
+    store.record("1", "move", h=2, to=0)
+    store.record("1", "current", h=2, p=0)
+    store.record("1", "position", h=2, p=42)
+    store.record("1", "loop", m="all")
+    store.record("1", "volume", v=0.8)
+    store.record("1", "channels", vc=10, tc=20)
+    store.record("2", "add", h=0, t=track(9))
+    store.record("2", "drop")
+
+EXPECTED = {"1": {
+    "queue": [[2, track(2)], [0, track(0)], [1, track(1)]], "current": 2, "position": 42, "loop": "all",
+    "volume": 0.8, "autoplay": False, "voice": 10, "text": 20,
+}}
+
+class FakeRedis:
+    """Servidor RESP en memoria con los comandos que usa RedisStateStore (HSET, HDEL, HGETALL)."""
+
+    def __init__(self):
+        self.hashes: dict[bytes, dict[bytes, bytes]] = {}
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return f"redis://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/0"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(FakeRedis._encode(v) for v in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                args = []
+                for _ in range(int(line[1:])):
+                    size = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(size + 2))[:-2])
+                writer.write(self._encode(self._run(args[0].upper(), *args[1:])))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _run(self, command: bytes, key: bytes, *args):
+        table = self.hashes.setdefault(key, {})
+        if command == b"HSET":
+            table[args[0]] = args[1]
+            return 1
+        if command == b"HDEL":
+            return 1 if table.pop(args[0], None) is not None else 0
+        if command == b"HGETALL":
+            return [part for item in table.items() for part in item]
+        raise AssertionError(f"Comando no simulado: {command!r}")
+
+def test_state_store_is_abstract():
+    with pytest.raises(TypeError):
+        StateStore()
+
+def test_memory_store_round_trip():
+    store = MemoryStateStore()
+    fill(store)
+    assert asyncio.run(store.load()) == EXPECTED
+
+def test_redis_store_round_trip():
+    async def main():
+        redis = FakeRedis()
+        url = await redis.start()
+        try:
+            store = RedisStateStore(url, "musicbot:queues")
+            fill(store)
+            await store.flush()
+            # Sólo la posición cambia: se reescribe el hash de posiciones, no la cola
+            queues = dict(redis.hashes[b"musicbot:queues"])
+            store.record("1", "position", h=2, p=50)
+            await store.flush()
+            assert redis.hashes[b"musicbot:queues"] == queues
+            await store.close({})
+
+            restarted = RedisStateStore(url, "musicbot:queues")
+            loaded = await restarted.load()
+            await restarted.redis.close()
+            return loaded
+        finally:
+            await redis.stop()
+
+    assert asyncio.run(main()) == {"1": {**EXPECTED["1"], "position": 50}}
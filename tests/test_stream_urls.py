@@ -0,0 +1,24 @@
+import time
+
+import MusicBot
+from MusicBot import Track, remember_stream_url
+
+def track(n: int) -> Track:
+    return Track(id=str(n), title=f"Pista {n}", webpage_url=f"https://www.youtube.com/watch?v={n}",
+                 duration=100, thumbnail="", artist="Artista")
+
+def test_bounded_lru_and_expired_purge(monkeypatch):
+    monkeypatch.setattr(MusicBot, "STREAM_URLS", MusicBot.OrderedDict())
+    monkeypatch.setattr(MusicBot, "STREAM_URL_CACHE_SIZE", 3)
+    expire = int(time.time()) + 3600
+    for n in range(3):
+        remember_stream_url(track(n), {"url": f"https://r.googlevideo.com/{n}?expire={expire}"})
+    # Usar la 0 la salva: sale la 1, que es la menos usada
+    MusicBot.STREAM_URLS.move_to_end(track(0).webpage_url)
+    remember_stream_url(track(3), {"url": f"https://r.googlevideo.com/3?expire={expire}"})
+    assert list(MusicBot.STREAM_URLS) == [track(n).webpage_url for n in (2, 0, 3)]
+
+    # Las caducadas se van en la siguiente inserción aunque quede sitio
+    MusicBot.STREAM_URLS[track(2).webpage_url] = ("https://r.googlevideo.com/2", time.time() - 1, None)
+    remember_stream_url(track(4), {"url": f"https://r.googlevideo.com/4?expire={expire}"})
+    assert list(MusicBot.STREAM_URLS) == [track(n).webpage_url for n in (0, 3, 4)]
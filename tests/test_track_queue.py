@@ -0,0 +1,52 @@
+import random
+
+from MusicBot import Track, TrackQueue
+
+def track(n: int) -> Track:
+    return Track(str(n), f"Pista {n}", f"https://www.youtube.com/watch?v={n:011d}", 100, "", "Artista")
+
+def test_matches_a_plain_list_under_random_operations():
+    rng = random.Random(7)
+    queue, model, handles = TrackQueue(), [], {}
+    for step in range(5000):
+        op = rng.random()
+        if op < 0.35 or not model:
+            n = step
+            if rng.random() < 0.2:
+                position = rng.randint(0, len(model))
+                handles[n] = queue.insert(position, track(n))
+                model.insert(position, n)
+            else:
+                handles[n] = queue.append(track(n))
+                model.append(n)
+        elif op < 0.6:
+            n = rng.choice(model)
+            queue.remove(handles[n])
+            model.remove(n)
+        elif op < 0.7:
+            n, position = rng.choice(model), rng.randint(0, len(model) - 1)
+            queue.move(handles[n], position)
+            model.remove(n)
+            model.insert(position, n)
+        elif op < 0.8:
+            queue.rotate()
+            model.append(model.pop(0))
+        elif op < 0.85:
+            assert queue.popleft() == track(model.pop(0))
+        else:
+            index = rng.randrange(len(model))
+            assert queue.handle_at(index) == handles[model[index]]
+            assert queue.index_of(handles[model[index]]) == index
+        assert len(queue) == len(model)
+    assert [t.id for t in queue] == [str(n) for n in model]
+
+def test_peek_after_remove_does_not_compact():
+    queue = TrackQueue(track(n) for n in range(1000))
+    handles = list(queue.handles())
+    order = queue._order
+    for handle in handles[500:510]:
+        queue.remove(handle)
+        assert queue.handle_at(1) == handles[1]
+    # Pocas lápidas: siguen en la lista original, sin reconstruirla
+    assert queue._order is order and queue._dead == 10
+    assert queue.handle_at(600) == handles[610]
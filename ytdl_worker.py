@@ -0,0 +1,62 @@
+"""
+Trabajador de extracción para el pool de procesos de MusicBot (ver ExtractionEngine).
+
+Cada proceso del pool mantiene instancias de yt_dlp.YoutubeDL de larga vida, una por juego
+de opciones, para no volver a leer cookies.txt ni inicializar los extractores en cada búsqueda.
+"""
+import json
+import time
+
+# yt_dlp se importa al primer uso: el proceso del bot importa este módulo sólo para
+# referenciar sus funciones, y no debe pagar el coste de cargar yt-dlp
+
+# Instancias reutilizables por juego de opciones (JSON ordenado) dentro de este proceso
+_INSTANCES: dict[str, "yt_dlp.YoutubeDL"] = {}
+
+# Campos voluminosos que el bot no usa: no merece la pena serializarlos de vuelta al proceso principal
+_HEAVY_KEYS = ("formats", "thumbnails", "subtitles", "automatic_captions", "heatmap", "chapters", "requested_formats")
+
+class ExtractionError(Exception):
+    """Error de yt-dlp convertido a texto para que cruce la frontera entre procesos sin problemas."""
+
+def _get_ydl(opts_key: str) -> "yt_dlp.YoutubeDL":
+    ydl = _INSTANCES.get(opts_key)
+    if ydl is None:
+        import yt_dlp
+        ydl = _INSTANCES[opts_key] = yt_dlp.YoutubeDL(json.loads(opts_key))
+    return ydl
+
+def _slim(info):
+    if not isinstance(info, dict):
+        return info
+    for key in _HEAVY_KEYS:
+        info.pop(key, None)
+    if isinstance(info.get("entries"), list):
+        info["entries"] = [_slim(e) for e in info["entries"]]
+    return info
+
+def extract(query: str, opts_key: str, overrides: dict | None = None):
+    """
+    Extrae `query` con la instancia de `opts_key`. Devuelve (info, segundos de trabajo).
+    `overrides` cambia opciones sólo para esta llamada (p. ej. playlist_items para leer una
+    playlist por tramos) sin crear otra instancia por cada valor.
+    """
+    start = time.perf_counter()
+    ydl = _get_ydl(opts_key)
+    saved = {key: ydl.params[key] for key in overrides or () if key in ydl.params}
+    ydl.params.update(overrides or {})
+    try:
+        info = ydl.extract_info(query, download=False)
+        info = _slim(ydl.sanitize_info(info)) if info else info
+    except Exception as e:
+        raise ExtractionError(str(e)) from None
+    finally:
+        for key in overrides or ():
+            ydl.params.pop(key, None)
+        ydl.params.update(saved)
+    return info, time.perf_counter() - start
+
+def warmup() -> int:
+    """Arranca el proceso del pool y carga yt-dlp antes de la primera búsqueda real."""
+    import yt_dlp  # noqa: F401
+    return len(_INSTANCES)